@@ -0,0 +1,13 @@
+"""
+Benchmarks - reproducible performance numbers for the indexer
+    
+    corpus.py       deterministic synthetic Hebrew/Aramaic corpus (TXT + PDF)
+    stages.py       micro benchmarks of single stages (tokenize, postings,
+                    delta/postings encoding, flush, PDF extraction)
+    end_to_end.py   full builds in merge and runs build mode
+    __main__.py     runner: python -m benchmarks (see --help)
+
+Results are JSON files with throughput, peak RSS and DB size per
+benchmark; python -m benchmarks --compare A B shows the changes between
+two commits.
+"""
@@ -0,0 +1,222 @@
+"""
+Benchmark runner
+
+Generates (or reuses) the synthetic corpus, runs every benchmark in its
+own process - so peak RSS is per benchmark - and writes one JSON file of
+results per run.
+
+Usage (from the pdf-indexer directory):
+    python -m benchmarks                                # all, small corpus
+    python -m benchmarks --suite micro --size medium --corpus-dir ../bench-corpus
+    python -m benchmarks --only tokenize,flush --repeat 5
+    python -m benchmarks --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+from typing import Dict, List, Optional
+
+from benchmarks.corpus import SIZES, generate_corpus, load_corpus, make_spec
+from benchmarks.measure import peak_rss
+
+RESULTS_FORMAT = 1
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(PACKAGE_DIR, 'benchmarks', 'results')
+
+
+def _benchmarks() -> Dict:
+    # Imported lazily: --compare doesn't need the indexer's dependencies
+    from benchmarks.stages import MICRO_BENCHMARKS
+    from benchmarks.end_to_end import END_TO_END_BENCHMARKS
+    return {
+        'micro': MICRO_BENCHMARKS,
+        'e2e': END_TO_END_BENCHMARKS
+    }
+
+
+def _git(*args) -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', *args], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment() -> Dict:
+    """What the results depend on besides the code"""
+    commit = _git('rev-parse', '--short', 'HEAD')
+    return {
+        'commit': commit,
+        'dirty': bool(_git('status', '--porcelain', '--untracked-files=no', '.')) if commit else None,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def run_one(name: str, corpus_dir: str, options: Dict) -> Dict:
+    """Run a benchmark in this process (the runner's child)"""
+    manifest = load_corpus(corpus_dir)
+    for suite, benchmarks in _benchmarks().items():
+        if name in benchmarks:
+            measured = benchmarks[name](corpus_dir, manifest, options)
+            return {'suite': suite, **measured, **peak_rss()}
+    raise ValueError(f"Unknown benchmark: {name}")
+
+
+def run_isolated(name: str, corpus_dir: str, options: Dict) -> Dict:
+    """Run a benchmark in a fresh interpreter and return its result"""
+    process = subprocess.run(
+        [
+            sys.executable, '-m', 'benchmarks', '--run-one', name,
+            '--corpus-dir', corpus_dir, '--options', json.dumps(options)
+        ],
+        cwd=PACKAGE_DIR, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _format_bytes(size: Optional[int]) -> str:
+    if size is None:
+        return '-'
+    return f"{size / 1024 ** 2:.1f}MB"
+
+
+def format_result(name: str, measured: Dict) -> str:
+    if 'error' in measured:
+        return f"{name:<16} ERROR: {measured['error']}"
+    if 'skipped' in measured:
+        return f"{name:<16} skipped: {measured['skipped']}"
+    line = (
+        f"{name:<16} {measured['throughput']:>14,.1f} {measured['unit']:<10} "
+        f"{measured['seconds']:8.3f}s  rss {_format_bytes(measured.get('peak_rss'))}"
+    )
+    if measured.get('db_bytes') is not None:
+        line += f"  db {_format_bytes(measured['db_bytes'])}"
+    return line
+
+
+def compare(base_path: str, new_path: str) -> int:
+    """Print throughput, peak RSS and DB size changes between two result files"""
+    with open(base_path, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    
+    print(f"base: {base['environment'].get('commit')}  new: {new['environment'].get('commit')}")
+    if base['corpus']['spec'] != new['corpus']['spec']:
+        print("⚠️  Different corpus specs - numbers are not comparable")
+    print(f"{'benchmark':<16} {'unit':<10} {'base':>14} {'new':>14} {'change':>8} {'rss':>8} {'db':>8}")
+    
+    def change(a, b) -> str:
+        if not a or b is None:
+            return '-'
+        return f"{(b / a - 1) * 100:+.1f}%"
+    
+    for name, old in base['results'].items():
+        current = new['results'].get(name)
+        if not current or 'throughput' not in old or 'throughput' not in current:
+            continue
+        print(
+            f"{name:<16} {old['unit']:<10} {old['throughput']:>14,.1f} {current['throughput']:>14,.1f} "
+            f"{change(old['throughput'], current['throughput']):>8} "
+            f"{change(old.get('peak_rss'), current.get('peak_rss')):>8} "
+            f"{change(old.get('db_bytes'), current.get('db_bytes')):>8}"
+        )
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='PDF indexer benchmarks')
+    parser.add_argument('--suite', choices=['micro', 'e2e', 'all'], default='all', help='Benchmarks to run (default: all)')
+    parser.add_argument('--only', help='Comma separated benchmark names')
+    parser.add_argument('--list', action='store_true', help='List the benchmarks')
+    parser.add_argument('--size', choices=list(SIZES), default='small', help='Corpus size (default: small)')
+    parser.add_argument('--seed', type=int, help='Corpus seed')
+    parser.add_argument('--corpus-dir', help='Generate the corpus here and reuse it (default: a temporary directory)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per micro benchmark, the best counts (default: 3)')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes of the end-to-end builds (default: 2)')
+    parser.add_argument('--mem-budget', default='256MB', help='Memory budget of the end-to-end builds (default: 256MB)')
+    parser.add_argument('--files-per-flush', type=int, default=5, help='Files per flush in the flush benchmarks (default: 5)')
+    parser.add_argument('--out', help='Results file (default: benchmarks/results/<commit>-<size>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two results files')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    parser.add_argument('--options', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    
+    if args.compare:
+        return compare(*args.compare)
+    
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one, args.corpus_dir, json.loads(args.options))))
+        return 0
+    
+    suites = _benchmarks()
+    if args.list:
+        for suite, benchmarks in suites.items():
+            for name, function in benchmarks.items():
+                print(f"{suite:<6} {name:<16} {function.__doc__}")
+        return 0
+    
+    names = [
+        name for suite, benchmarks in suites.items() if args.suite in (suite, 'all')
+        for name in benchmarks
+    ]
+    if args.only:
+        selected = [name.strip() for name in args.only.split(',')]
+        unknown = set(selected) - {name for benchmarks in suites.values() for name in benchmarks}
+        if unknown:
+            parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        names = [name for name in names if name in selected]
+    
+    options = {
+        'repeat': args.repeat,
+        'workers': args.workers,
+        'mem_budget': args.mem_budget,
+        'files_per_flush': args.files_per_flush
+    }
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        corpus_dir = os.path.abspath(args.corpus_dir or os.path.join(tmpdir, 'corpus'))
+        print(f"Generating {args.size} corpus in {corpus_dir}...")
+        manifest = generate_corpus(corpus_dir, make_spec(args.size, seed=args.seed))
+        print(
+            f"{len(manifest['files'])} files, {manifest['text_bytes'] / 1024 ** 2:.1f}MB of text, "
+            f"{sum(f['pages'] for f in manifest['files'] if f['kind'] == 'pdf')} PDF pages\n"
+        )
+        
+        results = {}
+        for name in names:
+            results[name] = run_isolated(name, corpus_dir, options)
+            print(format_result(name, results[name]))
+    
+    env = environment()
+    report = {
+        'format': RESULTS_FORMAT,
+        'environment': env,
+        'corpus': {'spec': manifest['spec'], 'text_bytes': manifest['text_bytes'], 'files': len(manifest['files'])},
+        'options': options,
+        'results': results
+    }
+    out = args.out
+    if not out:
+        label = f"{env['commit'] or 'nogit'}{'-dirty' if env['dirty'] else ''}-{args.size}"
+        out = os.path.join(RESULTS_DIR, f"{label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults: {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Synthetic Corpus - deterministic Hebrew/Aramaic books for benchmarks
+
+Words are drawn from a generated vocabulary with a Zipfian distribution
+(rank r has weight 1 / r^zipf), like real text: a few hundred function
+words make up half of all tokens, while the long tail keeps the number
+of distinct words growing with the corpus. The vocabulary mixes common
+Hebrew and Aramaic words, abbreviations with gershayim, prefixed forms
+and random roots with final letters; a fraction of the words carry nikud.
+
+Every file is generated from its own seed (corpus seed + file index), so
+a file's text doesn't depend on how many files are generated, and the
+same spec always produces byte-identical .txt files. PDFs are rendered
+with PyMuPDF from the same kind of text, one page per words_per_page
+words.
+
+Usage:
+    python -m benchmarks.corpus --out ../bench-corpus --size medium
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import logging
+from itertools import accumulate
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CORPUS_MANIFEST = "corpus.json"
+CORPUS_FORMAT = 1
+
+LETTERS = 'אבגדהוזחטיכלמנסעפצקרשת'
+FINALS = {'כ': 'ך', 'מ': 'ם', 'נ': 'ן', 'פ': 'ף', 'צ': 'ץ'}
+_REGULAR = {final: regular for regular, final in FINALS.items()}
+PREFIXES = ['ו', 'ה', 'ב', 'כ', 'ל', 'מ', 'ש', 'ד', 'וה', 'וב', 'של', 'מה', 'דה']
+SUFFIXES = ['', '', '', 'ים', 'ות', 'יה', 'ין', 'א', 'ו', 'ה', 'נו', 'הו', 'יהו', 'תא']
+
+# Vowel points and dagesh - the marks NIKUD_PATTERN removes
+VOWELS = ['ְ', 'ֱ', 'ֲ', 'ֳ', 'ִ', 'ֵ', 'ֶ', 'ַ', 'ָ', 'ֹ', 'ֻ']
+DAGESH = 'ּ'
+SHIN_DOTS = ['ׁ', 'ׂ']
+
+# The head of the distribution: Hebrew and Aramaic function words,
+# frequent nouns and abbreviations (with gershayim, split by the tokenizer)
+COMMON_WORDS = [
+    'של', 'על', 'את', 'לא', 'כי', 'אם', 'הוא', 'היא', 'זה', 'זו', 'אשר', 'כל', 'גם', 'או',
+    'אל', 'עם', 'בין', 'אין', 'יש', 'כן', 'אבל', 'רק', 'עוד', 'אף', 'כמו', 'לפי', 'מפני',
+    'אמר', 'רבי', 'רב', 'ואמר', 'שנאמר', 'דכתיב', 'דאמר', 'איתמר', 'תנן', 'תניא', 'מתניתין',
+    'גמרא', 'אלא', 'מאי', 'הכא', 'התם', 'ליה', 'להו', 'היכי', 'דילמא', 'איכא', 'ליכא',
+    'נמי', 'הוה', 'הוו', 'קא', 'דהא', 'משום', 'אמאי', 'תיובתא', 'קשיא', 'שמע', 'מינה',
+    'הלכה', 'דין', 'שבת', 'תורה', 'ישראל', 'משה', 'אברהם', 'ברכה', 'מצוה', 'מצות', 'עולם',
+    'ה\'', 'וכו\'', 'רש"י', 'תוס\'', 'רמב"ם', 'שו"ע', 'או"ח', 'יו"ד', 'ע"ב', 'ע"א', 'ז"ל',
+    'כנ"ל', 'עיי"ש', 'וז"ל', 'הקב"ה', 'ב"ה', 'א"כ', 'כ"ש', 'ד"ה', 'ס"ק', 'ח"א', 'ח"ב',
+]
+
+PUNCTUATION = ['.', '.', ',', ',', ',', ':', ';', '?']
+
+# Named sizes: files, words per file, pdf files, pages per pdf
+SIZES = {
+    'tiny': {'files': 4, 'words_per_file': 5000, 'pdf_files': 1, 'pdf_pages': 10},
+    'small': {'files': 20, 'words_per_file': 20000, 'pdf_files': 4, 'pdf_pages': 20},
+    'medium': {'files': 100, 'words_per_file': 50000, 'pdf_files': 20, 'pdf_pages': 50},
+    'large': {'files': 400, 'words_per_file': 100000, 'pdf_files': 50, 'pdf_pages': 200},
+}
+
+DEFAULT_SPEC = {
+    'seed': 1,
+    'vocabulary': 200000,  # distinct words to draw from
+    'zipf': 1.07,          # exponent of the rank-frequency distribution
+    'nikud': 0.2,          # fraction of vocabulary words written with nikud
+    'words_per_page': 350,
+    **SIZES['small']
+}
+
+
+def make_spec(size: str = 'small', **overrides) -> Dict:
+    """Corpus spec for a named size, with overrides (None = keep)"""
+    if size not in SIZES:
+        raise ValueError(f"Unknown corpus size: {size} (choose from {', '.join(SIZES)})")
+    spec = {**DEFAULT_SPEC, **SIZES[size], 'size': size}
+    spec.update({key: value for key, value in overrides.items() if value is not None})
+    return spec
+
+
+def _root(rng: random.Random) -> str:
+    length = rng.choices([2, 3, 4, 5, 6], weights=[10, 45, 30, 10, 5])[0]
+    word = ''.join(rng.choice(LETTERS) for _ in range(length))
+    return word[:-1] + FINALS.get(word[-1], word[-1])
+
+
+def _vocalize(word: str, rng: random.Random) -> str:
+    """Add nikud: a vowel under most letters, dagesh and shin dots sometimes"""
+    out = []
+    for letter in word:
+        out.append(letter)
+        if letter == 'ש':
+            out.append(rng.choice(SHIN_DOTS))
+        if letter in 'בכפתדג' and rng.random() < 0.3:
+            out.append(DAGESH)
+        if letter.isalpha() and rng.random() < 0.8:
+            out.append(rng.choice(VOWELS))
+    return ''.join(out)
+
+
+def build_vocabulary(size: int, nikud: float, seed: int) -> List[str]:
+    """
+    Vocabulary in rank order: COMMON_WORDS first, then generated words
+    
+    Generated words are a random root with a final letter, often with a
+    prefix and/or suffix, so the same root appears in several forms.
+    """
+    rng = random.Random(f"vocabulary:{seed}")
+    words = list(COMMON_WORDS[:size])
+    seen = set(words)
+    roots = [_root(rng) for _ in range(max(size // 4, 1))]
+    
+    while len(words) < size:
+        root = rng.choice(roots)
+        suffix = rng.choice(SUFFIXES) if rng.random() < 0.5 else ''
+        if suffix:
+            # The final letter is a regular one again before a suffix
+            root = root[:-1] + _REGULAR.get(root[-1], root[-1]) + suffix
+        if rng.random() < 0.4:
+            root = rng.choice(PREFIXES) + root
+        if rng.random() < nikud:
+            root = _vocalize(root, rng)
+        if root not in seen:
+            seen.add(root)
+            words.append(root)
+    
+    return words
+
+
+class TextGenerator:
+    """Zipfian sentences over a vocabulary (see build_vocabulary)"""
+    
+    def __init__(self, spec: Dict):
+        self.vocabulary = build_vocabulary(spec['vocabulary'], spec['nikud'], spec['seed'])
+        self.cum_weights = list(accumulate(
+            1.0 / rank ** spec['zipf'] for rank in range(1, len(self.vocabulary) + 1)
+        ))
+        self.seed = spec['seed']
+    
+    def words(self, count: int, rng: random.Random) -> List[str]:
+        return rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+    
+    def paragraphs(self, count: int, rng: random.Random) -> List[str]:
+        """
+        count words as paragraphs of sentences - punctuation, numbers and
+        an occasional Latin word, like scanned books have
+        """
+        words = self.words(count, rng)
+        paragraphs = []
+        sentence = []
+        paragraph = []
+        next_sentence = rng.randint(5, 25)
+        next_paragraph = rng.randint(3, 8)
+        
+        for word in words:
+            if rng.random() < 0.01:
+                sentence.append(str(rng.randint(1, 500)))
+            elif rng.random() < 0.002:
+                sentence.append(rng.choice(['ibid', 'Vilna', 'Warsaw', 'p.']))
+            sentence.append(word)
+            if len(sentence) >= next_sentence:
+                paragraph.append(' '.join(sentence) + rng.choice(PUNCTUATION))
+                sentence = []
+                next_sentence = rng.randint(5, 25)
+                if len(paragraph) >= next_paragraph:
+                    paragraphs.append(' '.join(paragraph))
+                    paragraph = []
+                    next_paragraph = rng.randint(3, 8)
+        
+        if sentence:
+            paragraph.append(' '.join(sentence) + '.')
+        if paragraph:
+            paragraphs.append(' '.join(paragraph))
+        return paragraphs
+    
+    def text(self, count: int, rng: random.Random) -> str:
+        return '\n\n'.join(self.paragraphs(count, rng))
+    
+    def file_rng(self, kind: str, index: int) -> random.Random:
+        """Independent RNG per file - a file doesn't depend on the others"""
+        return random.Random(f"{kind}:{self.seed}:{index}")
+
+
+def write_pdf(path: str, pages: List[str]):
+    """Render page texts right-to-left into a PDF (MuPDF's built-in fonts
+    cover Hebrew and nikud)"""
+    import fitz  # PyMuPDF
+    
+    doc = fitz.open()
+    try:
+        for text in pages:
+            page = doc.new_page(width=420, height=595)
+            html = ''.join(f'<p dir="rtl">{paragraph}</p>' for paragraph in text.split('\n\n'))
+            page.insert_htmlbox(page.rect + (36, 36, -36, -36), html, css='* {font-size: 9px;}')
+        doc.save(path, garbage=3, deflate=True)
+    finally:
+        doc.close()
+
+
+def generate_corpus(out_dir: str, spec: Dict) -> Dict:
+    """
+    Write a corpus to out_dir (reused if out_dir already has the same spec)
+    
+    Returns:
+        Manifest: {'format', 'spec', 'files': [{'path', 'kind', 'words',
+        'pages', 'bytes'}], 'text_bytes'}
+    """
+    manifest = load_corpus(out_dir)
+    if manifest and manifest['spec'] == spec:
+        return manifest
+    
+    os.makedirs(out_dir, exist_ok=True)
+    generator = TextGenerator(spec)
+    files = []
+    
+    for index in range(spec['files']):
+        rng = generator.file_rng('txt', index)
+        text = generator.text(spec['words_per_file'], rng)
+        path = os.path.join(out_dir, f"book_{index:04d}.txt")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        files.append({
+            'path': os.path.basename(path), 'kind': 'txt',
+            'words': spec['words_per_file'], 'pages': 1, 'bytes': os.path.getsize(path)
+        })
+    
+    for index in range(spec['pdf_files']):
+        rng = generator.file_rng('pdf', index)
+        pages = [generator.text(spec['words_per_page'], rng) for _ in range(spec['pdf_pages'])]
+        path = os.path.join(out_dir, f"scan_{index:04d}.pdf")
+        write_pdf(path, pages)
+        files.append({
+            'path': os.path.basename(path), 'kind': 'pdf',
+            'words': spec['words_per_page'] * spec['pdf_pages'], 'pages': spec['pdf_pages'],
+            'bytes': os.path.getsize(path)
+        })
+    
+    manifest = {
+        'format': CORPUS_FORMAT,
+        'spec': spec,
+        'files': files,
+        'text_bytes': sum(f['bytes'] for f in files if f['kind'] == 'txt')
+    }
+    with open(os.path.join(out_dir, CORPUS_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    
+    logger.info(f"Generated {len(files)} files in {out_dir}")
+    return manifest
+
+
+def load_corpus(out_dir: str) -> Optional[Dict]:
+    """Manifest of a generated corpus (None if there is none)"""
+    try:
+        with open(os.path.join(out_dir, CORPUS_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return manifest if manifest.get('format') == CORPUS_FORMAT else None
+
+
+def corpus_files(out_dir: str, manifest: Dict, kind: Optional[str] = None) -> List[str]:
+    """Paths of the corpus files (of one kind)"""
+    return [
+        os.path.join(out_dir, f['path'])
+        for f in manifest['files'] if kind is None or f['kind'] == kind
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Hebrew/Aramaic corpus')
+    parser.add_argument('--out', required=True, help='Output directory')
+    parser.add_argument('--size', default='small', choices=list(SIZES), help='Corpus size (default: small)')
+    parser.add_argument('--seed', type=int, help=f"Random seed (default: {DEFAULT_SPEC['seed']})")
+    parser.add_argument('--files', type=int, help='Text files')
+    parser.add_argument('--words-per-file', type=int, help='Words per text file')
+    parser.add_argument('--pdf-files', type=int, help='PDF files')
+    parser.add_argument('--pdf-pages', type=int, help='Pages per PDF')
+    parser.add_argument('--vocabulary', type=int, help='Distinct words')
+    parser.add_argument('--zipf', type=float, help='Zipf exponent')
+    parser.add_argument('--nikud', type=float, help='Fraction of words with nikud')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    spec = make_spec(
+        args.size, seed=args.seed, files=args.files, words_per_file=args.words_per_file,
+        pdf_files=args.pdf_files, pdf_pages=args.pdf_pages, vocabulary=args.vocabulary,
+        zipf=args.zipf, nikud=args.nikud
+    )
+    manifest = generate_corpus(args.out, spec)
+    print(f"{len(manifest['files'])} files, {manifest['text_bytes'] / 1024 ** 2:.1f}MB of text in {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""
+End-to-end benchmarks - a full build of the synthetic corpus
+
+The build runs the same steps as build_index.py (pipeline, final merge,
+VACUUM in merge mode) into a temporary output directory. Throughput is
+input MB/s; the result also has files/s, the index size on disk and the
+number of flushes.
+"""
+import os
+import time
+import tempfile
+from typing import Callable, Dict
+
+from benchmarks.corpus import corpus_files
+from benchmarks.measure import dir_size, result
+from checkpoint_manager import CheckpointManager
+from file_scanner import iter_pending
+from index_builder import IndexBuilder
+from pipeline import IndexingPipeline
+from config import CHECKPOINT_FILE
+
+
+def run_build(corpus_dir: str, manifest: Dict, output_dir: str, options: Dict, build_mode: str) -> Dict:
+    """Index every corpus file into output_dir, return the build's numbers"""
+    files = corpus_files(corpus_dir, manifest)
+    builder = IndexBuilder(output_dir, build_mode=build_mode, shards=options.get('shards', 0))
+    checkpoint = CheckpointManager(os.path.join(output_dir, CHECKPOINT_FILE), builder.db)
+    
+    try:
+        started = time.perf_counter()
+        pipeline = IndexingPipeline(
+            builder, checkpoint,
+            workers=options['workers'],
+            mem_budget=options['mem_budget']
+        )
+        errors = sum(
+            1 for item in pipeline.run(iter_pending(files, checkpoint, {'found': 0, 'skipped': 0}))
+            if item['error']
+        )
+        if builder.pending_runs():
+            builder.merge_runs()
+        checkpoint.mark_completed()
+        if build_mode == 'merge':
+            builder.vacuum()
+        seconds = time.perf_counter() - started
+        
+        stats = builder.get_stats()
+        return {
+            'seconds': seconds,
+            'files': len(files),
+            'errors': errors,
+            'flushes': pipeline.flush_count,
+            'unique_words': stats['unique_words'],
+            'chunks': stats['total_chunks']
+        }
+    finally:
+        builder.close()
+
+
+def _bench_build(corpus_dir: str, manifest: Dict, options: Dict, build_mode: str) -> Dict:
+    input_mb = sum(f['bytes'] for f in manifest['files']) / 1024 ** 2
+    
+    with tempfile.TemporaryDirectory() as output_dir:
+        build = run_build(corpus_dir, manifest, output_dir, options, build_mode)
+        db_bytes = dir_size(output_dir)
+        chunks_bytes = dir_size(output_dir, suffixes=('.jsonl',))
+    
+    seconds = build.pop('seconds')
+    return result(
+        seconds, input_mb, 'MB/s',
+        files_per_second=build['files'] / seconds,
+        db_bytes=db_bytes,
+        chunks_bytes=chunks_bytes,
+        workers=options['workers'],
+        **build
+    )
+
+
+def bench_build_merge(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """Full build, merge build mode - input MB/s"""
+    return _bench_build(corpus_dir, manifest, options, 'merge')
+
+
+def bench_build_runs(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """Full build, runs build mode - input MB/s"""
+    return _bench_build(corpus_dir, manifest, options, 'runs')
+
+
+END_TO_END_BENCHMARKS: Dict[str, Callable[[str, Dict, Dict], Dict]] = {
+    'build_merge': bench_build_merge,
+    'build_runs': bench_build_runs,
+}
@@ -0,0 +1,61 @@
+"""
+Measurement helpers shared by the benchmarks
+"""
+import os
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss() -> Dict[str, Optional[int]]:
+    """
+    Peak resident set size in bytes of this process and of its largest
+    waited-for child (worker pools, shard processes) - None where the
+    platform doesn't report it
+    """
+    if resource is None:
+        return {'peak_rss': None, 'peak_rss_children': None}
+    
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'peak_rss_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    }
+
+
+def best_of(repeat: int, run: Callable[[], None], setup: Optional[Callable[[], None]] = None) -> float:
+    """Fastest of repeat runs in seconds (setup runs untimed before each)"""
+    best = float('inf')
+    for _ in range(max(repeat, 1)):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def dir_size(path: str, suffixes=('.db', '.db-wal')) -> int:
+    """Total size of the files under path ending in one of suffixes"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(suffixes):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def result(seconds: float, amount: float, unit: str, **extra) -> Dict:
+    """Benchmark result: throughput = amount / seconds, in unit"""
+    return {
+        'seconds': seconds,
+        'throughput': amount / seconds if seconds > 0 else None,
+        'unit': unit,
+        **extra
+    }
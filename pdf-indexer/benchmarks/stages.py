@@ -0,0 +1,338 @@
+"""
+Micro benchmarks - one indexing stage each, on the synthetic corpus
+
+Every benchmark takes (corpus_dir, manifest, options) and returns a
+result dict (see measure.result): the best of options['repeat'] runs,
+throughput in its unit plus benchmark specific numbers.
+"""
+import json
+import pickle
+import tempfile
+import tracemalloc
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import regex
+
+from benchmarks.corpus import corpus_files
+from benchmarks.measure import best_of, dir_size, result
+from index_builder import (
+    IndexBuilder, build_chunks_and_postings, encode_postings, decode_postings_payload
+)
+from pdf_extractor import PDFExtractor
+from postings_accumulator import PostingsAccumulator
+from text_processor import tokenize_with_offsets
+from config import MIN_WORD_LENGTH, NIKUD_PATTERN
+
+
+def _read_texts(corpus_dir: str, manifest: Dict) -> List[str]:
+    texts = []
+    for path in corpus_files(corpus_dir, manifest, 'txt'):
+        with open(path, 'r', encoding='utf-8') as f:
+            texts.append(f.read())
+    return texts
+
+
+def _megabytes(texts: List[str]) -> float:
+    return sum(len(text.encode('utf-8')) for text in texts) / 1024 ** 2
+
+
+def bench_tokenize(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """text_processor.tokenize_with_offsets - MB/s of UTF-8 text"""
+    texts = _read_texts(corpus_dir, manifest)
+    tokens = sum(len(tokenize_with_offsets(text)) for text in texts)
+    
+    seconds = best_of(options['repeat'], lambda: [tokenize_with_offsets(text) for text in texts])
+    return result(seconds, _megabytes(texts), 'MB/s', tokens=tokens, tokens_per_second=tokens / seconds)
+
+
+def legacy_tokenize(text: str) -> List[Tuple[str, int, int]]:
+    """The original tokenizer: pattern looked up on every call, nikud
+    stripped and lowercased token by token - the baseline of tokenize"""
+    tokens = []
+    pattern = regex.compile(r'[\p{L}\p{N}]+', regex.UNICODE)
+    for match in pattern.finditer(text):
+        raw_token = match.group(0)
+        cleaned = regex.sub(NIKUD_PATTERN, '', raw_token).lower()
+        if len(cleaned) >= MIN_WORD_LENGTH:
+            tokens.append((cleaned, match.start(), len(raw_token)))
+    return tokens
+
+
+def bench_tokenize_legacy(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """Per-token tokenizer (see legacy_tokenize) - MB/s of UTF-8 text"""
+    texts = _read_texts(corpus_dir, manifest)
+    tokens = sum(len(legacy_tokenize(text)) for text in texts)
+    
+    seconds = best_of(options['repeat'], lambda: [legacy_tokenize(text) for text in texts])
+    return result(seconds, _megabytes(texts), 'MB/s', tokens=tokens, tokens_per_second=tokens / seconds)
+
+
+def bench_chunks_postings(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """build_chunks_and_postings (clean + chunk + tokenize) - MB/s"""
+    texts = _read_texts(corpus_dir, manifest)
+    
+    def run():
+        for doc_id, text in enumerate(texts, 1):
+            build_chunks_and_postings(doc_id, text, [])
+    
+    seconds = best_of(options['repeat'], run)
+    return result(seconds, _megabytes(texts), 'MB/s', files=len(texts))
+
+
+def _file_postings(corpus_dir: str, manifest: Dict) -> List[Dict[str, List[int]]]:
+    """{word: offsets} of every text file"""
+    return [
+        build_chunks_and_postings(doc_id, text, [])[1]
+        for doc_id, text in enumerate(_read_texts(corpus_dir, manifest), 1)
+    ]
+
+
+def _offset_lists(corpus_dir: str, manifest: Dict) -> List[List[int]]:
+    return [offsets for postings in _file_postings(corpus_dir, manifest) for offsets in postings.values()]
+
+
+def _traced_bytes(build: Callable[[], object]) -> int:
+    """Python memory held by what build() returns"""
+    tracemalloc.start()
+    try:
+        kept = build()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        del kept
+        tracemalloc.stop()
+
+
+def bench_accumulate(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """PostingsAccumulator.add of every file's postings - offsets/s, bytes/offset"""
+    file_postings = _file_postings(corpus_dir, manifest)
+    offsets = sum(len(values) for postings in file_postings for values in postings.values())
+    
+    # Memory is measured on unpickled postings, as they arrive from the
+    # worker processes - so every file brings its own word strings
+    pickled = [pickle.dumps(postings) for postings in file_postings]
+    
+    def accumulate(inputs: Iterable):
+        accumulator = PostingsAccumulator()
+        for doc_id, postings in enumerate(inputs, 1):
+            accumulator.add(doc_id, postings)
+        return accumulator
+    
+    def plain_map():
+        # The {word: {doc_id: [offsets]}} map the accumulator replaced
+        postings_map = {}
+        for doc_id, postings in enumerate(map(pickle.loads, pickled), 1):
+            for word, values in postings.items():
+                postings_map.setdefault(word, {})[doc_id] = list(values)
+        return postings_map
+    
+    seconds = best_of(options['repeat'], lambda: accumulate(file_postings))
+    accumulated = _traced_bytes(lambda: accumulate(map(pickle.loads, pickled)))
+    return result(
+        seconds, offsets, 'offsets/s',
+        offsets=offsets,
+        bytes_per_offset=accumulated / offsets,
+        plain_map_bytes_per_offset=_traced_bytes(plain_map) / offsets,
+        estimate_error=accumulate(map(pickle.loads, pickled)).nbytes / accumulated - 1
+    )
+
+
+def bench_delta_encode(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """IndexBuilder._delta_encode / _delta_decode - offsets/s"""
+    lists = _offset_lists(corpus_dir, manifest)
+    offsets = sum(len(values) for values in lists)
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        builder = IndexBuilder(tmpdir, shards=0)
+        try:
+            encoded = [builder._delta_encode(values) for values in lists]
+            seconds = best_of(options['repeat'], lambda: [builder._delta_encode(values) for values in lists])
+            decode_seconds = best_of(options['repeat'], lambda: [builder._delta_decode(values) for values in encoded])
+        finally:
+            builder.close()
+    
+    return result(seconds, offsets, 'offsets/s', offsets=offsets, decode_per_second=offsets / decode_seconds)
+
+
+def _doc_postings(corpus_dir: str, manifest: Dict) -> List[Dict[int, List[int]]]:
+    """{doc_id: offsets} per word - postings as a flush stores them"""
+    by_word = {}
+    for doc_id, postings in enumerate(_file_postings(corpus_dir, manifest), 1):
+        for word, offsets in postings.items():
+            by_word.setdefault(word, {})[doc_id] = offsets
+    return list(by_word.values())
+
+
+def bench_encode_postings(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """encode_postings (postings format 3) - offsets/s"""
+    postings = _doc_postings(corpus_dir, manifest)
+    offsets = sum(len(values) for docs in postings for values in docs.values())
+    payloads = [encode_postings(docs) for docs in postings]
+    
+    seconds = best_of(options['repeat'], lambda: [encode_postings(docs) for docs in postings])
+    return result(
+        seconds, offsets, 'offsets/s',
+        words=len(postings), offsets=offsets,
+        bytes_per_offset=sum(map(len, payloads)) / offsets
+    )
+
+
+def bench_decode_postings(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """decode_postings_payload (postings format 3) - offsets/s"""
+    postings = _doc_postings(corpus_dir, manifest)
+    offsets = sum(len(values) for docs in postings for values in docs.values())
+    payloads = [encode_postings(docs) for docs in postings]
+    
+    seconds = best_of(options['repeat'], lambda: [decode_postings_payload(payload) for payload in payloads])
+    return result(seconds, offsets, 'offsets/s', words=len(postings), offsets=offsets)
+
+
+def _flush_batches(corpus_dir: str, manifest: Dict, files_per_flush: int) -> List[PostingsAccumulator]:
+    """Flush batches of files_per_flush files each, as the pipeline hands them over"""
+    batches = []
+    for doc_id, postings in enumerate(_file_postings(corpus_dir, manifest), 1):
+        if (doc_id - 1) % files_per_flush == 0:
+            batches.append(PostingsAccumulator())
+        batches[-1].add(doc_id, postings)
+    return batches
+
+
+def legacy_flush(builder: IndexBuilder, postings_map: PostingsAccumulator):
+    """
+    The original flush: one SELECT + INSERT per word, JSON postings,
+    default journaling - the baseline the bulk merge replaced
+    
+    Stored postings are merged as the original did. Like the original it
+    writes posts only - no forward index, word sequences or page tables,
+    which flush_postings() writes too. The gematria and variants tables are
+    timed on their own (word_tables).
+    """
+    cursor = builder.db.cursor()
+    
+    for word, file_postings in postings_map.items():
+        cursor.execute("SELECT postings FROM posts WHERE word = ?", (word,))
+        row = cursor.fetchone()
+        
+        if row:
+            existing = json.loads(builder._decompress(row[0]))
+            for file_id, offsets in file_postings.items():
+                file_id = str(file_id)
+                if file_id in existing:
+                    existing[file_id].extend(offsets)
+                    existing[file_id].sort()
+                    existing[file_id] = builder._delta_encode(existing[file_id])
+                else:
+                    existing[file_id] = builder._delta_encode(sorted(offsets))
+            merged = existing
+        else:
+            merged = {
+                str(file_id): builder._delta_encode(sorted(offsets))
+                for file_id, offsets in file_postings.items()
+            }
+        
+        cursor.execute(
+            "INSERT OR REPLACE INTO posts (word, postings) VALUES (?, ?)",
+            (word, builder._compress(json.dumps(merged, ensure_ascii=False)))
+        )
+    
+    builder.db.commit()
+
+
+def _bench_flush(corpus_dir: str, manifest: Dict, options: Dict, build_mode: str, legacy: bool = False) -> Dict:
+    batches = _flush_batches(corpus_dir, manifest, options['files_per_flush'])
+    words = sum(len(batch) for batch in batches)
+    sizes = []
+    
+    def run():
+        with tempfile.TemporaryDirectory() as tmpdir:
+            builder = IndexBuilder(tmpdir, build_mode=build_mode, shards=0)
+            try:
+                if legacy:
+                    builder.db.execute("PRAGMA journal_mode=DELETE")
+                    builder.db.execute("PRAGMA synchronous=FULL")
+                    builder.db.execute("CREATE INDEX IF NOT EXISTS idx_word ON posts(word)")
+                for postings_map in batches:
+                    if legacy:
+                        legacy_flush(builder, postings_map)
+                    else:
+                        builder.flush_postings(postings_map)
+                if build_mode == 'runs':
+                    builder.merge_runs()
+            finally:
+                builder.close()
+            sizes.append(dir_size(tmpdir))
+    
+    seconds = best_of(options['repeat'], run)
+    return result(seconds, words, 'words/s', flushes=len(batches), db_bytes=sizes[-1])
+
+
+def bench_flush(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """IndexBuilder.flush_postings, merge build mode - words/s"""
+    return _bench_flush(corpus_dir, manifest, options, 'merge')
+
+
+def bench_flush_runs(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """flush_postings + merge_runs, runs build mode - words/s"""
+    return _bench_flush(corpus_dir, manifest, options, 'runs')
+
+
+def bench_flush_legacy(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """Row-by-row JSON flush of posts only (see legacy_flush) - words/s"""
+    return _bench_flush(corpus_dir, manifest, options, 'merge', legacy=True)
+
+
+def bench_word_tables(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """IndexBuilder.update_word_tables on a freshly built index - words/s"""
+    batches = _flush_batches(corpus_dir, manifest, options['files_per_flush'])
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        builder = IndexBuilder(tmpdir, build_mode='merge', shards=0)
+        try:
+            for postings_map in batches:
+                builder.flush_postings(postings_map)
+            words = builder.count_words()
+            
+            def clear():
+                with builder.db:
+                    for table in ('gematria', 'variants', 'lexicon'):
+                        builder.db.execute(f"DELETE FROM {table}")
+            
+            seconds = best_of(options['repeat'], builder.update_word_tables, setup=clear)
+        finally:
+            builder.close()
+    
+    return result(seconds, words, 'words/s')
+
+
+def bench_extract(corpus_dir: str, manifest: Dict, options: Dict) -> Dict:
+    """PDFExtractor.iter_pages (PyMuPDF, no cache) - pages/s"""
+    paths = corpus_files(corpus_dir, manifest, 'pdf')
+    if not paths:
+        return {'skipped': 'corpus has no PDFs'}
+    
+    extractor = PDFExtractor()
+    extracted = []
+    
+    def run():
+        extracted[:] = [
+            len(page['text'].encode('utf-8'))
+            for path in paths for page in extractor.iter_pages(path)
+        ]
+    
+    seconds = best_of(options['repeat'], run)
+    return result(seconds, len(extracted), 'pages/s', files=len(paths), mb_per_second=sum(extracted) / 1024 ** 2 / seconds)
+
+
+MICRO_BENCHMARKS: Dict[str, Callable[[str, Dict, Dict], Dict]] = {
+    'tokenize': bench_tokenize,
+    'tokenize_legacy': bench_tokenize_legacy,
+    'chunks_postings': bench_chunks_postings,
+    'accumulate': bench_accumulate,
+    'delta_encode': bench_delta_encode,
+    'encode_postings': bench_encode_postings,
+    'decode_postings': bench_decode_postings,
+    'flush': bench_flush,
+    'flush_runs': bench_flush_runs,
+    'flush_legacy': bench_flush_legacy,
+    'word_tables': bench_word_tables,
+    'extract': bench_extract,
+}
@@ -8,18 +8,22 @@ import sys
 import argparse
 import logging
 import time
-from pathlib import Path
-from typing import List
+from itertools import islice
+from typing import Dict
 from tqdm import tqdm
 
-from pdf_extractor import PDFExtractor
-from text_processor import clean_text
 from index_builder import IndexBuilder
+from file_scanner import iter_files, iter_pending
+from pipeline import IndexingPipeline, parse_size, format_size
 from checkpoint_manager import CheckpointManager
 from meili_uploader import MeiliUploader
+from extract_cache import ExtractCache
+from pdf_extractor import EXTRACTOR_VERSION
+from text_processor import TOKENIZER
 from config import (
-    CHUNK_SIZE, FLUSH_EVERY, SUPPORTED_EXTENSIONS,
-    CHECKPOINT_FILE, LOG_FILE, LOG_LEVEL
+    CHUNK_SIZE, FLUSH_EVERY, FLUSH_INTERVAL, MAX_WORKERS, PIPELINE_QUEUE_SIZE, SUPPORTED_EXTENSIONS,
+    CHECKPOINT_FILE, LOG_FILE, LOG_LEVEL, BUILD_MODE, MEM_BUDGET, CONTENT_HASH, SHARDS,
+    EXTRACT_CACHE_DIR, EXTRACT_CACHE_SIZE, MERGE_FACTOR
 )
 
 
@@ -37,64 +41,11 @@ def setup_logging(verbose: bool = False):
     )
 
 
-def find_files(books_dir: str, skip_pdf: bool = False) -> List[str]:
-    """Find all supported files recursively"""
-    extensions = ['.txt'] if skip_pdf else SUPPORTED_EXTENSIONS
-    files = []
-    
-    for ext in extensions:
-        files.extend(Path(books_dir).rglob(f'*{ext}'))
-    
-    return [str(f) for f in sorted(files)]
-
-
-def process_file(
-    file_path: str,
-    builder: IndexBuilder,
-    extractor: PDFExtractor,
-    postings_map: dict
-) -> tuple:
-    """
-    Process a single file
-    
-    Returns:
-        (chunks_count, words_count, success)
-    """
-    filename = os.path.basename(file_path)
-    file_id = filename.rsplit('.', 1)[0]
-    
-    try:
-        # Extract text
-        if file_path.lower().endswith('.pdf'):
-            result = extractor.extract_text(file_path)
-            text = result['text']
-            pages = result['pages']
-        else:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-            pages = [{'page_num': 1, 'start_offset': 0, 'end_offset': len(text)}]
-        
-        if not text or len(text) < 10:
-            logging.warning(f"File too short or empty: {filename}")
-            return 0, 0, False
-        
-        # Build chunks and postings
-        chunks, postings = builder.build_chunks_and_postings(file_id, text, pages)
-        
-        # Append chunks to file
-        builder.append_chunks(chunks)
-        
-        # Merge postings into map
-        for word, offsets in postings.items():
-            if word not in postings_map:
-                postings_map[word] = {}
-            postings_map[word][file_id] = offsets
-        
-        return len(chunks), len(postings), True
-        
-    except Exception as e:
-        logging.error(f"Failed to process {filename}: {e}")
-        return 0, 0, False
+def update_progress(pbar: tqdm, scan: Dict, done: int):
+    """Progress bar total grows while the directory walk is still going"""
+    pbar.total = scan['found']
+    pbar.n = scan['skipped'] + done
+    pbar.refresh()
 
 
 def main():
@@ -125,7 +76,65 @@ def main():
         '--flush-every',
         type=int,
         default=FLUSH_EVERY,
-        help=f'Flush to DB every N files (default: {FLUSH_EVERY})'
+        help=f'Also flush to DB every N files, 0 = memory budget only (default: {FLUSH_EVERY})'
+    )
+    
+    parser.add_argument(
+        '--flush-interval',
+        type=float,
+        default=FLUSH_INTERVAL,
+        metavar='SECONDS',
+        help='Also flush every N seconds, so a runs build makes new files searchable '
+             f'within about that time, 0 = off (default: {FLUSH_INTERVAL})'
+    )
+    
+    parser.add_argument(
+        '--mem-budget',
+        type=parse_size,
+        default=MEM_BUDGET,
+        help=f'Flush when the in-memory postings reach this size, e.g. 512MB (default: {MEM_BUDGET}). '
+             'A batch is filled while one waits and one is flushed, so peak postings memory is '
+             'about 3x this'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=MAX_WORKERS,
+        help=f'Worker processes for extraction/tokenization, 1 = serial (default: {MAX_WORKERS})'
+    )
+    
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=PIPELINE_QUEUE_SIZE,
+        help=f'Analyzed files buffered ahead of the writer (default: {PIPELINE_QUEUE_SIZE})'
+    )
+    
+    parser.add_argument(
+        '--build-mode',
+        choices=['merge', 'runs'],
+        default=BUILD_MODE,
+        help='merge = merge every flush into the DB, runs = write sorted runs '
+             '(searchable as soon as they are committed) and merge them once '
+             f'at the end (default: {BUILD_MODE})'
+    )
+    
+    parser.add_argument(
+        '--merge-factor',
+        type=int,
+        default=MERGE_FACTOR,
+        help='runs build mode: merge every N runs of the same size in the '
+             f'background while building, 0 = off (default: {MERGE_FACTOR})'
+    )
+    
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=None,
+        help='Partition the postings by word hash into N shard DBs, each written '
+             f'by its own process (default: the index\'s layout, else {SHARDS}; '
+             'changing it needs --reset)'
     )
     
     parser.add_argument(
@@ -147,6 +156,42 @@ def main():
         help='Reset checkpoint and start from scratch'
     )
     
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Re-index only new and changed files and remove deleted ones '
+             '(compared by size and mtime)'
+    )
+    
+    parser.add_argument(
+        '--hash',
+        action='store_true',
+        default=CONTENT_HASH,
+        help='Also record content hashes, so files that were only touched '
+             f'are not re-indexed by --incremental (default: {CONTENT_HASH})'
+    )
+    parser.add_argument(
+        '--no-hash',
+        dest='hash',
+        action='store_false',
+        help="Don't record content hashes, even with CONTENT_HASH = True"
+    )
+    
+    parser.add_argument(
+        '--extract-cache',
+        default=EXTRACT_CACHE_DIR,
+        metavar='DIR',
+        help='Keep extracted PDF page texts in DIR, keyed by file content, '
+             'so re-runs skip PDF parsing (default: off)'
+    )
+    
+    parser.add_argument(
+        '--extract-cache-size',
+        type=parse_size,
+        default=EXTRACT_CACHE_SIZE,
+        help=f'Size limit of the extraction cache, e.g. 10GB (default: {EXTRACT_CACHE_SIZE})'
+    )
+    
     parser.add_argument(
         '--upload-meili',
         action='store_true',
@@ -182,7 +227,17 @@ def main():
     print(f"📂 Books directory: {args.books_dir}")
     print(f"💾 Output directory: {args.output_dir}")
     print(f"📏 Chunk size: {args.chunk_size}")
-    print(f"💾 Flush every: {args.flush_every} files")
+    print(f"💾 Memory budget: {format_size(args.mem_budget)}")
+    if args.flush_every:
+        print(f"💾 Flush every: {args.flush_every} files")
+    if args.flush_interval:
+        print(f"💾 Flush interval: {args.flush_interval:g}s")
+    print(f"⚙️  Workers: {args.workers}")
+    print(f"🧱 Build mode: {args.build_mode}")
+    if args.incremental:
+        print(f"🔁 Incremental: YES{' (content hash)' if args.hash else ''}")
+    if args.extract_cache:
+        print(f"🗃️  Extraction cache: {args.extract_cache} ({format_size(args.extract_cache_size)})")
     print(f"📄 Skip PDF: {'YES' if args.skip_pdf else 'NO'}")
     print(f"🔄 Upload to Meili: {'YES' if args.upload_meili else 'NO'}")
     print()
@@ -190,46 +245,96 @@ def main():
     # Create output directory
     os.makedirs(args.output_dir, exist_ok=True)
     
-    # Find files
-    logger.info("Scanning for files...")
-    files = find_files(args.books_dir, args.skip_pdf)
+    if args.incremental and args.max_files:
+        # Every file missing from the list would count as deleted
+        print("❌ --incremental can't be combined with --max-files")
+        return 1
     
-    if args.max_files and len(files) > args.max_files:
-        logger.warning(f"Limiting to first {args.max_files} files for testing")
-        files = files[:args.max_files]
+    if not os.path.isdir(args.books_dir):
+        print(f"❌ Books directory not found: {args.books_dir}")
+        return 1
     
-    print(f"📋 Found {len(files)} files\n")
+    # Files are streamed from the directory walk into the pipeline
+    extensions = ['.txt'] if args.skip_pdf else SUPPORTED_EXTENSIONS
+    files = iter_files(args.books_dir, extensions)
     
-    if not files:
-        print("❌ No files found!")
-        return 1
+    if args.max_files:
+        logger.warning(f"Limiting to first {args.max_files} files for testing")
+        files = islice(files, args.max_files)
     
-    # Initialize components
+    # Initialize components - the checkpoint lives in posmap.db
+    builder = IndexBuilder(
+        args.output_dir, chunk_size=args.chunk_size, build_mode=args.build_mode,
+        content_hash=args.hash, shards=args.shards, merge_factor=args.merge_factor
+    )
     checkpoint_path = os.path.join(args.output_dir, CHECKPOINT_FILE)
-    checkpoint = CheckpointManager(checkpoint_path)
+    checkpoint = CheckpointManager(checkpoint_path, builder.db)
     
     if args.reset:
-        logger.info("Resetting checkpoint...")
+        logger.info("Resetting index and checkpoint...")
+        builder.reset()
         checkpoint.reset()
+    else:
+        # Chunks/runs of files whose flush never committed (crash, kill -9)
+        builder.discard_uncommitted()
+    
+    # Words of another tokenizer would not be found by the current one
+    if builder.tokenizer != TOKENIZER:
+        print(f"❌ Index was built with tokenizer {builder.tokenizer}, this version uses {TOKENIZER}")
+        print(f"💡 Use --reset to rebuild it")
+        builder.close()
+        return 1
     
-    # Check if already completed
-    progress = checkpoint.get_progress(len(files))
-    if progress['completed'] and progress['remaining'] == 0:
-        print("✅ Indexing already completed!")
-        print(f"💡 Use --reset to rebuild from scratch")
-        return 0
-    
+    if builder.shards:
+        print(f"🧩 Shards: {builder.shards.shard_count} (one writer process each)\n")
+    
+    # Changed and deleted files are removed from the index and the
+    # checkpoint; new and changed files are then processed like any
+    # unprocessed file
+    removed_doc_ids = []
+    if args.incremental:
+        # Deleted files are only known after the whole walk
+        print("🔍 Comparing files with the index...")
+        files = list(files)
+        new, changed, deleted = builder.diff_files(files)
+        print(f"   New: {len(new)}  Changed: {len(changed)}  Deleted: {len(deleted)}\n")
+        
+        # Checkpoints of older versions list file names - turn them into
+        # paths, so only the exact stale files are unmarked below
+        checkpoint.resolve_legacy(files)
+        
+        stale = changed + deleted
+        if stale:
+            removed_doc_ids = list(builder.get_doc_ids(stale).values())
+            builder.remove_documents(removed_doc_ids)
+            builder.unregister_files(builder.get_doc_ids(deleted).values())
+        # A new file has no postings yet, whatever a legacy entry of its name says
+        checkpoint.unmark_processed(stale + [path for path in new if checkpoint.is_processed(path)])
+    
+    progress = checkpoint.get_progress(0)
     if progress['processed'] > 0:
         print(f"📍 Resuming from checkpoint:")
-        print(f"   Already processed: {progress['processed']} files")
-        print(f"   Remaining: {progress['remaining']} files")
-        print(f"   Progress: {progress['percentage']:.1f}%\n")
+        print(f"   Already processed: {progress['processed']} files\n")
     
-    builder = IndexBuilder(args.output_dir)
-    extractor = PDFExtractor()
+    extract_cache = None
+    if args.extract_cache:
+        extract_cache = ExtractCache(args.extract_cache, args.extract_cache_size, EXTRACTOR_VERSION)
     
     # Process files
-    postings_map = {}
+    pipeline = IndexingPipeline(
+        builder,
+        checkpoint,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        flush_every=args.flush_every,
+        queue_size=args.queue_size,
+        mem_budget=args.mem_budget,
+        extract_cache=extract_cache,
+        flush_interval=args.flush_interval
+    )
+    results = None
+    scan = {'found': 0, 'skipped': 0}
+    indexed_paths = []
     processed_count = 0
     total_chunks = 0
     total_words = 0
@@ -238,53 +343,57 @@ def main():
     print("🔨 Processing files...\n")
     
     try:
-        with tqdm(total=len(files), desc="Processing", unit="file") as pbar:
-            for i, file_path in enumerate(files):
-                filename = os.path.basename(file_path)
-                
-                # Skip if already processed
-                if checkpoint.is_processed(filename):
-                    pbar.update(1)
-                    pbar.set_postfix_str(f"⏭️  {filename}")
-                    continue
+        with tqdm(desc="Processing", unit="file") as pbar:
+            # Extraction + tokenization run in the worker pool, chunks and
+            # SQLite flushes run in their own stages of this process
+            results = pipeline.run(iter_pending(files, checkpoint, scan))
+            done = 0
+            for result in results:
+                pbar.set_postfix_str(f"📄 {result['filename']} {pipeline.format_stats()}", refresh=False)
                 
-                pbar.set_postfix_str(f"📄 {filename}")
-                
-                # Process file
-                chunks_count, words_count, success = process_file(
-                    file_path,
-                    builder,
-                    extractor,
-                    postings_map
-                )
-                
-                if success:
-                    total_chunks += chunks_count
-                    total_words += words_count
+                if not result['error']:
+                    total_chunks += result['chunks_count']
+                    total_words += result['words_count']
                     processed_count += 1
-                    
-                    # Mark as processed
-                    checkpoint.mark_processed(filename, i)
-                    
-                    # Flush periodically
-                    if processed_count % args.flush_every == 0:
-                        pbar.set_postfix_str(f"💾 Flushing {len(postings_map)} words...")
-                        builder.flush_postings(postings_map)
-                        postings_map = {}
+                    indexed_paths.append(result['file_path'])
                 
-                pbar.update(1)
+                done += 1
+                update_progress(pbar, scan, done)
+            update_progress(pbar, scan, done)
+        
+        print(f"\n📋 Found {scan['found']} files, {scan['skipped']} already processed")
+        
+        if not scan['found']:
+            print("❌ No files found!")
+            return 1
         
-        # Final flush
-        if postings_map:
-            print("\n💾 Final flush...")
-            builder.flush_postings(postings_map)
+        if not done and not builder.pending_runs() and checkpoint.get_progress(0)['completed']:
+            print("✅ Indexing already completed!")
+            print(f"💡 Use --reset to rebuild from scratch")
+            return 0
+        
+        print("\n📈 Pipeline stages:")
+        for line in pipeline.summary():
+            print(f"   {line}")
+        
+        # Sorted runs (runs mode, or left over from an earlier runs build)
+        # are merged into a fresh, ordered posts table - no VACUUM needed
+        runs = builder.pending_runs()
+        if runs:
+            print(f"🔀 Merging {len(runs)} sorted runs...")
+            builder.merge_runs()
+        
+        # Gematria values and prefix variants of the words new to the index
+        print("🔢 Updating gematria/variants tables...")
+        builder.update_word_tables()
         
         # Mark as completed
         checkpoint.mark_completed()
         
-        # Optimize database
-        print("🗜️  Optimizing database...")
-        builder.vacuum()
+        if args.build_mode == 'merge':
+            # Optimize database
+            print("🗜️  Optimizing database...")
+            builder.vacuum()
         
         # Get stats
         stats = builder.get_stats()
@@ -300,6 +409,8 @@ def main():
         print(f"📝 Unique words: {stats['unique_words']}")
         print(f"💾 Database: {builder.db_path}")
         print(f"📄 Chunks file: {builder.chunks_path}")
+        if extract_cache:
+            print(f"🗃️  Extraction cache: {format_size(extract_cache.get_size())}")
         print()
         
         # Upload to Meilisearch
@@ -307,7 +418,16 @@ def main():
             print("📤 Uploading to Meilisearch...")
             uploader = MeiliUploader(args.meili_host, args.meili_index)
             uploader.configure_index()
-            uploader.upload_from_file(builder.chunks_path)
+            if args.incremental:
+                # Old versions may have had more chunks - delete them first
+                if removed_doc_ids:
+                    uploader.delete_docs(removed_doc_ids)
+                uploader.upload_from_file(
+                    builder.chunks_path, builder.get_titles(),
+                    set(builder.get_doc_ids(indexed_paths).values())
+                )
+            else:
+                uploader.upload_from_file(builder.chunks_path, builder.get_titles())
             
             meili_stats = uploader.get_stats()
             print(f"✓ Meilisearch: {meili_stats.get('documents', 0)} documents")
@@ -318,8 +438,9 @@ def main():
         print("\n\n⏸️  Interrupted by user")
         print("💾 Saving progress...")
         
-        if postings_map:
-            builder.flush_postings(postings_map)
+        # Flushes the written files and stops the stages
+        if results is not None:
+            results.close()
         
         print(f"✅ Progress saved! Processed {processed_count} files")
         print(f"💡 Run again to resume from checkpoint")
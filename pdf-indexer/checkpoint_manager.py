@@ -3,92 +3,295 @@ Checkpoint Manager - Resume support
 """
 import json
 import os
-from typing import Dict, List
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
 import logging
 
+from config import DB_NAME
+
 logger = logging.getLogger(__name__)
 
 
 class CheckpointManager:
-    """Manage indexing checkpoints for resume support"""
+    """
+    Manage indexing checkpoints for resume support
+    
+    The checkpoint lives in posmap.db: processed_files holds one row per
+    processed file (keyed by its full path) and checkpoint_state holds
+    lastProcessedIndex and completed. Membership checks use an in-memory
+    set and marking a file is a single-row insert, so both stay O(1) for
+    large libraries.
+    
+    A checkpoint.json written by older versions is imported on first use
+    and renamed to checkpoint.json.migrated. Its entries - and rows of
+    older versions of the table - are file names without a directory;
+    they match every file of that name until resolve_legacy() turns them
+    into paths.
+    """
     
-    def __init__(self, checkpoint_path: str):
+    def __init__(self, checkpoint_path: str, db: Optional[sqlite3.Connection] = None):
+        """
+        Args:
+            checkpoint_path: Legacy checkpoint.json path - posmap.db in the
+                             same directory is used unless db is given
+            db: Open connection to posmap.db (e.g. IndexBuilder.db)
+        """
         self.checkpoint_path = checkpoint_path
-        self.checkpoint = self._load()
-    
-    def _load(self) -> Dict:
-        """Load checkpoint from file"""
-        if os.path.exists(self.checkpoint_path):
-            try:
-                with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
-                    checkpoint = json.load(f)
-                    logger.info(f"Loaded checkpoint: {len(checkpoint.get('processedFiles', []))} files processed")
-                    return checkpoint
-            except Exception as e:
-                logger.error(f"Failed to load checkpoint: {e}")
-        
-        return {
-            'lastProcessedIndex': -1,
-            'processedFiles': [],
-            'completed': False
-        }
+        self._owns_db = db is None
+        if db is None:
+            db_path = os.path.join(os.path.dirname(checkpoint_path) or '.', DB_NAME)
+            db = sqlite3.connect(db_path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+        self.db = db
+        
+        self._init_tables()
+        self._migrate_json()
+        self.processed = self._load()
     
-    def save(self):
-        """Save checkpoint to file"""
+    def _init_tables(self):
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS processed_files (
+                filename TEXT PRIMARY KEY,
+                file_index INTEGER
+            )
+        """)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoint_state (
+                key TEXT PRIMARY KEY,
+                value
+            )
+        """)
+        self.db.commit()
+    
+    def _migrate_json(self):
+        """Import checkpoint.json of older versions"""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        
         try:
-            with open(self.checkpoint_path, 'w', encoding='utf-8') as f:
-                json.dump(self.checkpoint, f, ensure_ascii=False, indent=2)
-            logger.debug("Checkpoint saved")
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
         except Exception as e:
-            logger.error(f"Failed to save checkpoint: {e}")
+            logger.error(f"Failed to load checkpoint: {e}")
+            return
+        
+        processed = checkpoint.get('processedFiles', [])
+        last_index = checkpoint.get('lastProcessedIndex', -1)
+        
+        with self.db:
+            # Indexes of single files were never stored - the last one is
+            # the best guess for all of them
+            self.db.executemany(
+                "INSERT OR IGNORE INTO processed_files (filename, file_index) VALUES (?, ?)",
+                ((filename, last_index) for filename in processed)
+            )
+            self._set_state('lastProcessedIndex', last_index)
+            self._set_state('completed', bool(checkpoint.get('completed', False)))
+        
+        os.replace(self.checkpoint_path, self.checkpoint_path + '.migrated')
+        logger.info(f"Migrated checkpoint.json: {len(processed)} files processed")
+    
+    def _load(self) -> set:
+        """Load processed file paths"""
+        processed = {filename for (filename,) in self.db.execute("SELECT filename FROM processed_files")}
+        if processed:
+            logger.info(f"Loaded checkpoint: {len(processed)} files processed")
+        self.legacy = {filename for filename in processed if not _has_directory(filename)}
+        return processed - self.legacy
+    
+    def resolve_legacy(self, paths: Iterable[str]):
+        """
+        Replace legacy file-name entries with the paths they stand for
+        
+        Args:
+            paths: All files of the library - every file whose name has a
+                   legacy entry counts as processed, as it did before
+        """
+        if not self.legacy:
+            return
+        
+        resolved = [path for path in paths if os.path.basename(path) in self.legacy]
+        last_index = self.get_last_processed_index()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO processed_files (filename, file_index) VALUES (?, ?)",
+                ((path, last_index) for path in resolved)
+            )
+            self.db.executemany(
+                "DELETE FROM processed_files WHERE filename = ?",
+                ((filename,) for filename in self.legacy)
+            )
+        
+        self.processed.update(resolved)
+        logger.info(f"Resolved {len(self.legacy)} legacy checkpoint entries to {len(resolved)} paths")
+        self.legacy = set()
+    
+    def _get_state(self, key: str, default=None):
+        row = self.db.execute("SELECT value FROM checkpoint_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+    
+    def _set_state(self, key: str, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO checkpoint_state (key, value) VALUES (?, ?)",
+            (key, value)
+        )
+    
+    def save(self):
+        """Commit checkpoint changes (every change is already committed)"""
+        self.db.commit()
     
-    def is_processed(self, filename: str) -> bool:
+    def is_processed(self, path: str) -> bool:
         """Check if file was already processed"""
-        return filename in self.checkpoint['processedFiles']
+        return path in self.processed or (bool(self.legacy) and os.path.basename(path) in self.legacy)
     
-    def mark_processed(self, filename: str, index: int):
+    def mark_processed(self, path: str, index: int):
         """Mark file as processed"""
-        self.checkpoint['processedFiles'].append(filename)
-        self.checkpoint['lastProcessedIndex'] = index
-        self.save()
+        self.mark_processed_many([(path, index)])
+    
+    def mark_processed_many(self, files: Iterable[Tuple[str, int]]):
+        """Mark (path, index) pairs as processed in one transaction"""
+        with self.db:
+            self.record_processed(files)
+    
+    def record_processed(self, files: Iterable[Tuple[str, int]]):
+        """
+        Mark (path, index) pairs as processed without committing
+        
+        Meant for IndexBuilder.flush_postings(in_transaction=...) on the
+        builder's connection: the files count as processed exactly when
+        their postings are committed.
+        """
+        files = list(files)
+        if not files:
+            return
+        
+        self.db.executemany(
+            "INSERT OR REPLACE INTO processed_files (filename, file_index) VALUES (?, ?)",
+            files
+        )
+        self._set_state('lastProcessedIndex', files[-1][1])
+        self.processed.update(path for path, _ in files)
+    
+    def unmark_processed(self, paths: Iterable[str]):
+        """
+        Forget processed files (changed/deleted files of an incremental build)
+        
+        Only the exact paths are forgotten - call resolve_legacy() first,
+        a legacy entry stands for every file of its name.
+        """
+        paths = list(paths)
+        if not paths:
+            return
+        
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM processed_files WHERE filename = ?",
+                ((path,) for path in paths)
+            )
+            self._set_state('completed', False)
+        
+        self.processed.difference_update(paths)
     
     def mark_completed(self):
         """Mark indexing as completed"""
-        self.checkpoint['completed'] = True
-        self.save()
+        with self.db:
+            self._set_state('completed', True)
         logger.info("Indexing marked as completed")
     
     def reset(self):
         """Reset checkpoint"""
-        self.checkpoint = {
-            'lastProcessedIndex': -1,
-            'processedFiles': [],
-            'completed': False
-        }
-        self.save()
+        with self.db:
+            self.db.execute("DELETE FROM processed_files")
+            self._set_state('lastProcessedIndex', -1)
+            self._set_state('completed', False)
+        self.processed = set()
+        self.legacy = set()
         logger.info("Checkpoint reset")
     
     def get_progress(self, total_files: int) -> Dict:
         """Get progress information"""
-        processed = len(self.checkpoint['processedFiles'])
-        remaining = total_files - processed
-        percentage = (processed / total_files * 100) if total_files > 0 else 0
-        
-        return {
-            'processed': processed,
-            'remaining': remaining,
-            'total': total_files,
-            'percentage': percentage,
-            'completed': self.checkpoint['completed']
-        }
-    
-    def should_skip(self, filename: str) -> bool:
+        processed = len(self.processed) + len(self.legacy)
+        return _progress(processed, total_files, bool(self._get_state('completed', False)))
+    
+    def get_last_processed_index(self) -> int:
+        """Index of the last processed file in the file list (-1 if none)"""
+        return self._get_state('lastProcessedIndex', -1)
+    
+    def should_skip(self, path: str) -> bool:
         """Check if file should be skipped"""
-        return self.is_processed(filename)
+        return self.is_processed(path)
     
     def get_processed_files(self) -> List[str]:
         """Get list of processed files"""
-        return self.checkpoint['processedFiles'].copy()
+        return list(self.processed | self.legacy)
+    
+    def close(self):
+        """Close the database connection if this manager opened it"""
+        if self._owns_db:
+            self.db.close()
+
+
+def _has_directory(path: str) -> bool:
+    return os.path.basename(path) != path
+
+
+def _progress(processed: int, total_files: int, completed: bool) -> Dict:
+    return {
+        'processed': processed,
+        'remaining': total_files - processed,
+        'total': total_files,
+        'percentage': (processed / total_files * 100) if total_files > 0 else 0,
+        'completed': completed
+    }
+
+
+def read_progress(checkpoint_path: str, total_files: int) -> Optional[Dict]:
+    """
+    CheckpointManager.get_progress() without a CheckpointManager
+    
+    For status requests while a build may be running: posmap.db is opened
+    read-only, nothing is created or migrated. A checkpoint.json that
+    wasn't migrated yet is read as it is.
+    
+    Args:
+        checkpoint_path: Legacy checkpoint.json path (see CheckpointManager)
+        total_files: Files in the library
+    
+    Returns:
+        Progress dict, or None if there is no checkpoint
+    """
+    processed = 0
+    completed = False
+    found = False
+    
+    db_path = os.path.join(os.path.dirname(checkpoint_path) or '.', DB_NAME)
+    if os.path.exists(db_path):
+        db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            processed = db.execute("SELECT COUNT(*) FROM processed_files").fetchone()[0]
+            row = db.execute("SELECT value FROM checkpoint_state WHERE key = 'completed'").fetchone()
+            completed = bool(row[0]) if row else False
+            found = True
+        except sqlite3.OperationalError:
+            # No checkpoint tables yet
+            pass
+        finally:
+            db.close()
+    
+    if os.path.exists(checkpoint_path):
+        try:
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load checkpoint: {e}")
+        else:
+            # Migrated on the first CheckpointManager, before any row is written
+            processed += len(checkpoint.get('processedFiles', []))
+            completed = completed or bool(checkpoint.get('completed', False))
+            found = True
+    
+    return _progress(processed, total_files, completed) if found else None
 
 
 if __name__ == "__main__":
@@ -97,27 +300,30 @@ if __name__ == "__main__":
     
     logging.basicConfig(level=logging.DEBUG)
     
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as f:
-        checkpoint_path = f.name
-    
-    try:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, "checkpoint.json")
+        
+        # Legacy checkpoint to migrate
+        with open(checkpoint_path, 'w', encoding='utf-8') as f:
+            json.dump({'lastProcessedIndex': 0, 'processedFiles': ['file0.pdf'], 'completed': False}, f)
+        
         manager = CheckpointManager(checkpoint_path)
         
         # Test operations
-        print("Initial state:", manager.checkpoint)
+        print("Initial state:", manager.get_progress(10))
         
-        manager.mark_processed("file1.pdf", 0)
-        manager.mark_processed("file2.pdf", 1)
+        manager.mark_processed("books/file1.pdf", 1)
+        manager.mark_processed("books/file2.pdf", 2)
         
-        print("After processing 2 files:", manager.checkpoint)
-        print("Is file1.pdf processed?", manager.is_processed("file1.pdf"))
-        print("Is file3.pdf processed?", manager.is_processed("file3.pdf"))
+        print("After processing 2 files:", manager.get_processed_files())
+        print("Is books/file0.pdf processed (legacy)?", manager.is_processed("books/file0.pdf"))
+        print("Is books/file1.pdf processed?", manager.is_processed("books/file1.pdf"))
+        print("Is books/file3.pdf processed?", manager.is_processed("books/file3.pdf"))
         
         progress = manager.get_progress(10)
         print("Progress:", progress)
         
         manager.mark_completed()
-        print("Final state:", manager.checkpoint)
+        print("Final state:", manager.get_progress(10))
         
-    finally:
-        os.unlink(checkpoint_path)
+        manager.close()
@@ -9,26 +9,49 @@ MEILI_BATCH_SIZE = 1000
 
 # Processing Settings
 CHUNK_SIZE = 2000  # characters per chunk
-FLUSH_EVERY = 2    # flush to DB every N files
+FLUSH_EVERY = 0    # also flush to DB every N files (0 = memory budget only)
+FLUSH_INTERVAL = 0  # also flush every N seconds, so runs builds are searchable sooner (0 = off)
+MEM_BUDGET = "1GB"  # flush when the in-memory postings reach this size - up to 3 batches are
+                    # in memory at once (filling, queued, flushing), so peak is about 3x this
 MAX_WORKERS = 4    # parallel processing (set to CPU cores)
+LARGE_PDF_PAGES = 500   # split PDFs with at least N pages across workers (0 = never)
+PAGE_RANGE_SIZE = 100   # pages per extraction task when splitting
+PIPELINE_QUEUE_SIZE = 8  # analyzed files buffered ahead of the writer stage
+EXTRACT_CACHE_DIR = ""      # persist extracted PDF page texts here ("" = off)
+EXTRACT_CACHE_SIZE = "2GB"  # evict least recently used entries beyond this size
 
 # Hebrew Text Processing
 REMOVE_NIKUD = True
 MIN_WORD_LENGTH = 2
 NIKUD_PATTERN = r'[\u0591-\u05C7]'
+GEMATRIA_INDEX = True  # record the gematria values of Hebrew words (gematria table)
+GEMATRIA_PHRASES = True  # keep each document's words in text order (sequences table) for gematria phrases
+PREFIX_VARIANTS = True  # map prefix-stripped stems to the indexed words (variants table)
+PREFIX_MIN_STEM = 3     # letters a stem keeps after stripping ו/ה/ב/כ/ל/מ/ש
 
 # File Processing
 SUPPORTED_EXTENSIONS = ['.pdf', '.txt']
-SKIP_PATTERNS = ['temp', 'backup', '.git']
+SKIP_PATTERNS = ['temp', 'backup', '.git']  # fnmatch patterns of whole file/directory names
 
 # Database
 DB_NAME = "posmap.db"
 CHUNKS_FILE = "chunks.jsonl"
 CHECKPOINT_FILE = "checkpoint.json"
+DB_BATCH_SIZE = 500     # words per SELECT ... IN (...) / executemany batch
+DB_CACHE_MB = 64        # SQLite page cache
+BUILD_MODE = "merge"    # "merge" = merge every flush into posts, "runs" = sorted runs + final merge
+RUNS_DIR = "runs"       # sorted postings runs (runs build mode)
+MERGE_FAN_IN = 64       # runs merged at once; more runs are merged in several passes
+MERGE_FACTOR = 8        # runs build mode: merge every 8 runs of one size in the background (0 = off)
+CONTENT_HASH = False    # also hash file contents to detect changes (--incremental)
+SHARDS = 0              # >1 = partition postings by word hash into N shard DBs (sharded_index.py)
 
 # Performance
 USE_COMPRESSION = True  # zstd compression for postings
 COMPRESSION_LEVEL = 3   # 1-22, higher = better compression but slower
+ZSTD_DICTIONARY = True  # train a zstd dictionary on the first postings (stored in posmap.db)
+ZSTD_DICT_SIZE = 112 * 1024   # dictionary size in bytes
+ZSTD_DICT_SAMPLES = 5000      # postings payloads to train on
 
 # Logging
 LOG_LEVEL = "INFO"  # DEBUG, INFO, WARNING, ERROR
@@ -0,0 +1,353 @@
+"""
+Extraction Cache - per-page PDF text persisted across runs
+
+Extracting text with PyMuPDF is the most expensive step of a build, and
+the text of a PDF only changes when its bytes do. The cache stores the
+page texts of every extracted PDF under the blake2b hash of its contents
+(plus the extractor version), so re-runs - --reset rebuilds, a new chunk
+size, another output directory, renamed or moved files - read the texts
+back instead of parsing the PDF again.
+
+Layout:
+    
+    <cache_dir>/<version>/<hash[:2]>/<hash>.zst
+    <cache_dir>/<version>/<hash[:2]>/<hash>.<start>-<stop>.zst   (page ranges)
+
+Each entry is one zstd frame (with content checksum) of
+    per page: uint32 length, page text (utf-8)
+    uint32 0xFFFFFFFF end marker (a truncated entry has none)
+Entries are written to a .tmp file and renamed, so readers - and other
+worker processes - never see a partial entry. Large PDFs extracted as
+page ranges by several workers (see file_processor) get an entry per
+range, written and read by the worker of that range.
+
+The cache is kept under max_bytes by LRU eviction: reading an entry
+touches its mtime, and when the cache grows past the limit the oldest
+entries are deleted until it is back under EVICT_TO of the limit.
+"""
+import os
+import struct
+import logging
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import zstandard as zstd
+
+from index_builder import file_hash
+
+logger = logging.getLogger(__name__)
+
+_PAGE_HEADER = struct.Struct('<I')
+_ENTRY_SUFFIX = '.zst'
+_END_MARKER = 0xFFFFFFFF
+
+# After eviction the cache is at most this fraction of max_bytes, so
+# eviction doesn't run again on the very next entry
+EVICT_TO = 0.9
+
+# Several processes write to the same cache, each only sees its own
+# writes - the real size is re-read after writing this fraction of max_bytes
+_RESCAN_FRACTION = 1 / 16
+
+
+def _range_key(key: str, start: int, stop: int) -> str:
+    return f"{key}.{start}-{stop}"
+
+
+class ExtractCache:
+    """Content-hash keyed, size-limited cache of extracted page texts"""
+    
+    def __init__(self, cache_dir: str, max_bytes: int, version: str = 'v1'):
+        """
+        Args:
+            cache_dir: Cache directory (shared by all builds)
+            max_bytes: Size limit of the cache
+            version: Extractor version - entries of other versions are
+                     never read and eventually evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._keys: Dict[str, Tuple] = {}  # path -> (size, mtime_ns, hash)
+        self._size: Optional[int] = None   # cache size as of the last scan + own writes
+        self._unscanned = 0                # bytes written since the last scan
+    
+    def __getstate__(self):
+        # Worker processes start with fresh counters and their own scan
+        state = self.__dict__.copy()
+        state.update(hits=0, misses=0, _keys={}, _size=None, _unscanned=0)
+        return state
+    
+    def key(self, path: str) -> Optional[str]:
+        """Content hash of a file (None if it can't be read)"""
+        try:
+            stat = os.stat(path)
+            cached = self._keys.get(path)
+            if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+                return cached[2]
+            digest = file_hash(path)
+        except OSError as e:
+            logger.debug(f"Can't hash {path}: {e}")
+            return None
+        self._keys[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+    
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, self.version, key[:2], key + _ENTRY_SUFFIX)
+    
+    def contains(self, path: str) -> bool:
+        """Whether the page texts of a file are cached"""
+        key = self.key(path)
+        return key is not None and os.path.exists(self._entry_path(key))
+    
+    def iter_pages(self, path: str) -> Optional[Iterator[str]]:
+        """
+        Cached page texts of a file
+        
+        Returns:
+            Iterator over the page texts, or None on a cache miss
+        """
+        return self._iter_entry(self.key(path))
+    
+    def iter_range_pages(self, key: str, start: int, stop: int) -> Optional[Iterator[str]]:
+        """
+        Cached texts of pages [start, stop) of a file (see put_range)
+        
+        Args:
+            key: Content hash of the file (key())
+        """
+        return self._iter_entry(_range_key(key, start, stop))
+    
+    def _iter_entry(self, key: Optional[str]) -> Optional[Iterator[str]]:
+        entry_path = self._entry_path(key) if key else None
+        try:
+            f = open(entry_path, 'rb') if entry_path else None
+        except OSError:
+            f = None
+        if f is None:
+            self.misses += 1
+            return None
+        
+        self.hits += 1
+        try:
+            # Touch for LRU
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return self._read_pages(f, entry_path)
+    
+    def _read_pages(self, f, entry_path: str) -> Iterator[str]:
+        try:
+            with f, zstd.ZstdDecompressor().stream_reader(f) as reader:
+                while True:
+                    (length,) = _PAGE_HEADER.unpack(reader.read(_PAGE_HEADER.size))
+                    if length == _END_MARKER:
+                        return
+                    data = reader.read(length)
+                    if len(data) != length:
+                        raise ValueError("truncated entry")
+                    yield data.decode('utf-8', 'surrogatepass')
+        except (OSError, ValueError, struct.error, zstd.ZstdError) as e:
+            # Corrupt entry - drop it so the next run extracts again
+            logger.warning(f"Dropping corrupt extraction cache entry {entry_path}: {e}")
+            self._remove(entry_path)
+            raise
+    
+    def writer(self, path: str) -> Optional['CacheWriter']:
+        """
+        CacheWriter for the page texts of a file - pages are compressed
+        as they are written, so the whole text is never held in memory
+        
+        Returns:
+            CacheWriter, or None if the file can't be hashed or the entry
+            can't be created
+        """
+        key = self.key(path)
+        if key is None:
+            return None
+        return self._writer(self._entry_path(key))
+    
+    def _writer(self, entry_path: str) -> Optional['CacheWriter']:
+        try:
+            return CacheWriter(self, entry_path)
+        except OSError as e:
+            # Full disk, unwritable cache directory... - extract uncached
+            logger.warning(f"Can't write extraction cache entry {entry_path}: {e}")
+            return None
+    
+    def put(self, path: str, pages: Iterable[str]):
+        """Store all page texts of a file"""
+        writer = self.writer(path)
+        if writer is not None:
+            self._put(writer, pages)
+    
+    def put_range(self, key: str, start: int, stop: int, pages: Iterable[str]):
+        """
+        Store the texts of pages [start, stop) of a file extracted as
+        page ranges
+        
+        Args:
+            key: Content hash of the file (key())
+        """
+        writer = self._writer(self._entry_path(_range_key(key, start, stop)))
+        if writer is not None:
+            self._put(writer, pages)
+    
+    def _put(self, writer: 'CacheWriter', pages: Iterable[str]):
+        try:
+            for text in pages:
+                writer.write(text)
+            writer.commit()
+        finally:
+            writer.abort()
+    
+    def _added(self, size: int):
+        """Account for a new entry and evict if the cache is over its limit"""
+        if self._size is None:
+            self._size = self.get_size()
+        else:
+            self._size += size
+            self._unscanned += size
+            if self._unscanned >= self.max_bytes * _RESCAN_FRACTION:
+                self._size = self.get_size()
+                self._unscanned = 0
+        
+        if self._size > self.max_bytes:
+            self.evict()
+    
+    def _iter_entries(self) -> Iterator[os.DirEntry]:
+        """All entries (of every version) under cache_dir"""
+        stack = [self.cache_dir]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.endswith(_ENTRY_SUFFIX):
+                            yield entry
+            except OSError:
+                continue
+    
+    def get_size(self) -> int:
+        """Total size of the cache entries in bytes"""
+        size = 0
+        for entry in self._iter_entries():
+            try:
+                size += entry.stat().st_size
+            except OSError:
+                continue
+        return size
+    
+    def evict(self, target: Optional[int] = None):
+        """
+        Delete least recently used entries until the cache is at most
+        target bytes (default: EVICT_TO of max_bytes)
+        """
+        if target is None:
+            target = int(self.max_bytes * EVICT_TO)
+        
+        entries = []
+        for entry in self._iter_entries():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, entry_size, entry_path in sorted(entries):
+            if size <= target:
+                break
+            if self._remove(entry_path):
+                size -= entry_size
+                removed += 1
+        
+        self._size = size
+        self._unscanned = 0
+        if removed:
+            logger.info(f"Evicted {removed} extraction cache entries, cache is {size} bytes")
+    
+    def clear(self):
+        """Delete all entries"""
+        self.evict(target=0)
+    
+    def _remove(self, entry_path: str) -> bool:
+        try:
+            os.remove(entry_path)
+            return True
+        except OSError:
+            # Evicted by another process already
+            return False
+    
+    def get_stats(self) -> Dict:
+        """Hits/misses of this process and the cache size"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': self.get_size(),
+            'max_bytes': self.max_bytes
+        }
+
+
+class CacheWriter:
+    """
+    Write one cache entry page by page (see ExtractCache.writer)
+    
+    A write that fails with an I/O error is logged and drops the entry -
+    later writes and commit() do nothing, so extraction goes on uncached.
+    """
+    
+    def __init__(self, cache: ExtractCache, entry_path: str):
+        self.cache = cache
+        self.entry_path = entry_path
+        self.tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        self._file = open(self.tmp_path, 'wb')
+        self._writer = zstd.ZstdCompressor(write_checksum=True).stream_writer(self._file)
+    
+    def write(self, text: str):
+        if self._file is None:
+            return
+        data = text.encode('utf-8', 'surrogatepass')
+        try:
+            self._writer.write(_PAGE_HEADER.pack(len(data)))
+            self._writer.write(data)
+        except OSError as e:
+            self._failed(e)
+    
+    def commit(self):
+        """Finish the entry and make it visible"""
+        if self._file is None:
+            return
+        try:
+            self._writer.write(_PAGE_HEADER.pack(_END_MARKER))
+            self._writer.flush(zstd.FLUSH_FRAME)
+            self._file.close()
+            size = os.path.getsize(self.tmp_path)
+            os.replace(self.tmp_path, self.entry_path)
+        except OSError as e:
+            self._failed(e)
+            return
+        self._file = None
+        self.cache._added(size)
+    
+    def _failed(self, error: OSError):
+        logger.warning(f"Can't write extraction cache entry {self.entry_path}: {error}")
+        self.abort()
+    
+    def abort(self):
+        """Drop the entry unless it was committed (safe to call twice)"""
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
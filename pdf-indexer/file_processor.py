@@ -0,0 +1,424 @@
+"""
+File Processor - Extract + tokenize files, serially or in a worker pool
+"""
+import os
+import signal
+import logging
+from array import array
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from pdf_extractor import PDFExtractor, extract_page_range, split_page_ranges
+from extract_cache import ExtractCache
+from index_builder import (
+    PageTable, build_chunks_and_postings_from_pages, encode_word_sequence, file_title
+)
+from config import CHUNK_SIZE, LARGE_PDF_PAGES, PAGE_RANGE_SIZE, GEMATRIA_PHRASES
+
+logger = logging.getLogger(__name__)
+
+# Files with less text than this are reported as errors
+MIN_TEXT_LENGTH = 10
+
+# One extractor per worker process (created lazily)
+_extractor: Optional[PDFExtractor] = None
+_extract_cache: Optional[ExtractCache] = None
+
+
+def _get_extractor() -> PDFExtractor:
+    global _extractor
+    if _extractor is None:
+        _extractor = PDFExtractor(cache=_extract_cache)
+    return _extractor
+
+
+def set_extract_cache(cache: Optional[ExtractCache]):
+    """Use an extraction cache for the PDFs of this process (None = off)"""
+    global _extractor, _extract_cache
+    _extract_cache = cache
+    _extractor = None
+
+
+def _init_worker(cache: Optional[ExtractCache] = None):
+    """Worker process initializer - let the main process handle Ctrl+C"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_extract_cache(cache)
+
+
+def get_file_id(file_path: str) -> str:
+    """File identifier - filename without extension"""
+    return file_title(file_path)
+
+
+def iter_file_pages(file_path: str, extractor: PDFExtractor) -> Iterator[Dict]:
+    """
+    Stream pages of a PDF/TXT file
+    
+    Yields:
+        {'page_num': int, 'text': str, ...}
+    """
+    if file_path.lower().endswith('.pdf'):
+        yield from extractor.iter_pages(file_path)
+        return
+    
+    with open(file_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    yield {'page_num': 1, 'text': text, 'start_offset': 0, 'end_offset': len(text)}
+
+
+def _new_result(file_path: str, doc_id: int) -> Dict:
+    return {
+        'file_path': file_path,
+        'filename': os.path.basename(file_path),
+        'file_id': get_file_id(file_path),
+        'doc_id': doc_id,
+        'page_count': 0,
+        'page_table': None,
+        'sequence': None,
+        'chunks': [],
+        'postings': {},
+        'error': None
+    }
+
+
+def analyze_file(file_path: str, chunk_size: int = CHUNK_SIZE, doc_id: int = 0) -> Dict:
+    """
+    Extract and tokenize a single file
+    
+    Runs inside worker processes - never touches SQLite or chunks.jsonl,
+    the writer process does that with the returned data.
+    
+    Args:
+        file_path: PDF/TXT file
+        chunk_size: Characters per chunk
+        doc_id: Document id the chunks refer to (see IndexBuilder.register_files)
+    
+    Returns:
+        {
+            'file_path': str,
+            'filename': str,
+            'file_id': str,
+            'doc_id': int,
+            'page_count': int,
+            'page_table': PageTable,
+            'sequence': encode_word_sequence() blob or None (GEMATRIA_PHRASES),
+            'chunks': [...],
+            'postings': {word: [offsets]},
+            'error': str or None
+        }
+    """
+    return analyze_pages(
+        file_path, iter_file_pages(file_path, _get_extractor()), chunk_size, doc_id
+    )
+
+
+def analyze_pages(
+    file_path: str,
+    pages: Iterable[Dict],
+    chunk_size: int = CHUNK_SIZE,
+    doc_id: int = 0
+) -> Dict:
+    """
+    Tokenize a stream of pages - same result as analyze_file()
+    
+    Pages are consumed one at a time, so peak memory is bounded by a few
+    pages of text plus the postings of the file.
+    """
+    result = _new_result(file_path, doc_id)
+    page_table = PageTable()
+    sequence = [] if GEMATRIA_PHRASES else None
+    text_length = 0
+    
+    def counted(pages):
+        nonlocal text_length
+        for page in pages:
+            text_length += len(page['text'])
+            result['page_count'] += 1
+            yield page
+    
+    try:
+        chunks, postings = build_chunks_and_postings_from_pages(
+            doc_id, counted(pages), chunk_size, page_table, sequence
+        )
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    
+    if text_length < MIN_TEXT_LENGTH:
+        result['error'] = "File too short or empty"
+        return result
+    
+    result['page_table'] = page_table
+    if sequence is not None:
+        result['sequence'] = encode_word_sequence(sequence)
+    result['chunks'] = chunks
+    result['postings'] = postings
+    return result
+
+
+def _split_page_count(file_path: str) -> int:
+    """Page count if the file is a PDF that should be split, else 0"""
+    if not LARGE_PDF_PAGES or not file_path.lower().endswith('.pdf'):
+        return 0
+    page_count = _get_extractor().get_page_count(file_path)
+    if page_count < LARGE_PDF_PAGES:
+        return 0
+    if _extract_cache and _extract_cache.contains(file_path):
+        # Reading it from the cache is faster than splitting it
+        return 0
+    return page_count
+
+
+def analyze_or_split(file_path: str, chunk_size: int = CHUNK_SIZE, doc_id: int = 0) -> Dict:
+    """
+    analyze_file(), unless the file is a PDF with at least LARGE_PDF_PAGES
+    pages (and not in the extraction cache) - then only its page count
+    
+    Runs inside worker processes, so the dispatcher never opens or hashes
+    a PDF itself.
+    
+    Returns:
+        analyze_file() result, or {'file_path': str, 'split_pages': int,
+        'cache_key': content hash for the page range entries or None}
+    """
+    page_count = _split_page_count(file_path)
+    if not page_count:
+        return analyze_file(file_path, chunk_size, doc_id)
+    return {
+        'file_path': file_path,
+        'split_pages': page_count,
+        'cache_key': _extract_cache.key(file_path) if _extract_cache else None
+    }
+
+
+def analyze_page_range(
+    file_path: str,
+    start: int,
+    stop: int,
+    chunk_size: int = CHUNK_SIZE,
+    doc_id: int = 0,
+    cache_key: Optional[str] = None
+) -> Dict:
+    """
+    Extract and tokenize pages [start, stop) of a PDF on their own
+    
+    Runs inside worker processes. Offsets, chunk ids and the page table
+    start at 0 - _SplitDocument joins the ranges of a document. Texts are
+    read from / written to the range's extraction cache entry when
+    cache_key is given.
+    
+    Returns:
+        {'page_count': int, 'page_table': PageTable, 'sequence': blob or None,
+         'chunks': [...], 'postings': {word: array of offsets}}
+    """
+    texts = None
+    if _extract_cache and cache_key:
+        cached = _extract_cache.iter_range_pages(cache_key, start, stop)
+        if cached is not None:
+            try:
+                texts = list(cached)
+            except Exception as e:
+                logger.error(f"Extraction cache failed for {file_path} pages {start}-{stop}: {e}")
+    if texts is None:
+        texts = extract_page_range(file_path, start, stop)
+        if _extract_cache and cache_key:
+            _extract_cache.put_range(cache_key, start, stop, texts)
+    
+    page_table = PageTable()
+    sequence = [] if GEMATRIA_PHRASES else None
+    pages = ({'page_num': page_num, 'text': text} for page_num, text in enumerate(texts, start + 1))
+    chunks, postings = build_chunks_and_postings_from_pages(
+        doc_id, pages, chunk_size, page_table, sequence
+    )
+    return {
+        'page_count': len(texts),
+        'page_table': page_table,
+        'sequence': encode_word_sequence(sequence) if sequence is not None else None,
+        'chunks': chunks,
+        'postings': postings
+    }
+
+
+class _SplitDocument:
+    """
+    A large PDF whose page ranges are analyzed by several workers
+    
+    Ranges are joined in page order as soon as they and all ranges before
+    them are done: the cleaned text of a range follows that of the range
+    before after a newline, as pages do, so postings come out as if the
+    document was tokenized whole. Only chunks differ - the last chunk of a
+    range ends at its last page.
+    """
+    
+    def __init__(self, file_path: str, doc_id: int, range_count: int):
+        self.file_path = file_path
+        self.doc_id = doc_id
+        self.result = _new_result(file_path, doc_id)
+        self.result['page_table'] = PageTable()
+        self.ranges: List[Optional[Dict]] = [None] * range_count
+        self.joined = 0
+        self.remaining = range_count
+        self.failed = False
+    
+    def add_range(self, index: int, part: Dict):
+        """Take the analyze_page_range() result of range index"""
+        self.ranges[index] = part
+        while self.joined < len(self.ranges) and self.ranges[self.joined] is not None:
+            self._join(self.ranges[self.joined])
+            self.ranges[self.joined] = None
+            self.joined += 1
+    
+    def _join(self, part: Dict):
+        result = self.result
+        page_table = result['page_table']
+        shift = page_table.join_offset()
+        page_table.extend(part['page_table'], shift)
+        result['page_count'] += part['page_count']
+        if part['sequence'] is not None:
+            # Encoded sequences are zstd frames - joined by concatenation
+            result['sequence'] = (result['sequence'] or b'') + part['sequence']
+        
+        chunks = result['chunks']
+        first_chunk = len(chunks)
+        for chunk in part['chunks']:
+            chunk_id = first_chunk + chunk['chunkId']
+            chunk['id'] = f"{self.doc_id}_{chunk_id}"
+            chunk['chunkId'] = chunk_id
+            chunk['chunkStart'] += shift
+            chunks.append(chunk)
+        
+        postings = result['postings']
+        for word, offsets in part['postings'].items():
+            if shift:
+                offsets = array('I', map(shift.__add__, offsets))
+            if word in postings:
+                postings[word].extend(offsets)
+            else:
+                postings[word] = offsets
+    
+    def finish(self) -> Dict:
+        """The analyze_file() result of the whole document"""
+        self.ranges = None
+        if self.result['page_table'].raw_length < MIN_TEXT_LENGTH:
+            self.result.update(
+                page_table=None, sequence=None, chunks=[], postings={}, error="File too short or empty"
+            )
+        return self.result
+
+
+def iter_analyzed_files(
+    files: List[str],
+    workers: int = 1,
+    chunk_size: int = CHUNK_SIZE,
+    doc_ids: Optional[Dict[str, int]] = None,
+    extract_cache: Optional[ExtractCache] = None
+) -> Iterator[Dict]:
+    """
+    Analyze files and yield analyze_file() results
+    
+    With workers <= 1 files are processed in-process, in order.
+    Otherwise a process pool is used and results are yielded in completion
+    order; at most 2 * workers files are in flight so finished results
+    don't pile up in memory while the writer is busy. PDFs with at least
+    LARGE_PDF_PAGES pages are analyzed as PAGE_RANGE_SIZE page ranges
+    spread over the pool and joined here (see _SplitDocument) - their
+    text never reaches this process.
+    
+    Args:
+        files: File paths to process
+        workers: Number of worker processes
+        chunk_size: Characters per chunk
+        doc_ids: File path -> doc id (0 for files not in it), looked up
+                 when a file is submitted - may still be filled in while
+                 files is consumed
+        extract_cache: Read/write PDF page texts through this cache
+    """
+    if doc_ids is None:
+        doc_ids = {}
+    set_extract_cache(extract_cache)
+    
+    if workers <= 1:
+        for file_path in files:
+            yield analyze_file(file_path, chunk_size, doc_ids.get(file_path, 0))
+        return
+    
+    max_in_flight = workers * 2
+    pending_files = iter(files)
+    tasks = {}  # future -> (kind, payload)
+    files_in_flight = 0
+    
+    executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(extract_cache,)
+    )
+    logger.info(f"Started process pool with {workers} workers")
+    
+    def submit_file(file_path: str):
+        future = executor.submit(analyze_or_split, file_path, chunk_size, doc_ids.get(file_path, 0))
+        tasks[future] = ('file', file_path)
+    
+    def split_file(result: Dict):
+        # Large PDFs are split into page ranges so they don't keep a single
+        # worker busy long after the rest of the pool has finished
+        file_path = result['file_path']
+        page_count = result['split_pages']
+        ranges = split_page_ranges(page_count, PAGE_RANGE_SIZE)
+        logger.info(f"Splitting {os.path.basename(file_path)} ({page_count} pages) into {len(ranges)} ranges")
+        document = _SplitDocument(file_path, doc_ids.get(file_path, 0), len(ranges))
+        for index, (start, stop) in enumerate(ranges):
+            future = executor.submit(
+                analyze_page_range, file_path, start, stop, chunk_size, document.doc_id, result['cache_key']
+            )
+            tasks[future] = ('range', (document, index))
+    
+    def range_done(future, document: _SplitDocument, index: int) -> Optional[Dict]:
+        """The document's result once its last range is done"""
+        try:
+            part = future.result()
+        except Exception as e:
+            logger.error(f"Page range analysis failed for {document.file_path}: {e}")
+            document.failed = True
+        else:
+            if not document.failed:
+                document.add_range(index, part)
+        document.remaining -= 1
+        
+        if document.remaining:
+            return None
+        if document.failed:
+            # Retry the whole file the regular way (includes the PyPDF2 fallback)
+            future = executor.submit(analyze_file, document.file_path, chunk_size, document.doc_id)
+            tasks[future] = ('file', document.file_path)
+            return None
+        return document.finish()
+    
+    try:
+        while True:
+            # Keep the pool fed
+            while files_in_flight < max_in_flight:
+                file_path = next(pending_files, None)
+                if file_path is None:
+                    break
+                submit_file(file_path)
+                files_in_flight += 1
+            
+            if not tasks:
+                break
+            
+            done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, payload = tasks.pop(future)
+                if kind == 'range':
+                    result = range_done(future, *payload)
+                    if result is None:
+                        continue
+                else:
+                    result = future.result()
+                    if 'split_pages' in result:
+                        split_file(result)
+                        continue
+                files_in_flight -= 1
+                yield result
+    finally:
+        for future in tasks:
+            future.cancel()
+        executor.shutdown(wait=True)
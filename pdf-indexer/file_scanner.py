@@ -0,0 +1,98 @@
+"""
+File Scanner - single-pass streaming directory walk
+
+One os.scandir() walk finds files of all supported extensions at once.
+Files are yielded as they are discovered (in name order within each
+directory), so processing starts before a large library - or a network
+mount - has been walked completely. Directories and files whose name
+matches one of SKIP_PATTERNS (shell-style, case-insensitive) are skipped
+without descending into them. Symlinked directories are followed, each
+directory is walked once.
+"""
+import os
+import logging
+from fnmatch import fnmatchcase
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from config import SUPPORTED_EXTENSIONS, SKIP_PATTERNS
+
+logger = logging.getLogger(__name__)
+
+
+def _is_skipped(name: str, skip_patterns: List[str]) -> bool:
+    name = name.lower()
+    return any(fnmatchcase(name, pattern) for pattern in skip_patterns)
+
+
+def iter_files(
+    root: str,
+    extensions: Iterable[str] = SUPPORTED_EXTENSIONS,
+    skip_patterns: Iterable[str] = SKIP_PATTERNS
+) -> Iterator[str]:
+    """
+    Yield supported files under root, depth first
+    
+    Args:
+        root: Directory to walk
+        extensions: File extensions to yield (case-insensitive)
+        skip_patterns: Skip entries whose whole name matches one of these
+                       fnmatch patterns (case-insensitive)
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    skip_patterns = [pattern.lower() for pattern in skip_patterns]
+    stack = [root]
+    # (st_dev, st_ino) of the directories walked - symlink loops end here
+    visited = set()
+    
+    while stack:
+        directory = stack.pop()
+        try:
+            stat = os.stat(directory)
+            if (stat.st_dev, stat.st_ino) in visited:
+                logger.debug(f"Already walked {directory}")
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning(f"Can't read directory {directory}: {e}")
+            continue
+        
+        subdirs = []
+        for entry in entries:
+            if _is_skipped(entry.name, skip_patterns):
+                logger.debug(f"Skipping {entry.path}")
+                continue
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(extensions) and entry.is_file():
+                    yield entry.path
+            except OSError:
+                continue
+        
+        # Reversed, so subdirectories are walked in name order
+        stack.extend(reversed(subdirs))
+
+
+def find_files(root: str, skip_pdf: bool = False) -> List[str]:
+    """All supported files under root (see iter_files)"""
+    extensions = ['.txt'] if skip_pdf else SUPPORTED_EXTENSIONS
+    return list(iter_files(root, extensions))
+
+
+def iter_pending(files: Iterable[str], checkpoint, scan: Dict) -> Iterator[Tuple[str, int]]:
+    """
+    (path, index) of files the checkpoint doesn't list yet
+    
+    Args:
+        files: File paths, e.g. a running iter_files() walk
+        checkpoint: CheckpointManager
+        scan: {'found': 0, 'skipped': 0} - counted up as files arrive
+    """
+    for index, file_path in enumerate(files):
+        scan['found'] += 1
+        if checkpoint.is_processed(file_path):
+            scan['skipped'] += 1
+            continue
+        yield file_path, index
@@ -0,0 +1,168 @@
+"""
+Gematria Search - words and phrases of a given gematria value
+
+The build records the gematria of every indexed Hebrew word in the
+gematria table of posmap.db (regular, small and final-letter methods, see
+text_processor.GEMATRIA_TABLES), so a lookup across the library is a
+range of that table's index plus the postings of the words found - no
+book text is read.
+
+Phrases are runs of consecutive words. They are looked up in the word
+sequences the build keeps of every document (GEMATRIA_PHRASES, sequences
+table), so adjacency is counted in words - nikud, punctuation and
+unindexed short words between them don't matter, as in the app. A phrase
+search reads every sequence, but only the postings of the words phrases
+start with.
+
+With kolel (the app's useKolel) a word or phrase counts one more per
+word, so a search for value finds words of value - 1 and phrases of n
+words adding up to value - n.
+
+Usage:
+    from sharded_index import open_postings_reader
+    from gematria_search import search_gematria
+    
+    reader = open_postings_reader('index')
+    search_gematria(reader, 376)                  # {'שלום': {doc_id: [offsets]}, ...}
+    search_gematria(reader, 913, max_words=3)     # also phrases of 2-3 words
+    search_gematria(reader, 377, use_kolel=True)  # 'שלום' again (376 + 1 word)
+"""
+from typing import Dict, Iterable, List, Tuple
+
+from text_processor import GEMATRIA_METHODS
+
+
+def search_gematria(
+    reader,
+    value: int,
+    method: str = 'regular',
+    max_words: int = 1,
+    use_kolel: bool = False
+) -> Dict[str, Dict[int, List[int]]]:
+    """
+    Words and phrases whose gematria is value, with their postings
+    
+    Args:
+        reader: PostingsReader or ShardedPostingsReader
+        value: Gematria value
+        method: One of GEMATRIA_METHODS
+        max_words: Longest phrase to look for (1 = single words only) -
+                   phrases read the word sequences of all documents
+        use_kolel: Add the number of words to the gematria
+    
+    Returns:
+        {word or space-joined phrase: {doc_id: [offsets]}} - a phrase's
+        offsets are those of its first word
+    """
+    if method not in GEMATRIA_METHODS:
+        raise ValueError(f"Unknown gematria method: {method}")
+    
+    kolel = 1 if use_kolel else 0
+    words = list(reader.get_gematria_words(value - kolel, value - kolel, method))
+    results = {word: postings for word, postings in reader.get_many(words).items() if postings}
+    
+    # A word of a phrase is worth less than the whole phrase
+    high = value - 2 * kolel - 1
+    if max_words > 1 and high > 0:
+        values = reader.get_gematria_words(1, high, method)
+        matches = find_phrases(reader.iter_word_sequences(), values, value, max_words, use_kolel)
+        
+        # Offsets of the phrases' first words
+        first_words = list({phrase.split(' ', 1)[0] for phrase in matches})
+        postings = reader.get_many(first_words)
+        for phrase, occurrences in matches.items():
+            word_postings = postings.get(phrase.split(' ', 1)[0], {})
+            for doc_id, occurrence in occurrences:
+                offsets = word_postings.get(doc_id)
+                if offsets is not None and occurrence < len(offsets):
+                    results.setdefault(phrase, {}).setdefault(doc_id, []).append(offsets[occurrence])
+    
+    return results
+
+
+def find_phrases(
+    sequences: Iterable[Tuple[int, List[str]]],
+    values: Dict[str, int],
+    value: int,
+    max_words: int,
+    use_kolel: bool = False
+) -> Dict[str, List[Tuple[int, int]]]:
+    """
+    Phrases of 2 to max_words consecutive words adding up to value
+    
+    Args:
+        sequences: (doc_id, words in text order) of each document
+        values: {word: gematria value} of the words a phrase may contain
+        value: Gematria value of the phrase
+        max_words: Most words in a phrase
+        use_kolel: Add the number of words to the gematria
+    
+    Returns:
+        {space-joined phrase: [(doc_id, occurrence)]} - occurrence is the
+        number of times the phrase's first word appears in the document
+        before the phrase, i.e. the index of its offset in the postings
+    """
+    kolel = 1 if use_kolel else 0
+    
+    phrases: Dict[str, List[Tuple[int, int]]] = {}
+    for doc_id, words in sequences:
+        seen: Dict[str, int] = {}
+        for first, word in enumerate(words):
+            occurrence = seen.get(word, 0)
+            seen[word] = occurrence + 1
+            if word not in values:
+                continue
+            total = values[word] + kolel
+            for i in range(first + 1, min(first + max_words, len(words))):
+                if words[i] not in values:
+                    break
+                total += values[words[i]] + kolel
+                if total > value:
+                    break
+                if total == value:
+                    phrase = ' '.join(words[first:i + 1])
+                    phrases.setdefault(phrase, []).append((doc_id, occurrence))
+                    break
+    
+    return phrases
+
+
+if __name__ == "__main__":
+    # Test
+    import os
+    import tempfile
+    
+    from index_builder import (
+        IndexBuilder, PostingsReader, build_chunks_and_postings_from_pages, encode_word_sequence
+    )
+    from text_processor import extract_gematria_value
+    from config import DB_NAME
+    
+    # Pointed text: offsets are those of the text with nikud
+    test_text = "בְּרֵאשִׁית בָּרָא אֱלֹהִים אֵת הַשָּׁמַיִם"
+    value = extract_gematria_value("בראשית") + extract_gematria_value("ברא")
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        builder = IndexBuilder(tmpdir)
+        doc_id = builder.register_files(["test.txt"])["test.txt"]
+        sequence = []
+        chunks, postings = build_chunks_and_postings_from_pages(
+            doc_id, [{'page_num': 1, 'text': test_text}], sequence=sequence
+        )
+        builder.append_chunks(chunks)
+        builder.set_word_sequence(doc_id, encode_word_sequence(sequence))
+        builder.flush_postings(
+            {word: {doc_id: offsets} for word, offsets in postings.items()},
+            {doc_id: 1}
+        )
+        builder.update_word_tables()
+        builder.close()
+        
+        reader = PostingsReader(os.path.join(tmpdir, DB_NAME))
+        results = search_gematria(reader, value, max_words=2)
+        print(f"Gematria {value}: {results}")
+        assert results.get("בראשית ברא") == {doc_id: [0]}
+        
+        results = search_gematria(reader, value + 2, max_words=2, use_kolel=True)
+        assert results.get("בראשית ברא") == {doc_id: [0]}
+        reader.close()
@@ -1,50 +1,1183 @@
 """
 Index Builder - Core indexing logic
 """
+import os
+import sys
 import sqlite3
 import json
+import hashlib
+import threading
+from array import array
+from contextlib import nullcontext
 import zstandard as zstd
-from typing import Dict, List, Tuple
+from bisect import bisect_right
+from itertools import accumulate, islice, repeat
+from operator import sub
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 import logging
-from text_processor import tokenize_with_offsets, clean_text
+from text_processor import (
+    tokenize_with_offsets, clean_text_with_offsets, snap_to_word_boundary, page_for_offset, OffsetMap,
+    gematria_values, GEMATRIA_METHODS, prefix_stems, TOKENIZER
+)
+from postings_runs import (
+    list_runs, run_name, run_range, write_run, iter_run, merge_sorted, merge_run_files,
+    RunMerger, RunReader
+)
+from postings_accumulator import PostingsAccumulator
 from config import (
     CHUNK_SIZE, USE_COMPRESSION, COMPRESSION_LEVEL,
-    DB_NAME, CHUNKS_FILE
+    ZSTD_DICTIONARY, ZSTD_DICT_SIZE, ZSTD_DICT_SAMPLES,
+    DB_NAME, CHUNKS_FILE, DB_BATCH_SIZE, DB_CACHE_MB,
+    BUILD_MODE, RUNS_DIR, MERGE_FAN_IN, MERGE_FACTOR, CONTENT_HASH, SHARDS,
+    GEMATRIA_INDEX, PREFIX_VARIANTS
 )
 
 logger = logging.getLogger(__name__)
 
 
+def build_chunks_and_postings(
+    doc_id: int,
+    text: str,
+    pages: List[Dict],
+    chunk_size: int = CHUNK_SIZE,
+    page_table: Optional['PageTable'] = None
+) -> Tuple[List[Dict], Dict[str, array]]:
+    """
+    Build chunks and postings for a file
+    
+    Pure function - does not touch the database, so it can run
+    inside worker processes.
+    
+    Args:
+        doc_id: Document id (see IndexBuilder.register_files)
+        text: Full text content
+        pages: Page information
+        chunk_size: Characters per chunk
+        page_table: Filled in with the document's pages, see PageTable
+    
+    Returns:
+        (chunks, postings_map)
+    """
+    return build_chunks_and_postings_from_pages(
+        doc_id,
+        _split_pages(text, pages),
+        chunk_size,
+        page_table
+    )
+
+
+def _split_pages(text: str, pages: List[Dict]) -> Iterator[Dict]:
+    """Page dicts with their text, sliced from the full text"""
+    if not pages:
+        yield {'page_num': 1, 'text': text}
+        return
+    
+    for page in pages:
+        yield {
+            'page_num': page['page_num'],
+            'text': text[page['start_offset']:page['end_offset']]
+        }
+
+
+def build_chunks_and_postings_from_pages(
+    doc_id: int,
+    pages: Iterable[Dict],
+    chunk_size: int = CHUNK_SIZE,
+    page_table: Optional['PageTable'] = None,
+    sequence: Optional[List[str]] = None
+) -> Tuple[List[Dict], Dict[str, array]]:
+    """
+    Build chunks and postings from a stream of pages
+    
+    Pages (e.g. from PDFExtractor.iter_pages) are cleaned and tokenized
+    one at a time - pages are joined by a newline, so no word spans two
+    pages and this is the same as tokenizing the whole document once.
+    Chunks are cut from the buffered text as soon as chunk_size characters
+    are there, with the cut moved to the start of the word it would split,
+    so only about one page of text is held in memory. Offsets refer to the
+    cleaned text. The offsets of a word are an array('I') - 4 bytes each,
+    and compact to pickle back from a worker process.
+    
+    Args:
+        doc_id: Document id (see IndexBuilder.register_files)
+        pages: Iterable of {'page_num': int, 'text': str}
+        chunk_size: Characters per chunk (a chunk ends before a word that
+                    would cross it, or after a word longer than a chunk)
+        page_table: Filled in with the document's pages, so the offsets
+                    can be resolved to pages later (see PageTable)
+        sequence: Filled in with the document's words in text order (see
+                  encode_word_sequence)
+    
+    Returns:
+        (chunks, postings_map)
+    """
+    chunks = []
+    postings = {}
+    
+    # Cleaned-text offset where each page starts (for page lookup)
+    page_starts = []
+    page_nums = []
+    
+    buffer = ''      # cleaned text not chunked yet
+    buffer_start = 0  # offset of buffer[0] in the cleaned text
+    
+    def add_chunk(start: int, end: int):
+        chunk_id = len(chunks)
+        
+        # Find page number for this chunk
+        page_num = page_nums[bisect_right(page_starts, start) - 1]
+        
+        # Create chunk
+        preview = start - buffer_start
+        chunks.append({
+            'id': f"{doc_id}_{chunk_id}",
+            'docId': doc_id,
+            'chunkId': chunk_id,
+            'chunkStart': start,
+            'pageNum': page_num,
+            'text': buffer[preview:preview + min(end - start, 200)]  # Only first 200 chars for preview
+        })
+    
+    for page in pages:
+        page_text, page_offsets = clean_text_with_offsets(page['text'])
+        if not page_text:
+            if page_table is not None:
+                # Starts where the next page will, so it never wins a lookup
+                empty_start = buffer_start + len(buffer) + 1 if page_starts else 0
+                page_table.add_page(page['page_num'], len(page['text']), empty_start)
+            continue
+        
+        if page_starts:
+            buffer += '\n'
+        page_start = buffer_start + len(buffer)
+        page_starts.append(page_start)
+        page_nums.append(page['page_num'])
+        buffer += page_text
+        if page_table is not None:
+            page_table.add_page(page['page_num'], len(page['text']), page_start, page_offsets, len(page_text))
+        
+        # Tokenize the page once
+        for token, offset, length in tokenize_with_offsets(page_text):
+            if token not in postings:
+                postings[token] = array('I')
+            postings[token].append(page_start + offset)
+            if sequence is not None:
+                sequence.append(token)
+        
+        # Emit every full chunk in the buffer
+        pos = 0
+        while len(buffer) - pos >= chunk_size:
+            end = snap_to_word_boundary(buffer, pos + chunk_size, pos)
+            add_chunk(buffer_start + pos, buffer_start + end)
+            pos = end
+        buffer = buffer[pos:]
+        buffer_start += pos
+    
+    if buffer:
+        add_chunk(buffer_start, buffer_start + len(buffer))
+    
+    logger.debug(f"Built {len(chunks)} chunks, {len(postings)} unique words for doc {doc_id}")
+    
+    return chunks, postings
+
+
+def get_page_for_offset(pages: List[Dict], offset: int) -> int:
+    """Get page number for text offset (into the raw text, see PageTable)"""
+    return page_for_offset(pages, offset)
+
+
+# ---------------------------------------------------------------------------
+# Postings format
+#
+# A posts.postings blob is the (optionally zstd-compressed) payload:
+#
+#   format 1 (legacy): JSON {file_id: [first, delta, delta, ...]}
+#   format 2 (legacy): 0x02 followed by one or more blocks:
+#       varint doc_count
+#       varint keys_len, file ids (utf-8, sorted, NUL separated)
+#       packed offset counts   - one per doc
+#       packed first offsets   - one per doc
+#       packed deltas          - sum(counts) - doc_count, doc after doc
+#   format 3 (current): 0x03 followed by one or more blocks:
+#       varint doc_count
+#       packed doc ids         - sorted, see the files table
+#       packed offset counts, packed first offsets, packed deltas (as above)
+#
+# A packed array is a width byte (1/2/4/8) followed by little-endian
+# unsigned ints of that width, so a block is encoded and decoded with a
+# handful of array() calls instead of per-offset Python work.
+# A flush appends one block to the stored payload instead of re-encoding
+# it; readers merge docs that appear in more than one block.
+# ---------------------------------------------------------------------------
+
+POSTINGS_FORMAT_JSON = 1
+POSTINGS_FORMAT_BINARY = 2
+POSTINGS_FORMAT_DOC_IDS = 3
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_WIDTH_TYPECODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+def _write_varint(out: bytearray, value: int):
+    if value < 0x80:
+        out.append(value)
+        return
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_packed(out: bytearray, values: List[int]):
+    """Width byte + values at the smallest width that fits the largest one"""
+    largest = max(values, default=0)
+    width = 1 if largest < 1 << 8 else 2 if largest < 1 << 16 else 4 if largest < 1 << 32 else 8
+    out.append(width)
+    
+    packed = array(_WIDTH_TYPECODES[width], values)
+    if _BIG_ENDIAN:
+        packed.byteswap()
+    out += packed.tobytes()
+
+
+def _read_packed(data: bytes, pos: int, count: int) -> Tuple[array, int]:
+    width = data[pos]
+    pos += 1
+    
+    values = array(_WIDTH_TYPECODES[width])
+    values.frombytes(data[pos:pos + width * count])
+    if _BIG_ENDIAN:
+        values.byteswap()
+    
+    return values, pos + width * count
+
+
+def encode_postings_block(doc_postings: Dict[int, List[int]]) -> bytes:
+    """{doc_id: sorted offsets} -> one format 3 block"""
+    doc_ids = sorted(doc_postings)
+    docs = [doc_postings[doc_id] for doc_id in doc_ids]
+    
+    gaps = []
+    for offsets in docs:
+        if len(offsets) > 1:
+            gaps += map(sub, offsets[1:], offsets)
+    
+    out = bytearray()
+    _write_varint(out, len(doc_ids))
+    _write_packed(out, doc_ids)
+    _write_packed(out, [len(offsets) for offsets in docs])
+    _write_packed(out, [offsets[0] for offsets in docs])
+    _write_packed(out, gaps)
+    
+    return bytes(out)
+
+
+def encode_postings(doc_postings: Dict[int, List[int]]) -> bytes:
+    """{doc_id: sorted offsets} -> format 3 payload"""
+    return bytes([POSTINGS_FORMAT_DOC_IDS]) + encode_postings_block(doc_postings)
+
+
+def append_postings(payload: bytes, doc_postings: Dict[int, List[int]]) -> bytes:
+    """
+    Add {doc_id: sorted offsets} to a format 3 payload (None = new word)
+    
+    A new block is appended without decoding the existing ones. Legacy
+    payloads keyed by file name have to be converted first, see
+    IndexBuilder._upgrade_payload().
+    """
+    if payload is None:
+        return encode_postings(doc_postings)
+    
+    if payload[0] != POSTINGS_FORMAT_DOC_IDS:
+        raise ValueError(f"Can't append to postings format {payload[0]}")
+    
+    return payload + encode_postings_block(doc_postings)
+
+
+def remove_postings_docs(payload: bytes, doc_ids: Set[int]) -> bytes:
+    """
+    Format 3 payload without the given docs
+    
+    Blocks without any of the docs are copied as-is; the others are
+    re-packed from slices of their arrays, offsets are never decoded.
+    A payload left without docs is just the format byte.
+    """
+    if payload[0] != POSTINGS_FORMAT_DOC_IDS:
+        raise ValueError(f"Can't remove docs from postings format {payload[0]}")
+    
+    out = bytearray(payload[:1])
+    pos = 1
+    end = len(payload)
+    
+    while pos < end:
+        block_start = pos
+        doc_count, pos = _read_varint(payload, pos)
+        keys, pos = _read_packed(payload, pos, doc_count)
+        counts, pos = _read_packed(payload, pos, doc_count)
+        firsts, pos = _read_packed(payload, pos, doc_count)
+        deltas, pos = _read_packed(payload, pos, sum(counts) - doc_count)
+        
+        if doc_ids.isdisjoint(keys):
+            out += payload[block_start:pos]
+            continue
+        
+        kept = [i for i, key in enumerate(keys) if key not in doc_ids]
+        if not kept:
+            continue
+        
+        kept_deltas = array(deltas.typecode)
+        start = 0
+        for key, count in zip(keys, counts):
+            if key not in doc_ids:
+                kept_deltas += deltas[start:start + count - 1]
+            start += count - 1
+        
+        _write_varint(out, len(kept))
+        _write_packed(out, [keys[i] for i in kept])
+        _write_packed(out, [counts[i] for i in kept])
+        _write_packed(out, [firsts[i] for i in kept])
+        _write_packed(out, kept_deltas)
+    
+    return bytes(out)
+
+
+def _iter_blocks(payload: bytes):
+    """(keys, counts, firsts, deltas) of every block of a binary payload"""
+    doc_ids = payload[0] == POSTINGS_FORMAT_DOC_IDS
+    pos = 1
+    end = len(payload)
+    
+    while pos < end:
+        doc_count, pos = _read_varint(payload, pos)
+        if doc_ids:
+            keys, pos = _read_packed(payload, pos, doc_count)
+        else:
+            keys_len, pos = _read_varint(payload, pos)
+            keys = payload[pos:pos + keys_len].decode('utf-8').split('\0')
+            pos += keys_len
+        
+        counts, pos = _read_packed(payload, pos, doc_count)
+        firsts, pos = _read_packed(payload, pos, doc_count)
+        deltas, pos = _read_packed(payload, pos, sum(counts) - doc_count)
+        yield keys, counts, firsts, deltas
+
+
+def decode_postings_payload(payload: bytes) -> Dict:
+    """
+    Payload in any format -> {doc: absolute offsets}
+    
+    Docs are int doc ids for format 3 and file name strings for the
+    legacy formats.
+    """
+    if payload[:1] == b'{':
+        return {
+            file_id: list(accumulate(deltas))
+            for file_id, deltas in json.loads(payload).items()
+        }
+    
+    result = {}
+    for keys, counts, firsts, deltas in _iter_blocks(payload):
+        start = 0
+        for key, count, first in zip(keys, counts, firsts):
+            if count == 1:
+                offsets = [first]
+            else:
+                stop = start + count - 1
+                offsets = list(accumulate(deltas[start:stop], initial=first))
+                start = stop
+            
+            if key in result:
+                offsets = sorted(result[key] + offsets)
+            result[key] = offsets
+    
+    return result
+
+
+def decode_postings_docs(payload: bytes) -> Set:
+    """Payload in any format -> set of docs, without decoding offsets"""
+    if payload[:1] == b'{':
+        return set(json.loads(payload))
+    
+    docs = set()
+    for keys, _, _, _ in _iter_blocks(payload):
+        docs.update(keys)
+    return docs
+
+
+class PageTable:
+    """
+    The pages of a document, to resolve stored offsets without the PDF
+    
+    Postings and chunk offsets refer to the cleaned text - each page run
+    through clean_text() and the pages joined by a newline - while page
+    dicts (PDFExtractor) hold offsets into the raw extracted text. The
+    table keeps where every page starts in both and the OffsetMap between
+    them, so locate() is a bisect in each. Stored in the files table
+    (page_offsets) in the packed-array encoding of the postings:
+        
+        varint page_count, packed page numbers, packed clean start gaps,
+        packed raw page lengths,
+        varint segment_count, packed clean gaps, packed raw gaps
+    
+    clean_length (where the cleaned text ends) is only kept while the
+    table is built, so tables of page ranges can be joined with extend().
+    """
+    
+    def __init__(self):
+        self.page_nums = array('I')
+        self.clean_starts = array('I')
+        self.raw_starts = array('I')
+        self.raw_length = 0
+        self.clean_length = 0
+        self.offsets = OffsetMap()
+    
+    def add_page(
+        self,
+        page_num: int,
+        raw_length: int,
+        clean_start: int,
+        page_offsets: Optional[OffsetMap] = None,
+        clean_length: int = 0
+    ):
+        """
+        Append the next page
+        
+        Args:
+            page_num: Page number
+            raw_length: Length of the page's raw text
+            clean_start: Offset of the cleaned page in the document
+            page_offsets: clean_text_with_offsets() map of the page (None
+                          if nothing is left of it)
+            clean_length: Length of the cleaned page
+        """
+        self.page_nums.append(page_num)
+        self.clean_starts.append(clean_start)
+        self.raw_starts.append(self.raw_length)
+        if page_offsets is not None:
+            self.offsets.extend(page_offsets, clean_start, self.raw_length)
+        if clean_length:
+            self.clean_length = clean_start + clean_length
+        self.raw_length += raw_length
+    
+    def extend(self, other: 'PageTable', clean_start: int):
+        """
+        Append the pages of another table, whose cleaned text starts at
+        clean_start of this one's (see join_offset())
+        """
+        self.page_nums.extend(other.page_nums)
+        self.clean_starts.extend(map(clean_start.__add__, other.clean_starts))
+        self.raw_starts.extend(map(self.raw_length.__add__, other.raw_starts))
+        if other.clean_length:
+            self.offsets.extend(other.offsets, clean_start, self.raw_length)
+            self.clean_length = clean_start + other.clean_length
+        self.raw_length += other.raw_length
+    
+    def join_offset(self) -> int:
+        """Where the cleaned text of a following page range starts - after a newline, as between pages"""
+        return self.clean_length + 1 if self.clean_length else 0
+    
+    def __len__(self) -> int:
+        return len(self.page_nums)
+    
+    def locate(self, offset: int) -> Tuple[int, int]:
+        """
+        Stored (cleaned-text) offset -> (page number, offset into the page's raw text)
+        
+        The newline between two pages belongs to the first, as for chunks.
+        """
+        if not self.page_nums:
+            return 1, offset
+        i = max(bisect_right(self.clean_starts, offset) - 1, 0)
+        raw_start = self.raw_starts[i]
+        raw_end = self.raw_starts[i + 1] if i + 1 < len(self.raw_starts) else self.raw_length
+        return self.page_nums[i], min(self.offsets.to_raw(offset), raw_end) - raw_start
+    
+    def page_for_offset(self, offset: int) -> int:
+        """Page number of a stored offset"""
+        return self.locate(offset)[0]
+    
+    def encode(self) -> bytes:
+        out = bytearray()
+        _write_varint(out, len(self.page_nums))
+        _write_packed(out, self.page_nums)
+        _write_packed(out, _gaps(self.clean_starts))
+        ends = self.raw_starts[1:]
+        ends.append(self.raw_length)
+        _write_packed(out, list(map(sub, ends, self.raw_starts)))
+        _write_varint(out, len(self.offsets))
+        _write_packed(out, _gaps(self.offsets.clean))
+        _write_packed(out, _gaps(self.offsets.raw))
+        return bytes(out)
+    
+    @classmethod
+    def decode(cls, data: bytes) -> 'PageTable':
+        table = cls()
+        count, pos = _read_varint(data, 0)
+        page_nums, pos = _read_packed(data, pos, count)
+        table.page_nums = array('I', page_nums)
+        clean_starts, pos = _read_packed(data, pos, count)
+        table.clean_starts = array('I', accumulate(clean_starts))
+        lengths, pos = _read_packed(data, pos, count)
+        table.raw_starts = array('I', accumulate(lengths, initial=0))
+        table.raw_length = table.raw_starts.pop()
+        segments, pos = _read_varint(data, pos)
+        clean, pos = _read_packed(data, pos, segments)
+        raw, pos = _read_packed(data, pos, segments)
+        table.offsets = OffsetMap(array('I', accumulate(clean)), array('I', accumulate(raw)))
+        return table
+
+
+def _gaps(values: array) -> List[int]:
+    """First value, then the differences of ascending values"""
+    return values[:1].tolist() + list(map(sub, values[1:], values))
+
+
+# Dictionary samples are cut to this size - the start of a payload is
+# representative, and huge payloads of common words would crowd out the rest
+_DICT_SAMPLE_BYTES = 16 * 1024
+
+
+class PostingsDecompressor:
+    """
+    Decompress postings blobs
+    
+    Blobs are stored as plain payloads, plain zstd frames or frames made
+    with one of the dictionaries in the zstd_dicts table; the frame header
+    says which dictionary (if any) to use.
+    """
+    
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.decompressors = {0: zstd.ZstdDecompressor()}
+    
+    def add_dictionary(self, dict_id: int, data: bytes):
+        self.decompressors[dict_id] = zstd.ZstdDecompressor(
+            dict_data=zstd.ZstdCompressionDict(data)
+        )
+    
+    def _get(self, dict_id: int) -> zstd.ZstdDecompressor:
+        if dict_id not in self.decompressors:
+            row = self.db.execute(
+                "SELECT data FROM zstd_dicts WHERE dict_id = ?", (dict_id,)
+            ).fetchone()
+            if not row:
+                raise ValueError(f"Unknown zstd dictionary: {dict_id}")
+            self.add_dictionary(dict_id, row[0])
+        return self.decompressors[dict_id]
+    
+    def decompress(self, blob: bytes) -> bytes:
+        if blob[:4] != _ZSTD_MAGIC:
+            return blob
+        return self._get(zstd.get_frame_parameters(blob).dict_id).decompress(blob)
+    
+    def decompress_many(self, blobs: List[bytes]) -> List[bytes]:
+        """Decompress a batch, one multi-frame call per dictionary"""
+        groups = {}
+        for i, blob in enumerate(blobs):
+            if blob[:4] == _ZSTD_MAGIC:
+                groups.setdefault(zstd.get_frame_parameters(blob).dict_id, []).append(i)
+        if not groups:
+            return blobs
+        
+        payloads = list(blobs)
+        for dict_id, indices in groups.items():
+            decompressor = self._get(dict_id)
+            frames = [blobs[i] for i in indices]
+            if hasattr(decompressor, 'multi_decompress_to_buffer'):
+                buffers = decompressor.multi_decompress_to_buffer(frames)
+                frames = [buffers[i].tobytes() for i in range(len(buffers))]
+            else:
+                frames = [decompressor.decompress(frame) for frame in frames]
+            for i, payload in zip(indices, frames):
+                payloads[i] = payload
+        
+        return payloads
+
+
+class PostingsReader:
+    """
+    Read postings from a posmap.db (any postings format)
+    
+    While a 'runs' mode build is running, the postings of committed flushes
+    are still in runs - immutable segments next to the posts table. Every
+    lookup reads the posts table and the committed runs in one consistent
+    snapshot, so newly flushed documents are searchable right away and the
+    background merges (which replace runs) never show a word twice.
+    """
+    
+    def __init__(self, db_path: str, runs_dir: Optional[str] = None):
+        """
+        Args:
+            db_path: posmap.db path
+            runs_dir: Runs of the index (default: RUNS_DIR next to db_path)
+        """
+        self.db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self.decompressor = PostingsDecompressor(self.db)
+        self.runs_dir = runs_dir or os.path.join(os.path.dirname(db_path), RUNS_DIR)
+        self.segments = {}  # path -> RunReader of the current snapshot
+        self.lock = threading.Lock()
+    
+    def _payload(self, blob: bytes) -> bytes:
+        return self.decompressor.decompress(blob)
+    
+    def get_committed_through(self) -> int:
+        """Last flush number the index committed"""
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'runs_committed_through'"
+        ).fetchone()
+        return row[0] if row else 0
+    
+    def _snapshot(self, read: Callable, committed_through: Optional[int]):
+        """
+        Call read(segments) inside a read transaction, with readers of the
+        runs committed but not merged into posts as of that transaction
+        
+        A run deleted by a merge between the transaction start and opening
+        it means the snapshot is already stale - it's taken again.
+        """
+        with self.lock:
+            while True:
+                self.db.execute("BEGIN")
+                try:
+                    row = self.db.execute(
+                        "SELECT value FROM meta WHERE key = 'runs_merged_through'"
+                    ).fetchone()
+                    merged_through = row[0] if row else 0
+                    if committed_through is None:
+                        committed_through = self.get_committed_through()
+                    
+                    try:
+                        segments = self._open_segments(merged_through, committed_through)
+                    except FileNotFoundError:
+                        continue
+                    return read(segments)
+                finally:
+                    self.db.execute("COMMIT")
+    
+    def _open_segments(self, merged_through: int, committed_through: int) -> List[RunReader]:
+        runs = [
+            path for first, last, path in list_runs(self.runs_dir, remove_covered=False)
+            if first > merged_through and last <= committed_through
+        ]
+        
+        segments = {path: self.segments.pop(path, None) for path in runs}
+        for reader in self.segments.values():
+            reader.close()
+        self.segments = {path: reader for path, reader in segments.items() if reader}
+        for path in runs:
+            if path not in self.segments:
+                self.segments[path] = RunReader(path)
+        return [self.segments[path] for path in runs]
+    
+    def _decode(self, blob: Optional[bytes], blocks: List[bytes]) -> Dict[int, List[int]]:
+        """Stored blob (or None) + segment blocks -> {doc_id: offsets}"""
+        payload = self._payload(blob) if blob is not None else None
+        if not blocks:
+            return decode_postings_payload(payload)
+        if payload is None or payload[0] == POSTINGS_FORMAT_DOC_IDS:
+            payload = payload or bytes([POSTINGS_FORMAT_DOC_IDS])
+            return decode_postings_payload(payload + b''.join(blocks))
+        
+        result = decode_postings_payload(payload)
+        result.update(decode_postings_payload(bytes([POSTINGS_FORMAT_DOC_IDS]) + b''.join(blocks)))
+        return result
+    
+    def get(self, word: str, committed_through: Optional[int] = None) -> Dict[int, List[int]]:
+        """{doc_id: absolute offsets} for a word ({} if not indexed)"""
+        return self.get_many([word], committed_through).get(word, {})
+    
+    def get_many(
+        self,
+        words: List[str],
+        committed_through: Optional[int] = None
+    ) -> Dict[str, Dict[int, List[int]]]:
+        """
+        {word: {doc_id: absolute offsets}} for the indexed words
+        
+        Args:
+            words: Words to look up
+            committed_through: Read runs up to this flush number (default:
+                               what posmap.db says was committed)
+        """
+        return {
+            word: self._decode(blob, blocks)
+            for word, (blob, blocks) in self._snapshot(
+                lambda segments: self._read(words, segments), committed_through
+            ).items()
+        }
+    
+    def _read(self, words: List[str], segments: List[RunReader]) -> Dict[str, Tuple]:
+        """{word: (posts blob or None, [segment blocks])} of one snapshot"""
+        found = {}
+        for i in range(0, len(words), DB_BATCH_SIZE):
+            batch = words[i:i + DB_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            rows = self.db.execute(
+                f"SELECT word, postings FROM posts WHERE word IN ({placeholders})",
+                batch
+            )
+            for word, blob in rows:
+                found[word] = (blob, [])
+        
+        for segment in segments:
+            for word, block in segment.get_many(words).items():
+                found.setdefault(word, (None, []))[1].append(block)
+        return found
+    
+    def get_docs(self, word: str, committed_through: Optional[int] = None) -> Set[int]:
+        """Doc ids containing a word - offsets are not decoded"""
+        found = self._snapshot(lambda segments: self._read([word], segments), committed_through)
+        if word not in found:
+            return set()
+        
+        blob, blocks = found[word]
+        docs = decode_postings_docs(self._payload(blob)) if blob is not None else set()
+        if blocks:
+            docs |= decode_postings_docs(bytes([POSTINGS_FORMAT_DOC_IDS]) + b''.join(blocks))
+        return docs
+    
+    def get_files(self) -> Dict[int, Dict]:
+        """{doc_id: {'path', 'title', 'page_count', 'size'}}"""
+        return {
+            doc_id: {'path': path, 'title': title, 'page_count': page_count, 'size': size}
+            for doc_id, path, title, page_count, size in self.db.execute(
+                "SELECT doc_id, path, title, page_count, size FROM files"
+            )
+        }
+    
+    def get_page_table(self, doc_id: int) -> Optional[PageTable]:
+        """PageTable of a document (None if it was indexed without one)"""
+        return _read_page_table(self.db, doc_id)
+    
+    def get_gematria_words(self, low: int, high: Optional[int] = None, method: str = 'regular') -> Dict[str, int]:
+        """
+        Indexed words whose gematria is in [low, high]
+        
+        Words of removed documents stay in the gematria table - their
+        postings are empty.
+        
+        Args:
+            low: Lowest value
+            high: Highest value (default: low)
+            method: One of GEMATRIA_METHODS
+        
+        Returns:
+            {word: value}
+        """
+        if method not in GEMATRIA_METHODS:
+            raise ValueError(f"Unknown gematria method: {method}")
+        return dict(self.db.execute(
+            "SELECT word, value FROM gematria WHERE method = ? AND value BETWEEN ? AND ?",
+            (GEMATRIA_METHODS.index(method), low, low if high is None else high)
+        ))
+    
+    def iter_word_sequences(self) -> Iterator[Tuple[int, List[str]]]:
+        """(doc_id, words in text order) of the documents indexed with GEMATRIA_PHRASES"""
+        last_doc_id = -1
+        while True:
+            rows = self.db.execute(
+                "SELECT doc_id, words FROM sequences WHERE doc_id > ? ORDER BY doc_id LIMIT ?",
+                (last_doc_id, DB_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+            for doc_id, blob in rows:
+                yield doc_id, decode_word_sequence(blob)
+            last_doc_id = rows[-1][0]
+    
+    def get_variants(self, word: str) -> List[str]:
+        """Indexed words that are word with Hebrew prefixes (לשבת, והשבת for שבת)"""
+        return [variant for (variant,) in self.db.execute("SELECT word FROM variants WHERE stem = ?", (word,))]
+    
+    def get_with_variants(self, word: str, committed_through: Optional[int] = None) -> Dict[str, Dict[int, List[int]]]:
+        """{word or prefixed form: {doc_id: absolute offsets}} - the postings a query for word expands to"""
+        return self.get_many([word] + self.get_variants(word), committed_through)
+    
+    def close(self):
+        for reader in self.segments.values():
+            reader.close()
+        self.segments = {}
+        self.db.close()
+
+
+def encode_word_sequence(words: List[str]) -> bytes:
+    """
+    A document's words in text order, as stored in the sequences table
+    
+    Gematria phrases are runs of consecutive words - the postings alone
+    can't tell whether two occurrences are neighbours.
+    """
+    return zstd.ZstdCompressor(level=COMPRESSION_LEVEL).compress('\0'.join(words).encode('utf-8'))
+
+
+def decode_word_sequence(blob: bytes) -> List[str]:
+    """encode_word_sequence() -> words (a blob may be several of them, one after another)"""
+    words = []
+    while blob:
+        decompressor = zstd.ZstdDecompressor().decompressobj()
+        data = decompressor.decompress(blob)
+        blob = decompressor.unused_data
+        if data:
+            words.extend(data.decode('utf-8').split('\0'))
+    return words
+
+
+def _iter_word_batches(db: sqlite3.Connection, table: str) -> Iterator[List[str]]:
+    """Words of a table keyed by word, DB_BATCH_SIZE at a time in key order"""
+    last_word = ''
+    while True:
+        words = [
+            word for (word,) in db.execute(
+                f"SELECT word FROM {table} WHERE word > ? ORDER BY word LIMIT ?",
+                (last_word, DB_BATCH_SIZE)
+            )
+        ]
+        if not words:
+            return
+        yield words
+        last_word = words[-1]
+
+
+def _select_words(db: sqlite3.Connection, table: str, words: List[str]) -> Set[str]:
+    """The words that a table keyed by word has"""
+    if not words:
+        return set()
+    placeholders = ','.join('?' * len(words))
+    return {
+        word for (word,) in db.execute(f"SELECT word FROM {table} WHERE word IN ({placeholders})", words)
+    }
+
+
+def _read_page_table(db: sqlite3.Connection, doc_id: int) -> Optional[PageTable]:
+    row = db.execute("SELECT page_offsets FROM files WHERE doc_id = ?", (doc_id,)).fetchone()
+    return PageTable.decode(row[0]) if row and row[0] is not None else None
+
+
+def file_title(path: str) -> str:
+    """Title of a document - filename without extension"""
+    return os.path.basename(path).rsplit('.', 1)[0]
+
+
+def file_hash(path: str) -> str:
+    """blake2b digest of a file's contents"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_stats(path: str, content_hash: bool = False) -> Tuple:
+    """(size, mtime, content hash or None) of a file"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None, None, None
+    return stat.st_size, stat.st_mtime, file_hash(path) if content_hash else None
+
+
 class IndexBuilder:
     """Build inverted index with SQLite backend"""
     
-    def __init__(self, output_dir: str):
+    def __init__(
+        self,
+        output_dir: str,
+        chunk_size: int = CHUNK_SIZE,
+        build_mode: str = BUILD_MODE,
+        use_dictionary: bool = ZSTD_DICTIONARY,
+        content_hash: bool = CONTENT_HASH,
+        shards: Optional[int] = None,
+        merge_factor: int = MERGE_FACTOR
+    ):
+        """
+        Args:
+            output_dir: Directory of posmap.db / chunks.jsonl
+            chunk_size: Characters per chunk
+            build_mode: 'merge' - every flush is merged into posts
+                        'runs' - flushes write sorted runs, merge_runs()
+                        builds posts from them at the end
+            use_dictionary: Train a zstd dictionary on the first
+                            ZSTD_DICT_SAMPLES postings and compress with it
+            content_hash: Record a hash of every file's contents, so
+                          diff_files() ignores files that were only touched
+            shards: Partition the postings by word hash into this many
+                    shard DBs, each written by its own process (0/1 = all
+                    in posmap.db; default: the index's current layout, or
+                    SHARDS for a new index). An index with postings keeps
+                    its layout until reset().
+            merge_factor: 'runs' build mode - a background thread merges
+                          this many committed runs of the same size into
+                          one while the build runs (0 = only at the end)
+        """
+        if build_mode not in ('merge', 'runs'):
+            raise ValueError(f"Unknown build mode: {build_mode}")
+        
         self.output_dir = output_dir
+        self.chunk_size = chunk_size
+        self.build_mode = build_mode
         self.db_path = f"{output_dir}/{DB_NAME}"
         self.chunks_path = f"{output_dir}/{CHUNKS_FILE}"
+        self.runs_dir = f"{output_dir}/{RUNS_DIR}"
+        self.content_hash = content_hash
         self.db = None
         self.compressor = zstd.ZstdCompressor(level=COMPRESSION_LEVEL) if USE_COMPRESSION else None
-        self.decompressor = zstd.ZstdDecompressor() if USE_COMPRESSION else None
+        self._terms_compressor = zstd.ZstdCompressor(level=COMPRESSION_LEVEL) if USE_COMPRESSION else None
+        self.decompressor = None
+        
+        # Dictionary training - samples are collected from the first
+        # compressed payloads until there are enough to train on
+        self.use_dictionary = USE_COMPRESSION and use_dictionary
+        self.dict_id = None
+        self._dict_samples = []
+        
+        self.merge_factor = merge_factor
+        self.merger = None
+        if build_mode == 'runs' and merge_factor > 1:
+            self.merger = RunMerger(self.runs_dir, self._get_committed_runs, merge_factor)
+        
+        # The pipeline registers files while another thread flushes - both
+        # use self.db, and a commit of one must not end the other's transaction
+        self.lock = threading.RLock()
+        
+        # Byte range of each document's lines in chunks.jsonl, recorded in
+        # the files table when the document's postings are flushed
+        self._chunk_ranges = {}
+        
+        # Encoded PageTable of each document, recorded the same way
+        self._page_tables = {}
+        
+        # encode_word_sequence() of each document, recorded the same way
+        self._word_sequences = {}
         
         self._init_db()
+        self._load_dictionary()
+        
+        # Sharded layout (see sharded_index.py) - posts in posmap.db stays empty
+        from sharded_index import read_shard_count, remove_shards
+        
+        self.shards = None
+        current_shards = read_shard_count(output_dir)
+        if shards is None:
+            shards = current_shards or SHARDS
+        self.requested_shards = shards if shards > 1 else 0
+        
+        shard_count = current_shards
+        if shard_count != self.requested_shards:
+            if self._has_postings():
+                logger.warning(
+                    f"Index has {shard_count or 1} postings shard(s) - "
+                    f"reset() rebuilds it with {self.requested_shards or 1}"
+                )
+            else:
+                remove_shards(output_dir)
+                shard_count = self.requested_shards
+        if shard_count:
+            self._open_shards(shard_count)
+        
+        # The tokenizer the index was built with - kept until reset(). An
+        # index with documents but no record predates TOKENIZER_VERSION 2.
+        self.tokenizer = self._get_meta('tokenizer')
+        if self.tokenizer is None:
+            has_documents = os.path.exists(self.chunks_path) and os.path.getsize(self.chunks_path) > 0
+            self.tokenizer = '1' if has_documents else TOKENIZER
+            with self.lock, self.db:
+                self._set_meta('tokenizer', self.tokenizer)
+    
+    def _open_shards(self, shard_count: int):
+        from sharded_index import ShardSet
+        self.shards = ShardSet(self.output_dir, shard_count, self.use_dictionary, self.merge_factor)
+    
+    def _has_postings(self) -> bool:
+        """Whether any postings were written (in posmap.db, runs or shards)"""
+        if self.db.execute("SELECT 1 FROM posts LIMIT 1").fetchone():
+            return True
+        if list_runs(self.runs_dir) or self._get_meta('runs_committed_through'):
+            return True
+        return False
     
     def _init_db(self):
         """Initialize SQLite database"""
-        self.db = sqlite3.connect(self.db_path)
+        # The flush stage of the pipeline runs in its own thread
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        
+        # Bulk-load tuning: WAL + NORMAL sync is crash-safe for the DB file
+        # and avoids an fsync per transaction
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA temp_store=MEMORY")
+        self.db.execute(f"PRAGMA cache_size=-{DB_CACHE_MB * 1024}")
+        
         self.db.execute("""
             CREATE TABLE IF NOT EXISTS posts (
                 word TEXT PRIMARY KEY,
                 postings BLOB
             )
         """)
-        self.db.execute("CREATE INDEX IF NOT EXISTS idx_word ON posts(word)")
+        # The primary key is already indexed - a second index on word only
+        # doubled the cost of every write
+        self.db.execute("DROP INDEX IF EXISTS idx_word")
+        
+        # Format of newly written postings (readers detect it per blob)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            )
+        """)
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('postings_format', ?)",
+            (POSTINGS_FORMAT_DOC_IDS,)
+        )
+        
+        # Documents - postings and chunks refer to them by doc_id
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                doc_id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                title TEXT,
+                page_count INTEGER,
+                size INTEGER
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_files_title ON files(title)")
+        
+        # Change detection for incremental builds (added after the table)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(files)")}
+        for column, column_type in (
+            ('mtime', 'REAL'), ('content_hash', 'TEXT'),
+            ('chunks_offset', 'INTEGER'), ('chunks_length', 'INTEGER'),
+            ('page_offsets', 'BLOB')
+        ):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} {column_type}")
+        
+        # Forward index: the words of each document (zstd-compressed,
+        # NUL-joined), so removing a document only touches its own words
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS forward (
+                doc_id INTEGER PRIMARY KEY,
+                terms BLOB
+            )
+        """)
+        
+        # Trained zstd dictionaries, referenced by the dict id in each frame
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS zstd_dicts (
+                dict_id INTEGER PRIMARY KEY,
+                data BLOB
+            )
+        """)
+        
+        # Gematria of every indexed Hebrew word, by method (the index in
+        # GEMATRIA_METHODS) - a lookup by value is a range of the primary key
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS gematria (
+                method INTEGER,
+                value INTEGER,
+                word TEXT,
+                PRIMARY KEY (method, value, word)
+            ) WITHOUT ROWID
+        """)
+        
+        # Indexed words by their stems without Hebrew prefixes (בשבת and
+        # והשבת under שבת), so a query expands with one range lookup
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS variants (
+                stem TEXT,
+                word TEXT,
+                PRIMARY KEY (stem, word)
+            ) WITHOUT ROWID
+        """)
+        
+        # Words the gematria and variants tables were filled for
+        # (update_word_tables)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS lexicon (
+                word TEXT PRIMARY KEY
+            ) WITHOUT ROWID
+        """)
+        
+        # Words of each document in text order (GEMATRIA_PHRASES)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sequences (
+                doc_id INTEGER PRIMARY KEY,
+                words BLOB
+            )
+        """)
         self.db.commit()
         
+        self.decompressor = PostingsDecompressor(self.db)
+        
         logger.info(f"Database initialized: {self.db_path}")
     
+    def _load_dictionary(self):
+        """Compress with the DB's current dictionary, if it has one"""
+        dict_id = self._get_meta('zstd_dict_id')
+        if not USE_COMPRESSION or dict_id is None:
+            return
+        
+        row = self.db.execute("SELECT data FROM zstd_dicts WHERE dict_id = ?", (dict_id,)).fetchone()
+        self._set_dictionary(dict_id, row[0])
+    
+    def _set_dictionary(self, dict_id: int, data: bytes):
+        self.dict_id = dict_id
+        self.compressor = zstd.ZstdCompressor(
+            level=COMPRESSION_LEVEL,
+            dict_data=zstd.ZstdCompressionDict(data)
+        )
+        self.decompressor.add_dictionary(dict_id, data)
+        self._dict_samples = []
+    
+    def train_dictionary(self, samples: List[bytes]) -> bool:
+        """
+        Train a zstd dictionary on postings payloads and compress with it
+        
+        The dictionary is stored in the zstd_dicts table (in the caller's
+        transaction, if any); blobs written earlier keep decompressing with
+        whatever they were written with.
+        
+        Returns:
+            True if a dictionary was trained
+        """
+        samples = [sample[:_DICT_SAMPLE_BYTES] for sample in samples if sample]
+        try:
+            trained = zstd.train_dictionary(ZSTD_DICT_SIZE, samples, level=COMPRESSION_LEVEL)
+        except zstd.ZstdError as e:
+            logger.warning(f"zstd dictionary training failed, compressing without: {e}")
+            self.use_dictionary = False
+            return False
+        
+        data = trained.as_bytes()
+        dict_id = trained.dict_id()
+        self.db.execute(
+            "INSERT OR REPLACE INTO zstd_dicts (dict_id, data) VALUES (?, ?)",
+            (dict_id, data)
+        )
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('zstd_dict_id', ?)",
+            (dict_id,)
+        )
+        self._set_dictionary(dict_id, data)
+        
+        logger.info(f"Trained zstd dictionary {dict_id} ({len(data)} bytes) on {len(samples)} postings")
+        return True
+    
     def build_chunks_and_postings(
         self,
-        file_id: str,
+        doc_id: int,
         text: str,
         pages: List[Dict]
     ) -> Tuple[List[Dict], Dict[str, List[int]]]:
@@ -52,115 +1185,1067 @@ class IndexBuilder:
         Build chunks and postings for a file
         
         Args:
-            file_id: File identifier
+            doc_id: Document id
             text: Full text content
             pages: Page information
-            
+        
         Returns:
             (chunks, postings_map)
         """
-        text = clean_text(text)
-        chunks = []
-        postings = {}
+        return build_chunks_and_postings(doc_id, text, pages, self.chunk_size)
+    
+    def _get_page_for_offset(self, pages: List[Dict], offset: int) -> int:
+        """Get page number for text offset"""
+        return get_page_for_offset(pages, offset)
+    
+    def register_files(self, paths: List[str]) -> Dict[str, int]:
+        """
+        Give every file a doc id (kept across runs)
         
-        # Safe file ID for Meilisearch
-        safe_file_id = file_id.replace('.', '_').replace('/', '_')[:50]
+        Files seen before keep their doc id; new files get a files row with
+        path and title. Size, mtime and (with content_hash) the content hash
+        are recorded for every file, so diff_files() compares against the
+        version being indexed now. The page count is filled in when the
+        file's postings are flushed.
         
-        chunk_id = 0
-        for start in range(0, len(text), CHUNK_SIZE):
-            end = min(len(text), start + CHUNK_SIZE)
-            chunk_text = text[start:end]
-            
-            # Find page number for this chunk
-            page_num = self._get_page_for_offset(pages, start)
-            
-            # Create chunk
-            chunks.append({
-                'id': f"{safe_file_id}_{chunk_id}",
-                'fileId': file_id,
-                'safeFileId': safe_file_id,
-                'chunkId': chunk_id,
-                'chunkStart': start,
-                'pageNum': page_num,
-                'text': chunk_text[:200]  # Only first 200 chars for preview
-            })
+        Returns:
+            {path: doc_id}
+        """
+        doc_ids = {}
+        
+        with self.lock, self.db:
+            for i in range(0, len(paths), DB_BATCH_SIZE):
+                batch = paths[i:i + DB_BATCH_SIZE]
+                self.db.executemany(
+                    """
+                    INSERT INTO files (path, title, size, mtime, content_hash)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(path) DO UPDATE SET
+                        size = excluded.size,
+                        mtime = excluded.mtime,
+                        content_hash = excluded.content_hash
+                    """,
+                    (
+                        (path, file_title(path), *_file_stats(path, self.content_hash))
+                        for path in batch
+                    )
+                )
+                placeholders = ','.join('?' * len(batch))
+                doc_ids.update(self.db.execute(
+                    f"SELECT path, doc_id FROM files WHERE path IN ({placeholders})",
+                    batch
+                ))
+        
+        return doc_ids
+    
+    def diff_files(self, paths: List[str]) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Compare files on disk with the files table
+        
+        A file changed if its size or mtime differ from the recorded ones.
+        With content_hash, a file whose stats differ but whose contents hash
+        the same is not changed - its stats are refreshed instead. Rows
+        recorded before mtimes were stored are compared by size only, rows
+        recorded before paths were stored get theirs first (see
+        _adopt_legacy_rows).
+        
+        Args:
+            paths: All files of the library
+        
+        Returns:
+            (new paths, changed paths, deleted paths)
+        """
+        merged = self._adopt_legacy_rows(paths)
+        
+        recorded = {
+            path: (size, mtime, content_hash)
+            for path, size, mtime, content_hash in self.db.execute(
+                "SELECT path, size, mtime, content_hash FROM files WHERE path IS NOT NULL"
+            )
+        }
+        
+        new, changed, refreshed = [], [], []
+        for path in paths:
+            if path not in recorded:
+                new.append(path)
+                continue
+            if path in merged:
+                changed.append(path)
+                continue
             
-            # Tokenize and build postings
-            tokens = tokenize_with_offsets(chunk_text)
-            for token, offset, length in tokens:
-                if token not in postings:
-                    postings[token] = []
-                postings[token].append(start + offset)
+            size, mtime, content_hash = recorded[path]
+            current_size, current_mtime, _ = _file_stats(path)
+            if current_size == size and (mtime is None or current_mtime == mtime):
+                if mtime is None:
+                    refreshed.append((current_size, current_mtime, content_hash, path))
+                continue
             
-            chunk_id += 1
+            if self.content_hash and content_hash is not None and current_size == size:
+                current_hash = file_hash(path)
+                if current_hash == content_hash:
+                    refreshed.append((current_size, current_mtime, current_hash, path))
+                    continue
+            changed.append(path)
         
-        logger.debug(f"Built {len(chunks)} chunks, {len(postings)} unique words for {file_id}")
+        if refreshed:
+            with self.db:
+                self.db.executemany(
+                    "UPDATE files SET size = ?, mtime = ?, content_hash = ? WHERE path = ?",
+                    refreshed
+                )
         
-        return chunks, postings
+        found = set(paths)
+        deleted = [path for path in recorded if path not in found]
+        return new, changed, deleted
     
-    def _get_page_for_offset(self, pages: List[Dict], offset: int) -> int:
-        """Get page number for text offset"""
-        if not pages:
-            return 1
+    def _adopt_legacy_rows(self, paths: List[str]) -> Set[str]:
+        """
+        Give files rows without a path (indexes built or migrated before
+        paths were recorded) the file they belong to
+        
+        Legacy rows are keyed by title. A title matching one unregistered
+        file gets its path, size and mtime - edits made before this first
+        incremental build can't be told from the indexed version, later
+        ones are detected. A title shared by several files was indexed as
+        one merged document; it goes to the first of them, which is then
+        reported changed so the merged postings are replaced.
+        
+        Returns:
+            Paths whose row holds such a merged document
+        """
+        legacy = self.db.execute(
+            "SELECT doc_id, title FROM files WHERE path IS NULL AND title IS NOT NULL"
+        ).fetchall()
+        if not legacy:
+            return set()
+        
+        registered = set(self.get_doc_ids(paths))
+        by_title = {}
+        for path in paths:
+            if path not in registered:
+                by_title.setdefault(file_title(path), []).append(path)
         
-        for page in pages:
-            if page['start_offset'] <= offset < page['end_offset']:
-                return page['page_num']
+        updates = []
+        merged = set()
+        for doc_id, title in legacy:
+            candidates = by_title.pop(title, None)
+            if not candidates:
+                continue
+            path = candidates[0]
+            updates.append((path, *_file_stats(path, self.content_hash), doc_id))
+            if len(candidates) > 1:
+                merged.add(path)
+        
+        if updates:
+            with self.lock, self.db:
+                self.db.executemany(
+                    "UPDATE files SET path = ?, size = ?, mtime = ?, content_hash = ? WHERE doc_id = ?",
+                    updates
+                )
+        logger.info(f"Matched {len(updates)} of {len(legacy)} files rows without a path to files by title")
+        return merged
+    
+    def get_doc_ids(self, paths: List[str]) -> Dict[str, int]:
+        """{path: doc_id} of registered files"""
+        doc_ids = {}
+        for i in range(0, len(paths), DB_BATCH_SIZE):
+            batch = paths[i:i + DB_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            doc_ids.update(self.db.execute(
+                f"SELECT path, doc_id FROM files WHERE path IN ({placeholders})",
+                batch
+            ))
+        return doc_ids
+    
+    def unregister_files(self, doc_ids: Iterable[int]):
+        """Delete files rows (after remove_documents)"""
+        with self.db:
+            self.db.executemany("DELETE FROM files WHERE doc_id = ?", ((doc_id,) for doc_id in doc_ids))
+    
+    def get_files(self) -> Dict[int, Dict]:
+        """{doc_id: {'path', 'title', 'page_count', 'size'}}"""
+        return {
+            doc_id: {'path': path, 'title': title, 'page_count': page_count, 'size': size}
+            for doc_id, path, title, page_count, size in self.db.execute(
+                "SELECT doc_id, path, title, page_count, size FROM files"
+            )
+        }
+    
+    def get_titles(self) -> Dict[int, str]:
+        """{doc_id: title}"""
+        return dict(self.db.execute("SELECT doc_id, title FROM files"))
+    
+    def _set_page_counts(self, page_counts: Dict[int, int]):
+        self.db.executemany(
+            "UPDATE files SET page_count = ? WHERE doc_id = ?",
+            ((count, doc_id) for doc_id, count in page_counts.items() if count is not None)
+        )
+    
+    def set_page_table(self, doc_id: int, page_table: PageTable):
+        """Record a document's PageTable, written when its postings are flushed"""
+        self._page_tables[doc_id] = page_table.encode()
+    
+    def _set_page_tables(self, doc_ids: Iterable[int]):
+        self.db.executemany(
+            "UPDATE files SET page_offsets = ? WHERE doc_id = ?",
+            [
+                (self._page_tables.pop(doc_id), doc_id)
+                for doc_id in doc_ids if doc_id in self._page_tables
+            ]
+        )
+    
+    def get_page_table(self, doc_id: int) -> Optional[PageTable]:
+        """PageTable of a document (None if it was indexed without one)"""
+        return _read_page_table(self.db, doc_id)
+    
+    def set_word_sequence(self, doc_id: int, sequence: bytes):
+        """Record a document's encode_word_sequence(), written when its postings are flushed"""
+        self._word_sequences[doc_id] = sequence
+    
+    def _set_word_sequences(self, doc_ids: Iterable[int]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO sequences (doc_id, words) VALUES (?, ?)",
+            [
+                (doc_id, self._word_sequences.pop(doc_id))
+                for doc_id in doc_ids if doc_id in self._word_sequences
+            ]
+        )
+    
+    def _doc_id_for_title(self, title: str) -> int:
+        """Doc id for a legacy postings key (file name without extension)"""
+        row = self.db.execute(
+            "SELECT doc_id FROM files WHERE title = ? ORDER BY doc_id LIMIT 1", (title,)
+        ).fetchone()
+        if row:
+            return row[0]
+        return self.db.execute("INSERT INTO files (title) VALUES (?)", (title,)).lastrowid
+    
+    def _upgrade_payload(self, payload: bytes) -> bytes:
+        """Legacy payload keyed by file name -> format 3 payload keyed by doc id"""
+        if payload[0] == POSTINGS_FORMAT_DOC_IDS:
+            return payload
         
-        return pages[-1]['page_num']
+        doc_postings = {}
+        for title, offsets in decode_postings_payload(payload).items():
+            doc_id = self._doc_id_for_title(title)
+            doc_postings[doc_id] = sorted(doc_postings.get(doc_id, []) + offsets)
+        return encode_postings(doc_postings)
     
     def append_chunks(self, chunks: List[Dict]):
-        """Append chunks to JSONL file"""
-        with open(self.chunks_path, 'a', encoding='utf-8') as f:
-            for chunk in chunks:
-                f.write(json.dumps(chunk, ensure_ascii=False) + '\n')
+        """
+        Append chunks to JSONL file
+        
+        All chunks of a document must be appended in one call - their byte
+        range is what remove_documents() blanks out.
+        """
+        data = ''.join(json.dumps(chunk, ensure_ascii=False) + '\n' for chunk in chunks).encode('utf-8')
+        with open(self.chunks_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+        
+        if chunks and 'docId' in chunks[0]:
+            self._chunk_ranges[chunks[0]['docId']] = (offset, len(data))
+    
+    def remove_document(self, doc_id: int) -> int:
+        """Remove a document's postings and chunks, see remove_documents()"""
+        return self.remove_documents([doc_id])
     
-    def flush_postings(self, postings_map: Dict[str, Dict[str, List[int]]]):
+    def replace_document(
+        self,
+        doc_id: int,
+        chunks: List[Dict],
+        postings: Dict[str, List[int]],
+        page_count: int = None,
+        page_table: Optional[PageTable] = None,
+        sequence: Optional[List[str]] = None
+    ):
         """
-        Flush postings to database
+        Replace a document's postings and chunks with a new version
         
         Args:
-            postings_map: {word: {file_id: [offsets]}}
+            doc_id: Doc id from the files table
+            chunks: New chunks (build_chunks_and_postings)
+            postings: New {word: [offsets]}
+            page_count: Page count of the new version
+            page_table: PageTable of the new version
+            sequence: Words of the new version in text order
         """
-        cursor = self.db.cursor()
+        self.remove_documents([doc_id])
+        self.append_chunks(chunks)
+        if page_table is not None:
+            self.set_page_table(doc_id, page_table)
+        if sequence is not None:
+            self.set_word_sequence(doc_id, encode_word_sequence(sequence))
+        self.flush_postings(
+            {word: {doc_id: offsets} for word, offsets in postings.items()},
+            {doc_id: page_count}
+        )
+    
+    def remove_documents(self, doc_ids: Iterable[int]) -> int:
+        """
+        Remove documents' postings and chunks
+        
+        The forward index names the words of each document, so only their
+        posts rows are rewritten without the documents (or deleted if
+        nothing is left). Documents flushed before the forward index
+        existed fall back to a scan of all posts rows. Pending runs are
+        merged first so no postings of the documents stay behind in them.
+        
+        The documents' lines in chunks.jsonl are blanked out in place; the
+        file is compacted once blanks take up a quarter of it. The files
+        rows are kept - see unregister_files().
+        
+        Args:
+            doc_ids: Doc ids to remove
+        
+        Returns:
+            Number of posts rows rewritten or deleted
+        """
+        doc_ids = set(doc_ids)
+        if not doc_ids:
+            return 0
+        
+        terms = self._get_forward(doc_ids)
+        unindexed = doc_ids - set(terms)
+        if unindexed:
+            logger.info(f"{len(unindexed)} documents have no forward index - scanning all words")
+        words = sorted(set().union(*terms.values()))
+        
+        # The postings go first: if the forward index went first, a crash
+        # in between would leave postings nothing points to any more
+        if self.shards:
+            touched = self.shards.remove_postings(doc_ids, words, unindexed)
+        else:
+            touched = self.remove_postings(doc_ids, words, unindexed)
+        
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM forward WHERE doc_id = ?", ((doc_id,) for doc_id in doc_ids)
+            )
+            self.db.executemany(
+                "DELETE FROM sequences WHERE doc_id = ?", ((doc_id,) for doc_id in doc_ids)
+            )
+            self._remove_chunks(doc_ids)
+        
+        logger.info(f"Removed {len(doc_ids)} documents from {touched} words")
+        return touched
+    
+    def remove_postings(self, doc_ids: Set[int], words: List[str], scan_doc_ids: Set[int] = frozenset()) -> int:
+        """
+        Remove documents from the posts rows of the given words
+        
+        Pending runs are merged first so no postings of the documents stay
+        behind in them.
+        
+        Args:
+            doc_ids: Doc ids to remove
+            words: Words of the documents (forward index)
+            scan_doc_ids: Documents whose words aren't known - all posts
+                          rows are scanned for them
         
-        for word, file_postings in postings_map.items():
-            # Get existing postings
-            cursor.execute("SELECT postings FROM posts WHERE word = ?", (word,))
-            row = cursor.fetchone()
+        Returns:
+            Number of posts rows rewritten or deleted
+        """
+        if self.pending_runs():
+            self.merge_runs()
+        
+        touched = 0
+        with self.db:
+            for i in range(0, len(words), DB_BATCH_SIZE):
+                batch = words[i:i + DB_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = self.db.execute(
+                    f"SELECT rowid, postings FROM posts WHERE word IN ({placeholders})",
+                    batch
+                ).fetchall()
+                touched += self._remove_postings(rows, doc_ids)
             
-            if row:
-                # Merge with existing
-                existing_data = self._decompress(row[0])
-                existing = json.loads(existing_data)
-                
-                for file_id, offsets in file_postings.items():
-                    if file_id in existing:
-                        existing[file_id].extend(offsets)
-                        existing[file_id].sort()
-                        existing[file_id] = self._delta_encode(existing[file_id])
-                    else:
-                        existing[file_id] = self._delta_encode(sorted(offsets))
+            if scan_doc_ids:
+                last_rowid = 0
+                while True:
+                    rows = self.db.execute(
+                        "SELECT rowid, postings FROM posts WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                        (last_rowid, DB_BATCH_SIZE)
+                    ).fetchall()
+                    if not rows:
+                        break
+                    last_rowid = rows[-1][0]
+                    touched += self._remove_postings(rows, scan_doc_ids)
+        
+        return touched
+    
+    def _remove_postings(self, rows: List[Tuple[int, bytes]], doc_ids: Set[int]) -> int:
+        """Rewrite (rowid, blob) posts rows without the documents"""
+        updates = []
+        deletes = []
+        for (rowid, _), payload in zip(rows, self._decompress_many([blob for _, blob in rows])):
+            payload = self._upgrade_payload(payload)
+            remaining = remove_postings_docs(payload, doc_ids)
+            if len(remaining) == len(payload):
+                continue  # none of the docs
+            if len(remaining) > 1:
+                updates.append((rowid, remaining))
+            else:
+                deletes.append((rowid,))
+        
+        if updates:
+            self.db.executemany(
+                "UPDATE posts SET postings = ? WHERE rowid = ?",
+                zip(self._compress_many([payload for _, payload in updates]),
+                    (rowid for rowid, _ in updates))
+            )
+        if deletes:
+            self.db.executemany("DELETE FROM posts WHERE rowid = ?", deletes)
+        return len(updates) + len(deletes)
+    
+    def _write_forward(self, postings: PostingsAccumulator):
+        """Record the words of each flushed document"""
+        terms = postings.doc_words()
+        if not terms:
+            return
+        
+        # A document flushed again (replace_document) keeps its older words
+        for doc_id, words in self._get_forward(terms).items():
+            terms[doc_id].extend(words)
+        
+        self.db.executemany(
+            "INSERT OR REPLACE INTO forward (doc_id, terms) VALUES (?, ?)",
+            (
+                (doc_id, self._compress_terms(sorted(set(words))))
+                for doc_id, words in terms.items()
+            )
+        )
+    
+    def update_word_tables(self) -> int:
+        """
+        Bring the gematria and variants tables up to date with posts
+        
+        Called once at the end of a build, after merge_runs(). The lexicon
+        table lists the words the tables were filled for: only words of
+        posts missing from it get their gematria values and stems computed,
+        and words no longer in posts (removed documents) are dropped. A
+        sharded index reads the words of its shards' posts.
+        
+        Returns:
+            Number of words added or removed
+        """
+        if not GEMATRIA_INDEX and not PREFIX_VARIANTS:
+            return 0
+        
+        sources = self.shards.connect_posts() if self.shards else [self.db]
+        changed = 0
+        try:
+            with self.lock, self.db:  # one transaction
+                for source in sources:
+                    for words in _iter_word_batches(source, 'posts'):
+                        known = _select_words(self.db, 'lexicon', words)
+                        added = [word for word in words if word not in known]
+                        if added:
+                            self._write_word_tables(added)
+                            changed += len(added)
                 
-                merged = existing
+                for words in _iter_word_batches(self.db, 'lexicon'):
+                    removed = set(words)
+                    for source in sources:
+                        removed -= _select_words(source, 'posts', list(removed))
+                        if not removed:
+                            break
+                    if removed:
+                        self._remove_word_tables(list(removed))
+                        changed += len(removed)
+        finally:
+            if self.shards:
+                for source in sources:
+                    source.close()
+        
+        logger.info(f"Updated gematria/variants tables: {changed} words")
+        return changed
+    
+    def _write_word_tables(self, words: List[str]):
+        """Record the gematria values and prefix-stripped stems of new words"""
+        if GEMATRIA_INDEX:
+            rows = []
+            for word in words:
+                values = gematria_values(word)
+                if values:
+                    rows.extend(zip(range(len(values)), values, repeat(word)))
+            self.db.executemany("INSERT OR IGNORE INTO gematria (method, value, word) VALUES (?, ?, ?)", rows)
+        if PREFIX_VARIANTS:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO variants (stem, word) VALUES (?, ?)",
+                [(stem, word) for word in words for stem in prefix_stems(word)]
+            )
+        self.db.executemany("INSERT OR IGNORE INTO lexicon (word) VALUES (?)", ((word,) for word in words))
+    
+    def _remove_word_tables(self, words: List[str]):
+        """Drop the gematria and variants rows of words no longer indexed"""
+        self.db.executemany(
+            "DELETE FROM gematria WHERE method = ? AND value = ? AND word = ?",
+            [
+                (method, value, word)
+                for word in words for method, value in enumerate(gematria_values(word) or ())
+            ]
+        )
+        self.db.executemany(
+            "DELETE FROM variants WHERE stem = ? AND word = ?",
+            [(stem, word) for word in words for stem in prefix_stems(word)]
+        )
+        self.db.executemany("DELETE FROM lexicon WHERE word = ?", ((word,) for word in words))
+    
+    def _get_forward(self, doc_ids: Iterable[int]) -> Dict[int, List[str]]:
+        """{doc_id: words} of documents with a forward index entry"""
+        doc_ids = list(doc_ids)
+        terms = {}
+        for i in range(0, len(doc_ids), DB_BATCH_SIZE):
+            batch = doc_ids[i:i + DB_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            for doc_id, blob in self.db.execute(
+                f"SELECT doc_id, terms FROM forward WHERE doc_id IN ({placeholders})", batch
+            ):
+                data = self.decompressor.decompress(blob) if USE_COMPRESSION else blob
+                terms[doc_id] = data.decode('utf-8').split('\0') if data else []
+        return terms
+    
+    def _compress_terms(self, words: List[str]) -> bytes:
+        data = '\0'.join(words).encode('utf-8')
+        # Not compressed with the postings dictionary - it was trained on postings
+        return self._terms_compressor.compress(data) if USE_COMPRESSION else data
+    
+    def _set_chunk_ranges(self, doc_ids: Iterable[int]):
+        """Record the chunks.jsonl byte ranges of flushed documents"""
+        ranges = [
+            (*self._chunk_ranges.pop(doc_id), doc_id)
+            for doc_id in doc_ids if doc_id in self._chunk_ranges
+        ]
+        if not ranges:
+            return
+        
+        self.db.executemany(
+            "UPDATE files SET chunks_offset = ?, chunks_length = ? WHERE doc_id = ?", ranges
+        )
+        
+        # Documents are appended in flush order - everything before the end
+        # of this flush's last chunks belongs to committed documents
+        end = max(offset + length for offset, length, _ in ranges)
+        self._set_meta('chunks_committed_bytes', max(end, self._get_meta('chunks_committed_bytes', 0)))
+    
+    def _remove_chunks(self, doc_ids: Set[int]):
+        """Blank out the documents' lines in chunks.jsonl"""
+        if not os.path.exists(self.chunks_path):
+            return
+        
+        rows = []
+        doc_id_list = list(doc_ids)
+        for i in range(0, len(doc_id_list), DB_BATCH_SIZE):
+            batch = doc_id_list[i:i + DB_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            rows.extend(self.db.execute(
+                f"SELECT doc_id, chunks_offset, chunks_length FROM files WHERE doc_id IN ({placeholders})",
+                batch
+            ))
+        ranges = [(offset, length) for _, offset, length in rows if offset is not None]
+        
+        # Chunks written before ranges were recorded have to be searched for
+        if len(ranges) < len(doc_ids):
+            self._compact_chunks(doc_ids)
+            return
+        
+        blanked = 0
+        with open(self.chunks_path, 'r+b') as f:
+            for offset, length in ranges:
+                f.seek(offset)
+                data = f.read(length)
+                f.seek(offset)
+                # Keep the newlines, so line-based readers just see blank lines
+                f.write(b'\n'.join(b' ' * len(line) for line in data.split(b'\n')))
+                blanked += length
+            f.flush()
+            os.fsync(f.fileno())
+        
+        self.db.executemany(
+            "UPDATE files SET chunks_offset = NULL, chunks_length = NULL WHERE doc_id = ?",
+            ((doc_id,) for doc_id in doc_ids)
+        )
+        blank_bytes = self._get_meta('chunks_blank_bytes', 0) + blanked
+        self._set_meta('chunks_blank_bytes', blank_bytes)
+        
+        if blank_bytes * 4 > os.path.getsize(self.chunks_path):
+            self._compact_chunks()
+    
+    def _compact_chunks(self, doc_ids: Set[int] = frozenset()):
+        """
+        Rewrite chunks.jsonl without blank lines and the documents' chunks
+        
+        The byte ranges of all remaining documents are recorded anew.
+        """
+        # Chunks written before doc ids refer to their file by title
+        titles = set()
+        doc_id_list = list(doc_ids)
+        for i in range(0, len(doc_id_list), DB_BATCH_SIZE):
+            batch = doc_id_list[i:i + DB_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            titles.update(
+                title for (title,) in self.db.execute(
+                    f"SELECT title FROM files WHERE doc_id IN ({placeholders})", batch
+                )
+            )
+        
+        ranges = {}
+        tmp_path = self.chunks_path + '.tmp'
+        with open(self.chunks_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            offset = 0
+            for line in src:
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                doc_id = chunk.get('docId')
+                if doc_id is None:
+                    if chunk.get('fileId') in titles:
+                        continue
+                elif doc_id in doc_ids:
+                    continue
+                else:
+                    start, _ = ranges.get(doc_id, (offset, 0))
+                    ranges[doc_id] = (start, offset + len(line) - start)
+                dst.write(line)
+                offset += len(line)
+            dst.flush()
+            os.fsync(dst.fileno())
+        
+        os.replace(tmp_path, self.chunks_path)
+        
+        self.db.execute("UPDATE files SET chunks_offset = NULL, chunks_length = NULL")
+        self.db.executemany(
+            "UPDATE files SET chunks_offset = ?, chunks_length = ? WHERE doc_id = ?",
+            ((start, length, doc_id) for doc_id, (start, length) in ranges.items())
+        )
+        self._set_meta('chunks_blank_bytes', 0)
+        self._set_meta('chunks_committed_bytes', offset)
+    
+    def flush_postings(
+        self,
+        postings_map: Union[PostingsAccumulator, Dict[str, Dict[int, List[int]]]],
+        page_counts: Dict[int, int] = None,
+        in_transaction: Optional[Callable[[], None]] = None
+    ):
+        """
+        Flush postings to database
+        
+        Existing rows are fetched DB_BATCH_SIZE words at a time, merged in
+        memory and written back with executemany(), all in one transaction.
+        Blobs of a batch are (de)compressed in a single zstd call.
+        
+        In 'runs' build mode the postings are written to a sorted run
+        instead, see merge_runs(). The run only counts once the transaction
+        recording it commits - see discard_uncommitted(). From then on
+        PostingsReader sees it, and the background merger may compact it.
+        
+        A sharded index writes the run of every shard in the shard's own
+        process. In 'merge' build mode the shards then apply their runs to
+        their posts tables in the background, while the next batch is
+        being prepared.
+        
+        Args:
+            postings_map: PostingsAccumulator or {word: {doc_id: [offsets]}}
+            page_counts: {doc_id: page count} of the flushed files
+            in_transaction: Called inside the flush transaction, so its
+                            writes (CheckpointManager.record_processed)
+                            commit or roll back together with the postings
+        """
+        postings_map = PostingsAccumulator.from_map(postings_map)
+        
+        if self.shards:
+            number = self._get_meta('runs_committed_through', 0) + 1
+            self.shards.write_run(postings_map, number)
+            with self.lock, self.db:
+                self._set_meta('runs_committed_through', number)
+                self._commit_flush(postings_map, page_counts, in_transaction)
+            if self.build_mode == 'merge':
+                self.shards.apply_runs(number, wait=False)
             else:
-                # New word
-                merged = {
-                    file_id: self._delta_encode(sorted(offsets))
-                    for file_id, offsets in file_postings.items()
-                }
+                self.shards.commit_runs(number)
+            return
+        
+        if self.build_mode == 'runs':
+            _, number = run_range(self.write_run(postings_map))
+            with self.lock, self.db:
+                self._set_meta('runs_committed_through', number)
+                self._commit_flush(postings_map, page_counts, in_transaction)
+            if self.merger:
+                self.merger.notify()
+            return
+        
+        # Key order keeps B-tree page access sequential
+        items = postings_map.sorted_items()
+        
+        with self.lock, self.db:  # one transaction per flush
+            while True:
+                batch = list(islice(items, DB_BATCH_SIZE))
+                if not batch:
+                    break
+                existing = self._fetch_postings([word for word, _ in batch])
+                
+                payloads = []
+                for word, new_postings in batch:
+                    payload = existing.get(word)
+                    if payload is not None:
+                        payload = self._upgrade_payload(payload)
+                    payloads.append(append_postings(payload, new_postings))
+                
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO posts (word, postings) VALUES (?, ?)",
+                    zip([word for word, _ in batch], self._compress_many(payloads))
+                )
             
-            # Compress and store
-            data = json.dumps(merged, ensure_ascii=False)
-            compressed = self._compress(data)
+            self._commit_flush(postings_map, page_counts, in_transaction)
+        
+        logger.debug(f"Flushed {len(postings_map)} words to database")
+    
+    def _commit_flush(
+        self,
+        postings_map: PostingsAccumulator,
+        page_counts: Optional[Dict[int, int]],
+        in_transaction: Optional[Callable[[], None]]
+    ):
+        """Everything but the postings that a flush writes, inside its transaction"""
+        self._write_forward(postings_map)
+        if page_counts:
+            self._set_page_counts(page_counts)
+            self._set_chunk_ranges(page_counts)
+            self._set_page_tables(page_counts)
+            self._set_word_sequences(page_counts)
+        if in_transaction:
+            in_transaction()
+    
+    def discard_uncommitted(self):
+        """
+        Drop what an interrupted build wrote after its last committed flush
+        
+        Chunks are appended to chunks.jsonl and runs are written before the
+        flush transaction that records them. After a crash, chunks.jsonl is
+        truncated to the end of the last committed document's chunks and
+        newer runs are deleted, so resuming re-processes exactly the files
+        the checkpoint doesn't list. Call before a build, never during one.
+        """
+        # Half-written compactions
+        if os.path.exists(self.chunks_path + '.tmp'):
+            os.remove(self.chunks_path + '.tmp')
+        
+        committed_runs = self._get_meta('runs_committed_through')
+        if self.shards:
+            # Runs of the flush that was cut short may exist in some shards
+            self.shards.discard_runs(committed_runs or 0)
+            if self.build_mode == 'merge':
+                self.shards.apply_runs(committed_runs or 0)
+        else:
+            self.discard_runs(committed_runs)
+        
+        committed_bytes = self._get_meta('chunks_committed_bytes')
+        if committed_bytes is not None and os.path.exists(self.chunks_path):
+            size = os.path.getsize(self.chunks_path)
+            if size > committed_bytes:
+                logger.warning(f"Removing {size - committed_bytes} bytes of uncommitted chunks")
+                with open(self.chunks_path, 'r+b') as f:
+                    f.truncate(committed_bytes)
+    
+    def discard_runs(self, committed_through: Optional[int]):
+        """
+        Delete half-written runs and runs of flushes after committed_through
+        (None = only half-written ones), see discard_uncommitted()
+        """
+        if not os.path.isdir(self.runs_dir):
+            return
+        
+        with self._runs_locked():
+            for name in os.listdir(self.runs_dir):
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(self.runs_dir, name))
             
-            cursor.execute(
-                "INSERT OR REPLACE INTO posts (word, postings) VALUES (?, ?)",
-                (word, compressed)
+            if committed_through is None:
+                return
+            for first, _, path in list_runs(self.runs_dir):
+                if first > committed_through:
+                    logger.warning(f"Removing uncommitted run {os.path.basename(path)}")
+                    os.remove(path)
+    
+    def commit_runs(self, through: int):
+        """
+        Record that runs up to flush number through were committed
+        
+        Shards in 'runs' build mode get this from the main index after each
+        flush, so their background merger may compact those runs.
+        """
+        with self.lock, self.db:
+            self._set_meta('runs_committed_through', through)
+        if self.merger:
+            self.merger.notify()
+    
+    def _get_committed_runs(self) -> int:
+        with self.lock:
+            return self._get_meta('runs_committed_through', 0)
+    
+    def _runs_locked(self):
+        """Keep the background merger off the runs while they are changed"""
+        return self.merger.lock if self.merger else nullcontext()
+    
+    def reset(self):
+        """
+        Delete all postings, chunks and runs to rebuild from scratch
+        
+        Files keep their doc ids; the zstd dictionary is kept. A sharded
+        index is re-created with the requested number of shards, and the
+        index switches to the current tokenizer.
+        """
+        self.reset_postings()
+        with self.db:
+            self.db.execute("DELETE FROM forward")
+            self.db.execute("DELETE FROM gematria")
+            self.db.execute("DELETE FROM variants")
+            self.db.execute("DELETE FROM lexicon")
+            self.db.execute("DELETE FROM sequences")
+            self.db.execute(
+                "UPDATE files SET page_count = NULL, chunks_offset = NULL, chunks_length = NULL, "
+                "page_offsets = NULL"
             )
+            self.db.execute(
+                "DELETE FROM meta WHERE key IN ('chunks_committed_bytes', 'chunks_blank_bytes')"
+            )
+            self._set_meta('tokenizer', TOKENIZER)
+        self.tokenizer = TOKENIZER
         
-        self.db.commit()
-        logger.debug(f"Flushed {len(postings_map)} words to database")
+        shard_count = self.requested_shards
+        if self.shards and self.shards.shard_count != shard_count:
+            self.shards.destroy()
+            self.shards = None
+        if self.shards:
+            self.shards.reset_postings()
+        elif shard_count:
+            self._open_shards(shard_count)
+        
+        open(self.chunks_path, 'wb').close()
+        
+        logger.info("Index reset")
+    
+    def reset_postings(self):
+        """Delete the posts rows and runs"""
+        with self._runs_locked():
+            with self.db:
+                self.db.execute("DELETE FROM posts")
+                self.db.execute(
+                    "DELETE FROM meta WHERE key IN ('runs_merged_through', 'runs_committed_through')"
+                )
+            for _, _, path in list_runs(self.runs_dir):
+                os.remove(path)
+    
+    def _fetch_postings(self, words: List[str]) -> Dict[str, bytes]:
+        """Get stored (decompressed) payloads for a batch of words"""
+        placeholders = ','.join('?' * len(words))
+        rows = self.db.execute(
+            f"SELECT word, postings FROM posts WHERE word IN ({placeholders})",
+            words
+        ).fetchall()
+        
+        payloads = self._decompress_many([blob for _, blob in rows])
+        return {word: payload for (word, _), payload in zip(rows, payloads)}
+    
+    def pending_runs(self) -> List[Tuple[int, int, str]]:
+        """Runs not merged into posts yet, as (first, last, path), oldest first"""
+        if self.shards:
+            return self.shards.pending_runs()
+        merged_through = self._get_meta('runs_merged_through', 0)
+        return [run for run in list_runs(self.runs_dir) if run[1] > merged_through]
+    
+    def write_run(
+        self,
+        postings_map: Union[PostingsAccumulator, Dict[str, Dict[int, List[int]]]],
+        number: int = None
+    ) -> str:
+        """
+        Write postings to a new sorted run file
+        
+        Args:
+            postings_map: PostingsAccumulator or {word: {doc_id: [offsets]}}
+            number: Flush number of the run (default: the next one)
+        
+        Returns:
+            Path of the run
+        """
+        os.makedirs(self.runs_dir, exist_ok=True)
+        
+        if number is None:
+            last = max([run[1] for run in list_runs(self.runs_dir)], default=0)
+            number = max(last, self._get_meta('runs_merged_through', 0)) + 1
+        path = os.path.join(self.runs_dir, run_name(number, number))
+        
+        records = (
+            (word, encode_postings_block(doc_postings))
+            for word, doc_postings in PostingsAccumulator.from_map(postings_map).sorted_items()
+        )
+        count = write_run(path, records)
+        
+        logger.debug(f"Wrote {count} words to {path}")
+        return path
+    
+    def merge_runs(self) -> int:
+        """
+        K-way merge pending runs and the current posts into a new posts table
+        
+        Rows are inserted in key order into a freshly created table, so the
+        result is compact and ordered without VACUUM. Postings blocks are
+        concatenated, never decoded. More than MERGE_FAN_IN runs are first
+        merged into bigger runs. The background merger waits meanwhile.
+        
+        Returns:
+            Number of words in posts (0 if there was nothing to merge)
+        """
+        if self.shards:
+            # All shards merge at once, each in its own process
+            return self.shards.merge_runs()
+        
+        with self._runs_locked():
+            return self._merge_runs()
+    
+    def _merge_runs(self) -> int:
+        runs = self.pending_runs()
+        if not runs:
+            return 0
+        
+        while len(runs) > MERGE_FAN_IN:
+            group = runs[:MERGE_FAN_IN]
+            logger.info(f"Merging {len(group)} runs...")
+            merge_run_files(self.runs_dir, group)
+            runs = self.pending_runs()
+        
+        logger.info(f"Merging {len(runs)} runs into posts...")
+        
+        self.db.execute("DROP TABLE IF EXISTS posts_new")
+        self.db.execute("""
+            CREATE TABLE posts_new (
+                word TEXT PRIMARY KEY,
+                postings BLOB
+            )
+        """)
+        
+        header = bytes([POSTINGS_FORMAT_DOC_IDS])
+        sources = [self._iter_stored_blocks()] + [iter_run(path) for _, _, path in runs]
+        words = 0
+        batch = []
+        
+        for word, blocks in merge_sorted(sources):
+            batch.append((word, header + b''.join(blocks)))
+            if len(batch) >= DB_BATCH_SIZE:
+                self._insert_merged(batch)
+                words += len(batch)
+                batch = []
+        if batch:
+            self._insert_merged(batch)
+            words += len(batch)
+        
+        # Swap tables and record the merged runs in one transaction
+        with self.db:
+            self.db.execute("DROP TABLE posts")
+            self.db.execute("ALTER TABLE posts_new RENAME TO posts")
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('runs_merged_through', ?)",
+                (runs[-1][1],)
+            )
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        
+        for _, _, path in runs:
+            os.remove(path)
+        
+        # Only a non-empty posts table replaced by the merge leaves free pages
+        free_pages = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        total_pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        if free_pages > total_pages // 10:
+            self.vacuum()
+        
+        logger.info(f"Merged {len(runs)} runs: {words} words")
+        return words
+    
+    def apply_runs(self, through: int = None) -> int:
+        """
+        Merge pending runs into posts in place, oldest first
+        
+        Unlike merge_runs() the posts table isn't rebuilt: every run's
+        blocks are appended to the stored payloads, like a merge mode
+        flush. Shards in merge build mode write each flush as a run and
+        apply it once the main index committed the flush.
+        
+        Args:
+            through: Only apply runs up to this flush number
+        
+        Returns:
+            Number of words updated
+        """
+        with self._runs_locked():
+            return self._apply_runs(through)
+    
+    def _apply_runs(self, through: Optional[int]) -> int:
+        header = bytes([POSTINGS_FORMAT_DOC_IDS])
+        words = 0
+        for _, last, path in self.pending_runs():
+            if through is not None and last > through:
+                break
+            
+            records = iter_run(path)
+            with self.lock, self.db:
+                while True:
+                    batch = list(islice(records, DB_BATCH_SIZE))
+                    if not batch:
+                        break
+                    
+                    existing = self._fetch_postings([word for word, _ in batch])
+                    payloads = []
+                    for word, block in batch:
+                        payload = existing.get(word)
+                        payload = self._upgrade_payload(payload) if payload is not None else header
+                        payloads.append(payload + block)
+                    
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO posts (word, postings) VALUES (?, ?)",
+                        zip((word for word, _ in batch), self._compress_many(payloads))
+                    )
+                    words += len(batch)
+                self._set_meta('runs_merged_through', last)
+            os.remove(path)
+        
+        return words
+    
+    def _iter_stored_blocks(self) -> Iterator[Tuple[str, bytes]]:
+        """Stream (word, format 3 blocks) of the current posts table in key order"""
+        last_word = ''
+        while True:
+            rows = self.db.execute(
+                "SELECT word, postings FROM posts WHERE word > ? ORDER BY word LIMIT ?",
+                (last_word, DB_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+            
+            payloads = self._decompress_many([blob for _, blob in rows])
+            for (word, _), payload in zip(rows, payloads):
+                yield word, self._upgrade_payload(payload)[1:]
+            last_word = rows[-1][0]
+    
+    def _insert_merged(self, rows: List[Tuple[str, bytes]]):
+        blobs = self._compress_many([payload for _, payload in rows])
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO posts_new (word, postings) VALUES (?, ?)",
+                zip((word for word, _ in rows), blobs)
+            )
+    
+    def _get_meta(self, key: str, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+    
+    def _set_meta(self, key: str, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def decode_postings(self, blob: bytes) -> Dict[int, List[int]]:
+        """Stored blob -> {doc_id: absolute offsets}"""
+        return decode_postings_payload(self._decompress_many([blob])[0])
     
     def _delta_encode(self, arr: List[int]) -> List[int]:
         """Delta encode array for compression"""
@@ -173,12 +2258,45 @@ class IndexBuilder:
         
         return result
     
+    def _delta_decode(self, arr: List[int]) -> List[int]:
+        """Undo _delta_encode"""
+        return list(accumulate(arr))
+    
     def _compress(self, data: str) -> bytes:
         """Compress data"""
         if USE_COMPRESSION:
             return self.compressor.compress(data.encode('utf-8'))
         return data.encode('utf-8')
     
+    def _compress_many(self, payloads: List[bytes]) -> List[bytes]:
+        """
+        Compress a batch of payloads in one call when zstd supports it
+        
+        Payloads that don't get smaller (short postings lists) are stored
+        as-is; readers tell them apart by the zstd frame magic.
+        """
+        if not USE_COMPRESSION or not payloads:
+            return payloads
+        
+        if self.use_dictionary and self.dict_id is None:
+            self._dict_samples.extend(payloads[:ZSTD_DICT_SAMPLES - len(self._dict_samples)])
+            if len(self._dict_samples) >= ZSTD_DICT_SAMPLES:
+                self.train_dictionary(self._dict_samples)
+        
+        if hasattr(self.compressor, 'multi_compress_to_buffer'):
+            buffers = self.compressor.multi_compress_to_buffer(payloads)
+            compressed = [buffers[i].tobytes() for i in range(len(buffers))]
+        else:
+            compressed = [self.compressor.compress(payload) for payload in payloads]
+        return [
+            blob if len(blob) < len(payload) else payload
+            for payload, blob in zip(payloads, compressed)
+        ]
+    
+    def _decompress_many(self, blobs: List[bytes]) -> List[bytes]:
+        """Decompress a batch of blobs in one call per zstd dictionary"""
+        return self.decompressor.decompress_many(blobs)
+    
     def _decompress(self, data: bytes) -> str:
         """Decompress data"""
         if USE_COMPRESSION:
@@ -190,9 +2308,22 @@ class IndexBuilder:
         logger.info("Running VACUUM on database...")
         self.db.execute("VACUUM")
         self.db.commit()
+        if self.shards:
+            self.shards.vacuum()
+    
+    def count_words(self) -> int:
+        """Number of words in posts"""
+        if self.shards:
+            return sum(self.shards.count_words())
+        return self.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
     
     def close(self):
         """Close database connection"""
+        if self.merger:
+            self.merger.close()
+        if self.shards:
+            self.shards.close()
+            self.shards = None
         if self.db:
             self.db.close()
             logger.info("Database closed")
@@ -201,20 +2332,24 @@ class IndexBuilder:
         """Get index statistics"""
         cursor = self.db.cursor()
         
-        cursor.execute("SELECT COUNT(*) FROM posts")
-        word_count = cursor.fetchone()[0]
+        word_count = self.count_words()
+        
+        cursor.execute("SELECT COUNT(*) FROM files")
+        file_count = cursor.fetchone()[0]
         
         # Count chunks
         chunk_count = 0
         try:
-            with open(self.chunks_path, 'r', encoding='utf-8') as f:
-                chunk_count = sum(1 for _ in f)
+            with open(self.chunks_path, 'rb') as f:
+                # Removed documents leave blank lines behind
+                chunk_count = sum(1 for line in f if line.strip())
         except FileNotFoundError:
             pass
         
         return {
             'unique_words': word_count,
-            'total_chunks': chunk_count
+            'total_chunks': chunk_count,
+            'files': file_count
         }
 
 
@@ -234,8 +2369,9 @@ if __name__ == "__main__":
             {'page_num': 1, 'start_offset': 0, 'end_offset': len(test_text)}
         ]
         
+        doc_id = builder.register_files(["test.pdf"])["test.pdf"]
         chunks, postings = builder.build_chunks_and_postings(
-            "test.pdf",
+            doc_id,
             test_text,
             test_pages
         )
@@ -244,7 +2380,10 @@ if __name__ == "__main__":
         print(f"Unique words: {len(postings)}")
         
         builder.append_chunks(chunks)
-        builder.flush_postings({'test.pdf': postings})
+        builder.flush_postings(
+            {word: {doc_id: offsets} for word, offsets in postings.items()},
+            {doc_id: len(test_pages)}
+        )
         
         stats = builder.get_stats()
         print(f"Stats: {stats}")
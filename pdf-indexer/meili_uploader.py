@@ -2,7 +2,7 @@
 Meilisearch Uploader
 """
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional, Set
 import logging
 from meilisearch import Client
 from config import MEILI_HOST, MEILI_INDEX, MEILI_BATCH_SIZE
@@ -21,12 +21,19 @@ class MeiliUploader:
         
         logger.info(f"Meilisearch uploader initialized: {host}/{index_name}")
     
-    def upload_from_file(self, chunks_file: str):
+    def upload_from_file(
+        self,
+        chunks_file: str,
+        titles: Dict[int, str] = None,
+        doc_ids: Optional[Set[int]] = None
+    ):
         """
         Upload chunks from JSONL file
         
         Args:
             chunks_file: Path to chunks.jsonl file
+            titles: {doc_id: title} from the files table (IndexBuilder.get_titles)
+            doc_ids: Only upload chunks of these documents (incremental builds)
         """
         logger.info(f"Loading chunks from {chunks_file}...")
         
@@ -34,19 +41,27 @@ class MeiliUploader:
         with open(chunks_file, 'r', encoding='utf-8') as f:
             for line in f:
                 if line.strip():
-                    chunks.append(json.loads(line))
+                    chunk = json.loads(line)
+                    if doc_ids is None or chunk.get('docId') in doc_ids:
+                        chunks.append(chunk)
         
         logger.info(f"Loaded {len(chunks)} chunks")
         
-        self.upload_chunks(chunks)
+        self.upload_chunks(chunks, titles)
     
-    def upload_chunks(self, chunks: List[Dict]):
+    def upload_chunks(self, chunks: List[Dict], titles: Dict[int, str] = None):
         """
         Upload chunks to Meilisearch in batches
         
+        Chunks refer to their file by docId; the file name fields the app
+        searches and filters on (fileId, safeFileId) are filled in from
+        titles.
+        
         Args:
             chunks: List of chunk dictionaries
+            titles: {doc_id: title}
         """
+        titles = titles or {}
         total = len(chunks)
         uploaded = 0
         
@@ -56,18 +71,7 @@ class MeiliUploader:
             batch = chunks[i:i + MEILI_BATCH_SIZE]
             
             # Prepare documents
-            docs = [
-                {
-                    'id': chunk['id'],
-                    'fileId': chunk['fileId'],
-                    'safeFileId': chunk['safeFileId'],
-                    'chunkId': chunk['chunkId'],
-                    'chunkStart': chunk['chunkStart'],
-                    'pageNum': chunk.get('pageNum', 1),
-                    'text': chunk['text']
-                }
-                for chunk in batch
-            ]
+            docs = [self._make_document(chunk, titles) for chunk in batch]
             
             # Upload batch
             try:
@@ -83,6 +87,41 @@ class MeiliUploader:
         
         logger.info(f"✓ Upload complete! {uploaded} documents uploaded")
     
+    def delete_docs(self, doc_ids: List[int]):
+        """
+        Delete all chunks of documents (changed or deleted files)
+        
+        Args:
+            doc_ids: Doc ids from the files table
+        """
+        for i in range(0, len(doc_ids), MEILI_BATCH_SIZE):
+            batch = doc_ids[i:i + MEILI_BATCH_SIZE]
+            self.index.delete_documents(filter=f"docId IN [{', '.join(map(str, batch))}]")
+        
+        logger.info(f"Deleted chunks of {len(doc_ids)} documents")
+    
+    def _make_document(self, chunk: Dict, titles: Dict[int, str]) -> Dict:
+        if 'docId' in chunk:
+            file_id = titles.get(chunk['docId'], str(chunk['docId']))
+            safe_file_id = file_id.replace('.', '_').replace('/', '_')[:50]
+        else:
+            # chunks.jsonl written before doc ids
+            file_id = chunk['fileId']
+            safe_file_id = chunk['safeFileId']
+        
+        doc = {
+            'id': chunk['id'],
+            'fileId': file_id,
+            'safeFileId': safe_file_id,
+            'chunkId': chunk['chunkId'],
+            'chunkStart': chunk['chunkStart'],
+            'pageNum': chunk.get('pageNum', 1),
+            'text': chunk['text']
+        }
+        if 'docId' in chunk:
+            doc['docId'] = chunk['docId']
+        return doc
+    
     def configure_index(self):
         """Configure Meilisearch index settings"""
         logger.info("Configuring index settings...")
@@ -97,6 +136,7 @@ class MeiliUploader:
             # Filterable attributes
             self.index.update_filterable_attributes([
                 'fileId',
+                'docId',
                 'pageNum',
                 'safeFileId'
             ])
@@ -159,16 +199,22 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     
     if len(sys.argv) < 2:
-        print("Usage: python meili_uploader.py <chunks_file>")
+        print("Usage: python meili_uploader.py <chunks_file> [posmap.db]")
         sys.exit(1)
     
+    # File titles for chunks that refer to files by docId
+    titles = {}
+    if len(sys.argv) > 2:
+        import sqlite3
+        titles = dict(sqlite3.connect(sys.argv[2]).execute("SELECT doc_id, title FROM files"))
+    
     uploader = MeiliUploader()
     
     # Configure index
     uploader.configure_index()
     
     # Upload chunks
-    uploader.upload_from_file(sys.argv[1])
+    uploader.upload_from_file(sys.argv[1], titles)
     
     # Get stats
     stats = uploader.get_stats()
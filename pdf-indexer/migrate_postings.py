@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Migrate posmap.db postings to the binary format
+
+Rewrites every posts row in the current format (see index_builder.py),
+merging appended blocks into one and replacing file name keys with doc
+ids from the files table, then VACUUMs and reports DB size and the time
+to decode all postings before and after. With --train-dict the rows are
+recompressed with a zstd dictionary trained on a sample of all rows.
+
+Usage:
+    python migrate_postings.py --db index/posmap.db
+    python migrate_postings.py --db index/posmap.db --train-dict
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+
+from index_builder import (
+    IndexBuilder, POSTINGS_FORMAT_DOC_IDS, decode_postings_payload, encode_postings
+)
+from config import DB_BATCH_SIZE, ZSTD_DICT_SAMPLES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def decode_all(builder: IndexBuilder) -> float:
+    """Decode every postings row, return seconds"""
+    started = time.perf_counter()
+    cursor = builder.db.execute("SELECT postings FROM posts")
+    while True:
+        rows = cursor.fetchmany(DB_BATCH_SIZE)
+        if not rows:
+            break
+        for payload in builder._decompress_many([blob for (blob,) in rows]):
+            decode_postings_payload(payload)
+    return time.perf_counter() - started
+
+
+def train_dictionary(builder: IndexBuilder) -> bool:
+    """Train a zstd dictionary on rows spread evenly over the whole table"""
+    total = builder.db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+    step = max(1, total // ZSTD_DICT_SAMPLES)
+    blobs = [
+        blob for (blob,) in builder.db.execute(
+            "SELECT postings FROM posts WHERE rowid % ? = 0 LIMIT ?",
+            (step, ZSTD_DICT_SAMPLES)
+        )
+    ]
+    with builder.db:
+        samples = [compact_payload(builder, payload) for payload in builder._decompress_many(blobs)]
+        return builder.train_dictionary(samples)
+
+
+def compact_payload(builder: IndexBuilder, payload: bytes) -> bytes:
+    """Any stored payload -> single-block payload keyed by doc id"""
+    return encode_postings(decode_postings_payload(builder._upgrade_payload(payload)))
+
+
+def migrate(builder: IndexBuilder) -> int:
+    """Re-encode all rows in format 2, return number of rows"""
+    migrated = 0
+    last_rowid = 0
+    
+    with builder.db:
+        while True:
+            rows = builder.db.execute(
+                "SELECT rowid, postings FROM posts WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, DB_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                break
+            
+            payloads = [
+                compact_payload(builder, payload)
+                for payload in builder._decompress_many([blob for _, blob in rows])
+            ]
+            builder.db.executemany(
+                "UPDATE posts SET postings = ? WHERE rowid = ?",
+                zip(builder._compress_many(payloads), (rowid for rowid, _ in rows))
+            )
+            
+            migrated += len(rows)
+            last_rowid = rows[-1][0]
+            if migrated % (DB_BATCH_SIZE * 100) == 0:
+                logger.info(f"Migrated {migrated:,} words")
+        
+        builder.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('postings_format', ?)",
+            (POSTINGS_FORMAT_DOC_IDS,)
+        )
+        # Every row was recompressed - older dictionaries are unused now
+        builder.db.execute(
+            "DELETE FROM zstd_dicts WHERE dict_id IS NOT ?", (builder.dict_id,)
+        )
+    
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate posmap.db postings to the binary format')
+    parser.add_argument('--db', required=True, help='Path to posmap.db')
+    parser.add_argument('--train-dict', action='store_true',
+                        help='Train a zstd dictionary on the rows and compress with it')
+    args = parser.parse_args()
+    
+    if not os.path.exists(args.db):
+        print(f"❌ Database not found: {args.db}")
+        return 1
+    
+    # IndexBuilder works on <output_dir>/posmap.db
+    output_dir = os.path.dirname(os.path.abspath(args.db))
+    if os.path.basename(args.db) != 'posmap.db':
+        print("❌ Expected a posmap.db file")
+        return 1
+    
+    # Rows are compressed with the DB's current dictionary unless a new one
+    # is trained - never with one trained on the first rows only
+    builder = IndexBuilder(output_dir, use_dictionary=False)
+    
+    size_before = os.path.getsize(args.db)
+    decode_before = decode_all(builder)
+    
+    if args.train_dict:
+        print("📚 Training zstd dictionary...")
+        if not train_dictionary(builder):
+            print("❌ Dictionary training failed")
+            builder.close()
+            return 1
+    
+    print(f"📦 Migrating {args.db}...")
+    migrated = migrate(builder)
+    builder.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    builder.vacuum()
+    
+    size_after = os.path.getsize(args.db)
+    decode_after = decode_all(builder)
+    builder.close()
+    
+    print(f"✅ Migrated {migrated:,} words")
+    print(f"   DB size:     {size_before / 1024 / 1024:10.1f} MB -> {size_after / 1024 / 1024:10.1f} MB")
+    print(f"   Decode time: {decode_before:10.2f} s  -> {decode_after:10.2f} s")
+    
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
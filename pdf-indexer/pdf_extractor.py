@@ -2,17 +2,51 @@
 PDF Text Extraction with page numbers
 """
 import fitz  # PyMuPDF - fastest
-from typing import Dict, List, Optional
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import logging
+from text_processor import page_for_offset
+from config import PAGE_RANGE_SIZE
 
 logger = logging.getLogger(__name__)
 
+# Extraction cache entries (see extract_cache.py) are only reused by the
+# same extractor
+EXTRACTOR_VERSION = f"pymupdf-{fitz.VersionBind}"
+
+
+def split_page_ranges(page_count: int, range_size: int = PAGE_RANGE_SIZE) -> List[Tuple[int, int]]:
+    """Split [0, page_count) into (start, stop) ranges of range_size pages"""
+    return [
+        (start, min(page_count, start + range_size))
+        for start in range(0, page_count, range_size)
+    ]
+
+
+def extract_page_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    """
+    Extract texts of pages [start, stop)
+    
+    Runs inside worker processes - each call opens its own fitz handle.
+    """
+    doc = fitz.open(pdf_path)
+    try:
+        return [doc[page_num].get_text() + '\n' for page_num in range(start, stop)]
+    finally:
+        doc.close()
+
 
 class PDFExtractor:
     """Extract text from PDF with page information"""
     
-    def __init__(self):
+    def __init__(self, cache=None):
+        """
+        Args:
+            cache: Optional extract_cache.ExtractCache - page texts of PDFs
+                   extracted before are read from it instead of the PDF
+        """
         self.current_file = None
+        self.cache = cache
     
     def extract_text(self, pdf_path: str) -> Dict:
         """
@@ -34,85 +68,153 @@ class PDFExtractor:
                 ]
             }
         """
-        self.current_file = pdf_path
+        pages = list(self.iter_pages(pdf_path))
         
-        try:
-            return self._extract_with_pymupdf(pdf_path)
-        except Exception as e:
-            logger.error(f"PyMuPDF failed for {pdf_path}: {e}")
-            try:
-                return self._extract_with_pypdf2(pdf_path)
-            except Exception as e2:
-                logger.error(f"PyPDF2 also failed for {pdf_path}: {e2}")
-                return {'text': '', 'pages': []}
+        return {
+            'text': ''.join(page['text'] for page in pages),
+            'pages': pages
+        }
     
-    def _extract_with_pymupdf(self, pdf_path: str) -> Dict:
-        """Extract using PyMuPDF (fastest)"""
-        doc = fitz.open(pdf_path)
+    def iter_pages(self, pdf_path: str) -> Iterator[Dict]:
+        """
+        Stream pages one at a time
         
-        pages = []
-        full_text = ''
+        Only the current page is held in memory, so callers can chunk and
+        tokenize big books incrementally. If PyMuPDF fails (on open or in
+        the middle of the document) the remaining pages are read with PyPDF2.
+        If that fails as well, nothing is yielded for a document that could
+        not be opened, and RuntimeError is raised for one that was read in
+        part.
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            page_text = page.get_text() + '\n'
-            
-            pages.append({
-                'page_num': page_num + 1,
-                'text': page_text,
-                'start_offset': len(full_text),
-                'end_offset': len(full_text) + len(page_text)
-            })
+        Args:
+            pdf_path: Path to PDF file
             
-            full_text += page_text
+        Yields:
+            {
+                'page_num': int,
+                'text': str,
+                'start_offset': int,  # offsets into the concatenated text
+                'end_offset': int
+            }
+        """
+        self.current_file = pdf_path
+        yield from self._iter_page_dicts(self._iter_texts(pdf_path))
+    
+    def _iter_texts(self, pdf_path: str) -> Iterator[str]:
+        """Page texts from the extraction cache, or extracted (and cached)"""
+        page_count = 0
         
-        doc.close()
+        cached = self.cache.iter_pages(pdf_path) if self.cache else None
+        if cached is not None:
+            logger.debug(f"Extraction cache hit for {pdf_path}")
+            try:
+                for page_text in cached:
+                    page_count += 1
+                    yield page_text
+                return
+            except Exception as e:
+                logger.error(f"Extraction cache failed for {pdf_path}: {e}")
         
-        logger.debug(f"Extracted {len(pages)} pages from {pdf_path}")
+        # Pages are added to the cache entry as they are extracted; the
+        # entry is only kept if the whole document was extracted
+        writer = self.cache.writer(pdf_path) if self.cache else None
+        try:
+            # After a failed cache read, continue after the pages already read
+            yield from islice(self._iter_extracted_texts(pdf_path, writer), page_count, None)
+        finally:
+            if writer:
+                writer.abort()
+    
+    def _iter_extracted_texts(self, pdf_path: str, writer=None) -> Iterator[str]:
+        """
+        Page texts from PyMuPDF, continued with PyPDF2 if it fails
+        
+        Args:
+            writer: Optional extract_cache.CacheWriter - committed once
+                    every page was extracted
+        """
+        page_count = 0
         
+        try:
+            for page_text in self._iter_pymupdf_texts(pdf_path):
+                page_count += 1
+                if writer:
+                    writer.write(page_text)
+                yield page_text
+            
+            logger.debug(f"Extracted {page_count} pages from {pdf_path}")
+            if writer:
+                writer.commit()
+            return
+        except Exception as e:
+            logger.error(f"PyMuPDF failed for {pdf_path}: {e}")
+        
+        try:
+            for page_text in self._iter_pypdf2_texts(pdf_path, first_page=page_count):
+                page_count += 1
+                if writer:
+                    writer.write(page_text)
+                yield page_text
+            
+            logger.debug(f"Extracted {page_count} pages from {pdf_path} (PyPDF2)")
+            if writer:
+                writer.commit()
+        except Exception as e2:
+            logger.error(f"PyPDF2 also failed for {pdf_path}: {e2}")
+            if page_count:
+                # Indexing the pages read so far would pass a truncated
+                # document off as complete
+                raise RuntimeError(f"Extraction stopped after {page_count} pages: {e2}") from e2
+    
+    def _iter_page_dicts(self, page_texts: Iterable[str]) -> Iterator[Dict]:
+        """Page texts -> iter_pages() page dicts"""
+        offset = 0
+        for page_num, page_text in enumerate(page_texts, 1):
+            yield self._make_page(page_num, page_text, offset)
+            offset += len(page_text)
+    
+    def _make_page(self, page_num: int, page_text: str, offset: int) -> Dict:
         return {
-            'text': full_text,
-            'pages': pages
+            'page_num': page_num,
+            'text': page_text,
+            'start_offset': offset,
+            'end_offset': offset + len(page_text)
         }
     
-    def _extract_with_pypdf2(self, pdf_path: str) -> Dict:
-        """Fallback: Extract using PyPDF2"""
+    def get_page_count(self, pdf_path: str) -> int:
+        """Get number of pages (0 if the file can't be opened)"""
+        try:
+            doc = fitz.open(pdf_path)
+        except Exception as e:
+            logger.debug(f"Could not open {pdf_path}: {e}")
+            return 0
+        try:
+            return len(doc)
+        finally:
+            doc.close()
+    
+    def _iter_pymupdf_texts(self, pdf_path: str) -> Iterator[str]:
+        """Page texts using PyMuPDF (fastest)"""
+        doc = fitz.open(pdf_path)
+        try:
+            for page_num in range(len(doc)):
+                yield doc[page_num].get_text() + '\n'
+        finally:
+            doc.close()
+    
+    def _iter_pypdf2_texts(self, pdf_path: str, first_page: int = 0) -> Iterator[str]:
+        """Fallback: page texts using PyPDF2, starting at first_page"""
         import PyPDF2
         
-        pages = []
-        full_text = ''
-        
         with open(pdf_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
             
-            for page_num in range(len(reader.pages)):
-                page = reader.pages[page_num]
-                page_text = page.extract_text() + '\n'
-                
-                pages.append({
-                    'page_num': page_num + 1,
-                    'text': page_text,
-                    'start_offset': len(full_text),
-                    'end_offset': len(full_text) + len(page_text)
-                })
-                
-                full_text += page_text
-        
-        logger.debug(f"Extracted {len(pages)} pages from {pdf_path} (PyPDF2)")
-        
-        return {
-            'text': full_text,
-            'pages': pages
-        }
+            for page_num in range(first_page, len(reader.pages)):
+                yield reader.pages[page_num].extract_text() + '\n'
     
     def get_page_for_offset(self, pages: List[Dict], offset: int) -> int:
-        """Get page number for a given text offset"""
-        for page in pages:
-            if page['start_offset'] <= offset < page['end_offset']:
-                return page['page_num']
-        
-        # Default to last page if offset is beyond
-        return pages[-1]['page_num'] if pages else 1
+        """Get page number for a given text offset (bisect over the pages)"""
+        return page_for_offset(pages, offset)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,409 @@
+"""
+Indexing Pipeline - overlapping analyze -> write -> flush stages
+    
+    analyze  extract + tokenize (worker pool, see file_processor)
+       |     bounded queue of analyzed files
+    write    append chunks.jsonl, add postings to the accumulator
+       |     bounded queue of postings batches (cut at the memory budget)
+    flush    merge batches into SQLite and mark their files in the
+             checkpoint, in one transaction
+
+Each stage runs in its own thread, so PDF parsing keeps going while the
+writer appends chunks and SQLite merges postings. Full queues block the
+upstream stage (backpressure), which keeps memory bounded.
+"""
+import re
+import time
+import queue
+import threading
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from file_processor import iter_analyzed_files
+from postings_accumulator import PostingsAccumulator
+from config import (
+    CHUNK_SIZE, DB_BATCH_SIZE, FLUSH_EVERY, FLUSH_INTERVAL, MAX_WORKERS, MEM_BUDGET,
+    PIPELINE_QUEUE_SIZE
+)
+
+logger = logging.getLogger(__name__)
+
+# End-of-stream marker
+_DONE = object()
+
+# _get() result when the deadline passed before an item arrived
+_TIMEOUT = object()
+
+# How often blocked stages wake up to check for stop/errors (seconds)
+_POLL_INTERVAL = 0.2
+
+# Discovered files are registered (given doc ids) at least this often
+# (seconds), so a slow directory walk doesn't hold back the first files
+_REGISTER_INTERVAL = 0.2
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+
+def parse_size(size) -> int:
+    """'1GB' / '512MB' / '1.5 GB' / 1024 -> bytes"""
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?B?)\s*', str(size).upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    unit = match.group(2)
+    if unit and not unit.endswith('B'):
+        unit += 'B'
+    return int(float(match.group(1)) * _SIZE_UNITS[unit])
+
+
+def format_size(size: int) -> str:
+    """Bytes -> short human readable size"""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+
+
+class StageStats:
+    """Throughput and queue depth of a pipeline stage"""
+    
+    def __init__(self, name: str, inbox: Optional[queue.Queue] = None):
+        self.name = name
+        self.inbox = inbox
+        self.items = 0
+        self.busy = 0.0       # seconds spent working
+        self.blocked = 0.0    # seconds spent waiting on a full downstream queue
+        self.max_depth = 0
+        self.started = time.time()
+    
+    def record(self, busy: float):
+        self.items += 1
+        self.busy += busy
+        if self.inbox is not None:
+            self.max_depth = max(self.max_depth, self.inbox.qsize())
+    
+    def as_dict(self) -> Dict:
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'items': self.items,
+            'per_second': self.items / elapsed,
+            'utilization': self.busy / elapsed,
+            'blocked': self.blocked,
+            'queue': self.inbox.qsize() if self.inbox is not None else 0,
+            'max_queue': self.max_depth
+        }
+
+
+class IndexingPipeline:
+    """Run analyze -> write -> flush as overlapping stages"""
+    
+    def __init__(
+        self,
+        builder,
+        checkpoint,
+        workers: int = MAX_WORKERS,
+        chunk_size: int = CHUNK_SIZE,
+        flush_every: int = FLUSH_EVERY,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        mem_budget=MEM_BUDGET,
+        extract_cache=None,
+        flush_interval: float = FLUSH_INTERVAL
+    ):
+        """
+        Args:
+            builder: IndexBuilder the chunks and postings go to
+            checkpoint: CheckpointManager files are marked in
+            workers: Worker processes for extraction/tokenization
+            chunk_size: Characters per chunk
+            flush_every: Also flush every N files (0 = memory budget only)
+            queue_size: Analyzed files buffered ahead of the writer
+            mem_budget: Flush when the postings accumulator reaches this size
+                        (bytes or a size like '1GB'). Up to three batches
+                        are in memory - filling, queued, flushing - so the
+                        postings take up to about 3x this
+            extract_cache: Optional extract_cache.ExtractCache for PDF
+                           page texts
+            flush_interval: Also flush when the oldest unflushed file was
+                            written this many seconds ago (0 = off) - with
+                            'runs' build mode, files become searchable
+                            within about this time
+        """
+        self.builder = builder
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.mem_budget = parse_size(mem_budget)
+        self.extract_cache = extract_cache
+        
+        self.analyzed = queue.Queue(maxsize=queue_size)
+        # One batch waiting while another is flushed - batches are big.
+        # With the batch being filled that's up to 3x mem_budget in memory
+        self.batches = queue.Queue(maxsize=1)
+        
+        self.stages = {
+            'analyze': StageStats('analyze'),
+            'write': StageStats('write', self.analyzed),
+            'flush': StageStats('flush', self.batches)
+        }
+        self.flush_count = 0
+        self.accumulator_bytes = 0       # estimated size of the accumulator being built
+        self.peak_accumulator_bytes = 0
+        self.error = None
+        self._stopping = threading.Event()
+        self._batch_started = None  # when the first file of the batch was written
+    
+    def stop(self):
+        """Stop feeding new files; what was already written gets flushed"""
+        self._stopping.set()
+    
+    def run(self, files: Iterable[Tuple[str, int]]) -> Iterator[Dict]:
+        """
+        Process files, yielding each analyzed file once it was written
+        
+        The write stage runs in the caller's thread. Yielded results have
+        'chunks'/'postings' replaced by 'chunks_count'/'words_count'. Files
+        are marked in the checkpoint only after their postings are flushed.
+        
+        files is consumed lazily by the analyze stage - it can be a
+        directory walk still in progress (file_scanner.iter_files). Files
+        get their doc ids (IndexBuilder.register_files) in batches as they
+        arrive.
+        
+        Args:
+            files: (file path, index in the full file list) pairs
+        """
+        file_indices = {}
+        
+        analyze_thread = threading.Thread(
+            target=self._analyze_stage, args=(files, file_indices), daemon=True
+        )
+        flush_thread = threading.Thread(target=self._flush_stage, daemon=True)
+        analyze_thread.start()
+        flush_thread.start()
+        
+        stats = self.stages['write']
+        postings_map = PostingsAccumulator()
+        batch = []
+        page_counts = {}
+        
+        def flush():
+            nonlocal postings_map, batch, page_counts
+            self._put(self.batches, (postings_map, page_counts, batch), stats, force=True)
+            postings_map = PostingsAccumulator()
+            batch = []
+            page_counts = {}
+            self.accumulator_bytes = 0
+        
+        try:
+            while not self._stopping.is_set():
+                # A batch is due after flush_interval even if no further file
+                # arrives, e.g. while a long PDF is being analyzed
+                deadline = self._batch_started + self.flush_interval if batch and self.flush_interval else None
+                result = self._get(self.analyzed, deadline)
+                if result is _DONE:
+                    break
+                if result is _TIMEOUT:
+                    flush()
+                    continue
+                
+                started = time.perf_counter()
+                if self._write(result, postings_map):
+                    if not batch:
+                        self._batch_started = time.monotonic()
+                    batch.append((result['file_path'], file_indices.pop(result['file_path'])))
+                    page_counts[result['doc_id']] = result['page_count']
+                    
+                    if self._should_flush(batch):
+                        flush()
+                stats.record(time.perf_counter() - started)
+                
+                yield result
+        finally:
+            self._stopping.set()
+            
+            # Flush whatever was written, then wait for the flush stage
+            if batch:
+                flush()
+            self._put(self.batches, _DONE, stats, force=True)
+            flush_thread.join()
+            analyze_thread.join()
+        
+        if self.error:
+            raise self.error
+    
+    def _analyze_stage(self, files: Iterable[Tuple[str, int]], file_indices: Dict[str, int]):
+        stats = self.stages['analyze']
+        doc_ids = {}
+        results = iter_analyzed_files(
+            self._register(files, doc_ids, file_indices), self.workers, self.chunk_size, doc_ids,
+            extract_cache=self.extract_cache
+        )
+        
+        try:
+            started = time.perf_counter()
+            for result in results:
+                stats.record(time.perf_counter() - started)
+                if not self._put(self.analyzed, result, stats):
+                    break
+                started = time.perf_counter()
+        except Exception as e:
+            logger.error(f"Analyze stage failed: {e}")
+            self.error = e
+        finally:
+            results.close()
+            self._put(self.analyzed, _DONE, stats)
+    
+    def _register(
+        self,
+        files: Iterable[Tuple[str, int]],
+        doc_ids: Dict[str, int],
+        file_indices: Dict[str, int]
+    ) -> Iterator[str]:
+        """Register files in batches, yield their paths once they have doc ids"""
+        batch = []
+        last_registered = 0.0  # the first file is registered right away
+        
+        def register():
+            doc_ids.update(self.builder.register_files(batch))
+            return time.monotonic()
+        
+        for file_path, index in files:
+            file_indices[file_path] = index
+            batch.append(file_path)
+            if len(batch) >= DB_BATCH_SIZE or time.monotonic() - last_registered >= _REGISTER_INTERVAL:
+                last_registered = register()
+                yield from batch
+                batch = []
+        
+        if batch:
+            register()
+            yield from batch
+    
+    def _write(self, result: Dict, postings_map: PostingsAccumulator) -> bool:
+        """Append chunks and add postings to the accumulator"""
+        chunks = result.pop('chunks')
+        postings = result.pop('postings')
+        page_table = result.pop('page_table', None)
+        sequence = result.pop('sequence', None)
+        result['chunks_count'] = len(chunks)
+        result['words_count'] = len(postings)
+        
+        if result['error']:
+            logger.error(f"Failed to process {result['filename']}: {result['error']}")
+            return False
+        
+        doc_id = result['doc_id']
+        
+        # Append chunks to file
+        self.builder.append_chunks(chunks)
+        if page_table is not None:
+            self.builder.set_page_table(doc_id, page_table)
+        if sequence is not None:
+            self.builder.set_word_sequence(doc_id, sequence)
+        
+        # Add postings to the accumulator
+        self.accumulator_bytes += postings_map.add(doc_id, postings)
+        self.peak_accumulator_bytes = max(self.peak_accumulator_bytes, self.accumulator_bytes)
+        return True
+    
+    def _should_flush(self, batch: List) -> bool:
+        if self.accumulator_bytes >= self.mem_budget:
+            return True
+        if self.flush_interval and time.monotonic() - self._batch_started >= self.flush_interval:
+            return True
+        return bool(self.flush_every) and len(batch) >= self.flush_every
+    
+    def _flush_stage(self):
+        stats = self.stages['flush']
+        
+        while True:
+            item = self.batches.get()
+            if item is _DONE:
+                break
+            if self.error:
+                continue  # keep draining so the writer never blocks
+            
+            postings_map, page_counts, batch = item
+            started = time.perf_counter()
+            try:
+                if self.checkpoint.db is self.builder.db:
+                    # A crash can't separate postings from the checkpoint
+                    self.builder.flush_postings(
+                        postings_map, page_counts,
+                        in_transaction=lambda: self.checkpoint.record_processed(batch)
+                    )
+                else:
+                    self.builder.flush_postings(postings_map, page_counts)
+                    self.checkpoint.mark_processed_many(batch)
+                self.flush_count += 1
+            except Exception as e:
+                logger.error(f"Flush stage failed: {e}")
+                self.error = e
+            stats.record(time.perf_counter() - started)
+    
+    def _get(self, inbox: queue.Queue, deadline: Optional[float] = None):
+        """Next item, or _TIMEOUT once time.monotonic() passes deadline"""
+        while True:
+            if self.error:
+                raise self.error
+            timeout = _POLL_INTERVAL
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    return _TIMEOUT
+            try:
+                return inbox.get(timeout=timeout)
+            except queue.Empty:
+                continue
+    
+    def _put(self, outbox: queue.Queue, item, stats: StageStats, force: bool = False) -> bool:
+        """Put with backpressure; gives up once stopping unless force is set"""
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    outbox.put(item, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    if self._stopping.is_set() and not force:
+                        return False
+        finally:
+            stats.blocked += time.perf_counter() - started
+    
+    def get_stats(self) -> Dict:
+        """Per-stage throughput, utilization and queue depth"""
+        stats = {name: stage.as_dict() for name, stage in self.stages.items()}
+        stats['flush_count'] = self.flush_count
+        stats['accumulator_bytes'] = self.accumulator_bytes
+        stats['peak_accumulator_bytes'] = self.peak_accumulator_bytes
+        stats['mem_budget'] = self.mem_budget
+        return stats
+    
+    def format_stats(self) -> str:
+        """Short one-line summary for progress bars"""
+        stats = self.stages
+        return (
+            f"q[write:{stats['write'].inbox.qsize()} flush:{stats['flush'].inbox.qsize()}] "
+            f"mem:{format_size(self.accumulator_bytes)}/{format_size(self.mem_budget)} "
+            f"flushes:{self.flush_count}"
+        )
+    
+    def summary(self) -> List[str]:
+        """Human readable per-stage report"""
+        lines = []
+        for name, stage in self.get_stats().items():
+            if name not in self.stages:
+                continue
+            lines.append(
+                f"{name:<8} {stage['items']:>7} items  {stage['per_second']:8.2f}/s  "
+                f"busy {stage['utilization'] * 100:5.1f}%  blocked {stage['blocked']:7.1f}s  "
+                f"max queue {stage['max_queue']}"
+            )
+        lines.append(
+            f"postings {self.flush_count:>7} flushes  "
+            f"peak {format_size(self.peak_accumulator_bytes)} of {format_size(self.mem_budget)} budget"
+        )
+        return lines
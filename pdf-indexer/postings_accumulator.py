@@ -0,0 +1,163 @@
+"""
+Postings Accumulator - compact in-memory postings between flushes
+
+A plain {word: {doc_id: [offsets]}} map costs about 36 bytes per offset
+(a boxed int plus its list slot) and an inner dict per word, which is
+what fills the memory budget between flushes. The accumulator keeps one
+array('I') per word instead, with the word's documents one after another:
+    
+    doc_id, offset count, offset_1 ... offset_count, doc_id, ...
+
+so an offset costs 4 bytes and a (word, document) pair 8 bytes on top,
+instead of a list and a dict entry. Each word is kept once, as a key of
+the accumulator: the per-file postings arrive from the worker processes
+unpickled with fresh strings, which are dropped after add(). (sys.intern
+isn't used - the interpreter's intern table never shrinks, and a build
+goes through millions of words.)
+
+sorted_items() yields the words in key order - the order runs and
+B-tree pages are written in - decoding one word at a time, so a flush
+never holds a second, boxed copy of the whole map.
+"""
+import sys
+from array import array
+from typing import Callable, Dict, Iterator, List, Mapping, Sequence, Tuple
+
+# Per word: dict slot, array object and buffer slack (the str is counted separately)
+_WORD_BYTES = 120
+_ITEM_BYTES = array('I').itemsize
+
+
+def _decode(entry: array) -> Dict[int, array]:
+    """One word's array -> {doc_id: offsets} (later additions of a doc win)"""
+    docs = {}
+    pos = 0
+    end = len(entry)
+    while pos < end:
+        count = entry[pos + 1]
+        docs[entry[pos]] = entry[pos + 2:pos + 2 + count]
+        pos += 2 + count
+    return docs
+
+
+def _iter_doc_ids(entry: array) -> Iterator[int]:
+    pos = 0
+    end = len(entry)
+    while pos < end:
+        yield entry[pos]
+        pos += 2 + entry[pos + 1]
+
+
+class PostingsAccumulator:
+    """
+    {word: {doc_id: offsets}} of the files written since the last flush
+    
+    Reads like a read-only mapping of that shape (the offsets are arrays);
+    documents are added whole with add().
+    """
+    
+    def __init__(self):
+        self._postings: Dict[str, array] = {}
+        self.nbytes = 0
+    
+    @classmethod
+    def from_map(cls, postings_map: Mapping[str, Mapping[int, Sequence[int]]]) -> 'PostingsAccumulator':
+        """Accumulator of a {word: {doc_id: offsets}} map (offsets get sorted)"""
+        if isinstance(postings_map, cls):
+            return postings_map
+        
+        accumulator = cls()
+        for word, doc_postings in postings_map.items():
+            entry = accumulator._entry(word)
+            for doc_id, offsets in doc_postings.items():
+                entry.append(doc_id)
+                entry.append(len(offsets))
+                entry.extend(sorted(offsets))
+            accumulator.nbytes += len(entry) * _ITEM_BYTES
+        return accumulator
+    
+    def _entry(self, word: str) -> array:
+        entry = self._postings.get(word)
+        if entry is None:
+            entry = self._postings[word] = array('I')
+            self.nbytes += _WORD_BYTES + sys.getsizeof(word)
+        return entry
+    
+    def add(self, doc_id: int, postings: Mapping[str, Sequence[int]]) -> int:
+        """
+        Add a document's postings
+        
+        Args:
+            doc_id: Document id
+            postings: {word: ascending offsets} (build_chunks_and_postings)
+        
+        Returns:
+            Approximate bytes the accumulator grew by
+        """
+        before = self.nbytes
+        items = 0
+        for word, offsets in postings.items():
+            entry = self._entry(word)
+            entry.append(doc_id)
+            entry.append(len(offsets))
+            entry.extend(offsets)
+            items += 2 + len(offsets)
+        
+        self.nbytes += items * _ITEM_BYTES
+        return self.nbytes - before
+    
+    def __len__(self) -> int:
+        return len(self._postings)
+    
+    def __bool__(self) -> bool:
+        return bool(self._postings)
+    
+    def __contains__(self, word) -> bool:
+        return word in self._postings
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._postings)
+    
+    def __getitem__(self, word: str) -> Dict[int, array]:
+        return _decode(self._postings[word])
+    
+    def items(self) -> Iterator[Tuple[str, Dict[int, array]]]:
+        """(word, {doc_id: offsets}) in insertion order"""
+        for word, entry in self._postings.items():
+            yield word, _decode(entry)
+    
+    def sorted_items(self) -> Iterator[Tuple[str, Dict[int, array]]]:
+        """(word, {doc_id: offsets}) in word order, decoded one word at a time"""
+        postings = self._postings
+        for word in sorted(postings):
+            yield word, _decode(postings[word])
+    
+    def doc_words(self) -> Dict[int, List[str]]:
+        """{doc_id: words} - the forward index of the accumulated documents"""
+        words = {}
+        for word, entry in self._postings.items():
+            if len(entry) == 2 + entry[1]:  # most words are in one document
+                doc_ids = (entry[0],)
+            else:
+                doc_ids = _iter_doc_ids(entry)
+            for doc_id in doc_ids:
+                if doc_id in words:
+                    words[doc_id].append(word)
+                else:
+                    words[doc_id] = [word]
+        return words
+    
+    def split(self, key: Callable[[str], int], count: int) -> List['PostingsAccumulator']:
+        """
+        Partition by word into count accumulators (sharing the arrays)
+        
+        Args:
+            key: word -> part number in range(count)
+            count: Number of parts
+        """
+        parts = [PostingsAccumulator() for _ in range(count)]
+        for word, entry in self._postings.items():
+            part = parts[key(word)]
+            part._postings[word] = entry
+            part.nbytes += _WORD_BYTES + sys.getsizeof(word) + len(entry) * _ITEM_BYTES
+        return parts
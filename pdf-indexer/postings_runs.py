@@ -0,0 +1,380 @@
+"""
+Postings Runs - sorted on-disk postings runs for external-memory builds
+
+In 'runs' build mode every flush writes its postings, sorted by word, to
+a run file instead of merging them into SQLite. At the end of the build
+the runs are k-way merged in one pass into a freshly created posts table,
+so no word's postings are ever read back and rewritten.
+
+Runs are also the segments of a live index: once its flush committed, a
+run is immutable and readable (RunReader), so PostingsReader sees the
+posts table plus the committed runs while the build is still going.
+RunMerger compacts them in the background - see pick_merge() for the
+policy.
+
+Run file layout:
+    
+    RUN_MAGIC
+    per word (sorted): uint32 word_len, uint32 block_len, word (utf-8),
+                       format 3 postings blocks (see index_builder.py)
+    end record: uint32 0xFFFFFFFF, uint32 0
+    index, every INDEX_INTERVAL-th word: uint32 word_len, uint64 offset, word
+    footer: uint64 index offset, uint32 index entries, INDEX_MAGIC
+
+Runs are named run_<first>_<last>.run after the flush numbers they cover,
+so a run produced by merging runs 1..64 is run_000001_000064.run.
+"""
+import os
+import re
+import heapq
+import struct
+import logging
+import threading
+from bisect import bisect_right
+from itertools import groupby
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RUN_MAGIC = b'PRUN\x03'       # blocks are postings format 3, indexed
+_UNINDEXED_MAGIC = b'PRUN\x02'  # same records, no end record/index
+INDEX_MAGIC = b'PIDX'
+INDEX_INTERVAL = 32            # words scanned at most per lookup
+_RECORD_HEADER = struct.Struct('<II')
+_INDEX_ENTRY = struct.Struct('<IQ')
+_FOOTER = struct.Struct('<QI4s')
+_END = 0xFFFFFFFF
+_RUN_NAME = re.compile(r'^run_(\d{6})_(\d{6})\.run$')
+
+
+def run_name(first: int, last: int) -> str:
+    return f"run_{first:06d}_{last:06d}.run"
+
+
+def run_range(path: str) -> Tuple[int, int]:
+    """(first, last) flush numbers of a run file"""
+    match = _RUN_NAME.match(os.path.basename(path))
+    if not match:
+        raise ValueError(f"Not a run file name: {path}")
+    return int(match.group(1)), int(match.group(2))
+
+
+def list_runs(runs_dir: str, remove_covered: bool = True) -> List[Tuple[int, int, str]]:
+    """
+    Runs in a directory as (first, last, path), oldest first
+    
+    Runs whose range is covered by another run are inputs of a merge that
+    was interrupted (or is just deleting them) - they are left out, and
+    deleted unless remove_covered is False (readers).
+    """
+    if not os.path.isdir(runs_dir):
+        return []
+    
+    runs = []
+    for name in os.listdir(runs_dir):
+        match = _RUN_NAME.match(name)
+        if match:
+            runs.append((int(match.group(1)), int(match.group(2)), os.path.join(runs_dir, name)))
+    
+    # Widest range first for equal starts, so covered runs come right after
+    runs.sort(key=lambda run: (run[0], -run[1]))
+    
+    result = []
+    for first, last, path in runs:
+        if result and last <= result[-1][1]:
+            if remove_covered:
+                logger.info(f"Removing already merged run {os.path.basename(path)}")
+                _remove(path)
+            continue
+        result.append((first, last, path))
+    
+    return result
+
+
+def write_run(path: str, records: Iterable[Tuple[str, bytes]]) -> int:
+    """
+    Write (word, block) records - already sorted by word - to a run file
+    
+    The file is written under a temporary name, fsynced and renamed, so a
+    run either exists completely or not at all.
+    
+    Returns:
+        Number of records written
+    """
+    tmp_path = path + '.tmp'
+    count = 0
+    index = []
+    
+    with open(tmp_path, 'wb') as f:
+        f.write(RUN_MAGIC)
+        offset = len(RUN_MAGIC)
+        for word, block in records:
+            encoded_word = word.encode('utf-8')
+            if count % INDEX_INTERVAL == 0:
+                index.append((encoded_word, offset))
+            f.write(_RECORD_HEADER.pack(len(encoded_word), len(block)))
+            f.write(encoded_word)
+            f.write(block)
+            offset += _RECORD_HEADER.size + len(encoded_word) + len(block)
+            count += 1
+        f.write(_RECORD_HEADER.pack(_END, 0))
+        
+        index_offset = offset + _RECORD_HEADER.size
+        for encoded_word, word_offset in index:
+            f.write(_INDEX_ENTRY.pack(len(encoded_word), word_offset))
+            f.write(encoded_word)
+        f.write(_FOOTER.pack(index_offset, len(index), INDEX_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    
+    os.replace(tmp_path, path)
+    return count
+
+
+def iter_run(path: str) -> Iterator[Tuple[str, bytes]]:
+    """Stream (word, block) records of a run file in word order"""
+    with open(path, 'rb', buffering=1024 * 1024) as f:
+        if f.read(len(RUN_MAGIC)) not in (RUN_MAGIC, _UNINDEXED_MAGIC):
+            raise ValueError(f"Not a postings run: {path}")
+        
+        header_size = _RECORD_HEADER.size
+        while True:
+            header = f.read(header_size)
+            if not header:
+                return
+            word_len, block_len = _RECORD_HEADER.unpack(header)
+            if word_len == _END:
+                return
+            word = f.read(word_len).decode('utf-8')
+            yield word, f.read(block_len)
+
+
+def merge_sorted(sources: List[Iterator[Tuple[str, bytes]]]) -> Iterator[Tuple[str, List[bytes]]]:
+    """
+    K-way merge of word-sorted (word, data) streams
+    
+    Yields each word once with its data from all sources, in source order.
+    """
+    merged = heapq.merge(*sources, key=itemgetter(0))
+    for word, records in groupby(merged, key=itemgetter(0)):
+        yield word, [data for _, data in records]
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # Removed by a concurrent list_runs() already
+        pass
+
+
+def merge_run_files(runs_dir: str, runs: List[Tuple[int, int, str]]) -> str:
+    """
+    Merge adjacent runs into one run covering their flush range
+    
+    The merged run is complete before the inputs are deleted; inputs left
+    over by a crash in between are removed by the next list_runs().
+    
+    Returns:
+        Path of the merged run
+    """
+    path = os.path.join(runs_dir, run_name(runs[0][0], runs[-1][1]))
+    merged = merge_sorted([iter_run(run_path) for _, _, run_path in runs])
+    write_run(path, ((word, b''.join(blocks)) for word, blocks in merged))
+    for _, _, run_path in runs:
+        _remove(run_path)
+    return path
+
+
+class RunReader:
+    """Look up words in a run file without reading all of it"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            magic = os.pread(self.fd, len(RUN_MAGIC), 0)
+            if magic == RUN_MAGIC:
+                self._load_index()
+            elif magic == _UNINDEXED_MAGIC:
+                self._build_index()
+            else:
+                raise ValueError(f"Not a postings run: {path}")
+        except BaseException:
+            os.close(self.fd)
+            raise
+    
+    def _load_index(self):
+        size = os.fstat(self.fd).st_size
+        index_offset, entries, magic = _FOOTER.unpack(
+            os.pread(self.fd, _FOOTER.size, size - _FOOTER.size)
+        )
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"Run has no index: {self.path}")
+        
+        data = os.pread(self.fd, size - _FOOTER.size - index_offset, index_offset)
+        self.words = []
+        self.offsets = []
+        pos = 0
+        for _ in range(entries):
+            word_len, offset = _INDEX_ENTRY.unpack_from(data, pos)
+            pos += _INDEX_ENTRY.size
+            self.words.append(data[pos:pos + word_len].decode('utf-8'))
+            self.offsets.append(offset)
+            pos += word_len
+    
+    def _build_index(self):
+        """Index of an older run by scanning it once"""
+        self.words = []
+        self.offsets = []
+        offset = len(_UNINDEXED_MAGIC)
+        for count, (word, block) in enumerate(iter_run(self.path)):
+            if count % INDEX_INTERVAL == 0:
+                self.words.append(word)
+                self.offsets.append(offset)
+            offset += _RECORD_HEADER.size + len(word.encode('utf-8')) + len(block)
+    
+    def get(self, word: str) -> Optional[bytes]:
+        """Postings blocks of a word (None if the run doesn't have it)"""
+        i = bisect_right(self.words, word) - 1
+        if i < 0:
+            return None
+        
+        offset = self.offsets[i]
+        for _ in range(INDEX_INTERVAL):
+            header = os.pread(self.fd, _RECORD_HEADER.size, offset)
+            if len(header) < _RECORD_HEADER.size:
+                return None
+            word_len, block_len = _RECORD_HEADER.unpack(header)
+            if word_len == _END:
+                return None
+            offset += _RECORD_HEADER.size
+            record_word = os.pread(self.fd, word_len, offset).decode('utf-8')
+            offset += word_len
+            if record_word == word:
+                return os.pread(self.fd, block_len, offset)
+            if record_word > word:
+                return None
+            offset += block_len
+        return None
+    
+    def get_many(self, words: Iterable[str]) -> Dict[str, bytes]:
+        """{word: postings blocks} for the words the run has"""
+        result = {}
+        for word in words:
+            block = self.get(word)
+            if block is not None:
+                result[word] = block
+        return result
+    
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def pick_merge(runs: List[Tuple[int, int, str]], factor: int) -> Optional[List[Tuple[int, int, str]]]:
+    """
+    Tiered merge policy: the oldest factor adjacent runs of the same tier
+    
+    A run's tier is log_factor of the number of flushes it covers, so
+    factor single-flush runs become one run of tier 1, factor of those one
+    of tier 2, and so on - a build of F flushes keeps at most about
+    factor * log_factor(F) runs, and every flush is rewritten only
+    log_factor(F) times.
+    
+    Args:
+        runs: Committed runs, oldest first
+        factor: Runs merged at once (< 2 = never merge)
+    
+    Returns:
+        Runs to merge, or None
+    """
+    if factor < 2:
+        return None
+    
+    def tier(run):
+        flushes = run[1] - run[0] + 1
+        level = 0
+        while flushes >= factor:
+            flushes //= factor
+            level += 1
+        return level
+    
+    start = 0
+    for i in range(1, len(runs) + 1):
+        if i == len(runs) or tier(runs[i]) != tier(runs[start]):
+            if i - start >= factor:
+                return runs[start:start + factor]
+            start = i
+    return None
+
+
+class RunMerger:
+    """
+    Background thread compacting committed runs (see pick_merge)
+    
+    notify() after every committed flush. Anything else that deletes or
+    rewrites runs (the final merge, reset, removals) holds lock, which the
+    thread holds while it merges.
+    """
+    
+    def __init__(self, runs_dir: str, committed_through: Callable[[], int], factor: int):
+        """
+        Args:
+            runs_dir: Directory of the runs
+            committed_through: Returns the last committed flush number -
+                               later runs are never merged
+            factor: Runs merged at once
+        """
+        self.runs_dir = runs_dir
+        self.committed_through = committed_through
+        self.factor = factor
+        self.lock = threading.Lock()
+        self.merges = 0
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+    
+    def notify(self):
+        """A flush committed - merge if the policy says so"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='run-merger', daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._closed:
+                return
+            try:
+                while not self._closed and self.merge_once():
+                    pass
+            except Exception as e:
+                # The final merge still covers every run
+                logger.error(f"Background run merge failed: {e}")
+    
+    def merge_once(self) -> bool:
+        """Run one merge the policy picks; False if there was none"""
+        # Read before taking lock - the callback may need the owner's locks
+        committed = self.committed_through() or 0
+        with self.lock:
+            runs = [run for run in list_runs(self.runs_dir) if run[1] <= committed]
+            group = pick_merge(runs, self.factor)
+            if not group:
+                return False
+            path = merge_run_files(self.runs_dir, group)
+            self.merges += 1
+        logger.debug(f"Merged {len(group)} runs into {os.path.basename(path)}")
+        return True
+    
+    def close(self):
+        """Stop the thread after the merge in progress"""
+        self._closed = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
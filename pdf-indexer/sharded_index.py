@@ -0,0 +1,450 @@
+"""
+Sharded Index - postings partitioned by word hash over several SQLite DBs
+
+With a single posmap.db every flush and the final merge run in one
+thread, and the file grows to gigabytes. A sharded index puts the postings
+of each word into shard crc32(word) % N instead; every shard is an own
+SQLite DB written by its own process, so flushes, merges and VACUUM run
+on N cores, and lookups of different words hit different, smaller files.
+
+Layout:
+    
+    index/
+        posmap.db           files, forward index, checkpoint (posts stays empty)
+        shards.json         manifest
+        shards/000/         posmap.db (posts, meta, zstd_dicts) + runs/
+        shards/001/
+        ...
+
+Manifest (shards.json):
+    
+    {"format": 1, "hash": "crc32", "shard_count": N,
+     "shards": [{"path": "shards/000", "words": ..., "bytes": ...}, ...]}
+
+Words and bytes are refreshed after merges and VACUUM.
+
+Writes: a flush splits the postings by shard and every shard process
+writes its part as a sorted run named after the flush number. The main
+index commits that number in the flush transaction (with the forward
+index and the checkpoint), so runs of a flush that never committed are
+deleted by discard_uncommitted() like in 'runs' build mode. In 'merge'
+build mode each shard applies its committed runs to its posts table in
+the background; in 'runs' mode each shard compacts its committed runs in
+the background (RunMerger) and all shards merge at once at the end.
+
+Reads: ShardedPostingsReader routes each word to its shard, and reads
+every shard's committed runs as of one committed flush number of the
+main index; open_postings_reader() opens whichever layout an index has.
+"""
+import os
+import json
+import zlib
+import shutil
+import signal
+import sqlite3
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from index_builder import IndexBuilder, PageTable, PostingsReader
+from postings_accumulator import PostingsAccumulator
+from config import DB_NAME, MERGE_FACTOR
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "shards.json"
+SHARDS_DIR = "shards"
+MANIFEST_FORMAT = 1
+
+# IndexBuilder methods a shard process runs on request
+_SHARD_METHODS = {
+    'write_run', 'commit_runs', 'apply_runs', 'merge_runs', 'pending_runs', 'discard_runs',
+    'reset_postings', 'remove_postings', 'vacuum', 'count_words'
+}
+
+
+class ShardError(RuntimeError):
+    """A shard process failed to run a request"""
+
+
+def shard_for(word: str, shard_count: int) -> int:
+    """Shard of a word - stable across runs and platforms"""
+    return zlib.crc32(word.encode('utf-8')) % shard_count
+
+
+def partition(words: Iterable[str], shard_count: int) -> List[List[str]]:
+    """Words -> one list per shard (input order kept)"""
+    parts = [[] for _ in range(shard_count)]
+    for word in words:
+        parts[shard_for(word, shard_count)].append(word)
+    return parts
+
+
+def partition_postings(postings: PostingsAccumulator, shard_count: int) -> List[PostingsAccumulator]:
+    """Accumulated postings -> one accumulator per shard"""
+    return postings.split(lambda word: shard_for(word, shard_count), shard_count)
+
+
+def _manifest_path(output_dir: str) -> str:
+    return os.path.join(output_dir, MANIFEST_FILE)
+
+
+def read_manifest(output_dir: str) -> Optional[Dict]:
+    """Manifest of a sharded index (None for a single posmap.db)"""
+    try:
+        with open(_manifest_path(output_dir), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    
+    if manifest.get('format') != MANIFEST_FORMAT or manifest.get('hash') != 'crc32':
+        raise ValueError(f"Unsupported shard manifest: {_manifest_path(output_dir)}")
+    return manifest
+
+
+def write_manifest(output_dir: str, manifest: Dict):
+    path = _manifest_path(output_dir)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def read_shard_count(output_dir: str) -> int:
+    """Number of shards of an index (0 = single posmap.db)"""
+    manifest = read_manifest(output_dir)
+    return manifest['shard_count'] if manifest else 0
+
+
+def remove_shards(output_dir: str):
+    """Delete the manifest and all shards of an index"""
+    if os.path.exists(_manifest_path(output_dir)):
+        os.remove(_manifest_path(output_dir))
+    shutil.rmtree(os.path.join(output_dir, SHARDS_DIR), ignore_errors=True)
+
+
+def _shard_main(conn, shard_dir: str, use_dictionary: bool, merge_factor: int):
+    """Shard process: run requests on the shard's IndexBuilder until closed"""
+    # Ctrl+C goes to the whole process group - the main process decides
+    # when the shards stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    builder = IndexBuilder(
+        shard_dir, build_mode='runs', use_dictionary=use_dictionary, shards=0,
+        merge_factor=merge_factor
+    )
+    try:
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                break
+            if method == 'close':
+                conn.send((True, None))
+                break
+            
+            try:
+                if method not in _SHARD_METHODS:
+                    raise ValueError(f"Unknown shard request: {method}")
+                conn.send((True, getattr(builder, method)(*args)))
+            except Exception as e:
+                logger.exception(f"Shard {shard_dir}: {method} failed")
+                conn.send((False, f"{type(e).__name__}: {e}"))
+    finally:
+        builder.close()
+
+
+class ShardWriter:
+    """Handle of one shard process"""
+    
+    def __init__(self, context, shard_dir: str, use_dictionary: bool, merge_factor: int):
+        self.shard_dir = shard_dir
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_shard_main, args=(child_conn, shard_dir, use_dictionary, merge_factor),
+            name=f"shard-{os.path.basename(shard_dir)}", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        
+        self.lock = threading.Lock()
+        self._unanswered = 0
+    
+    def send(self, method: str, *args):
+        """Start a request without waiting for it"""
+        with self.lock:
+            self.conn.send((method, args))
+            self._unanswered += 1
+    
+    def call(self, method: str, *args):
+        """Run a request and return its result (after all earlier ones)"""
+        with self.lock:
+            self.conn.send((method, args))
+            self._unanswered += 1
+            return self._receive_all()
+    
+    def wait(self):
+        """Wait for all started requests"""
+        with self.lock:
+            self._receive_all()
+    
+    def _receive_all(self):
+        """Results of all unanswered requests - the last one is returned,
+        the first failure is raised once all were received"""
+        result = None
+        error = None
+        while self._unanswered:
+            try:
+                ok, result = self.conn.recv()
+            except EOFError:
+                self._unanswered = 0
+                raise ShardError(f"Shard process {self.shard_dir} died")
+            self._unanswered -= 1
+            if not ok and error is None:
+                error = ShardError(f"Shard {self.shard_dir}: {result}")
+        if error:
+            raise error
+        return result
+    
+    def close(self):
+        try:
+            self.call('close')
+        except (ShardError, OSError) as e:
+            logger.warning(f"Closing shard {self.shard_dir}: {e}")
+        self.process.join()
+        self.conn.close()
+
+
+class ShardSet:
+    """The shard processes of a sharded index, used by IndexBuilder"""
+    
+    def __init__(
+        self,
+        output_dir: str,
+        shard_count: int,
+        use_dictionary: bool = True,
+        merge_factor: int = MERGE_FACTOR
+    ):
+        """
+        Args:
+            output_dir: Index directory - the manifest is created if missing
+            shard_count: Number of shards (must match an existing manifest)
+            use_dictionary: Train a zstd dictionary per shard
+            merge_factor: Background merge policy of the shards' runs
+                          (see IndexBuilder)
+        """
+        self.output_dir = output_dir
+        self.shard_count = shard_count
+        
+        manifest = read_manifest(output_dir)
+        if manifest is None:
+            manifest = {
+                'format': MANIFEST_FORMAT,
+                'hash': 'crc32',
+                'shard_count': shard_count,
+                'shards': [
+                    {'path': f"{SHARDS_DIR}/{shard:03d}", 'words': 0, 'bytes': 0}
+                    for shard in range(shard_count)
+                ]
+            }
+            for shard in manifest['shards']:
+                os.makedirs(os.path.join(output_dir, shard['path']), exist_ok=True)
+            write_manifest(output_dir, manifest)
+        elif manifest['shard_count'] != shard_count:
+            raise ValueError(
+                f"Index has {manifest['shard_count']} shards, not {shard_count} - reset it first"
+            )
+        self.manifest = manifest
+        
+        # Spawned, not forked: the builder's process already runs threads
+        context = multiprocessing.get_context('spawn')
+        self.writers = [
+            ShardWriter(context, os.path.join(output_dir, shard['path']), use_dictionary, merge_factor)
+            for shard in manifest['shards']
+        ]
+        # Requests go out to all shards at once; a blocked send (a shard
+        # still busy with the previous flush) doesn't hold up the others
+        self._executor = ThreadPoolExecutor(max_workers=shard_count, thread_name_prefix='shard')
+        
+        logger.info(f"Started {shard_count} shard writers in {output_dir}/{SHARDS_DIR}")
+    
+    def _call_all(self, method: str, args: Optional[List[Tuple]] = None) -> List:
+        """Run a request on every shard in parallel (args: one tuple per
+        shard, None = no request for that shard)"""
+        if args is None:
+            args = [()] * self.shard_count
+        
+        def call(shard: int):
+            if args[shard] is None:
+                return None
+            return self.writers[shard].call(method, *args[shard])
+        
+        return list(self._executor.map(call, range(self.shard_count)))
+    
+    def write_run(self, postings_map: PostingsAccumulator, number: int):
+        """Write every shard's part of a flush as run number"""
+        parts = partition_postings(postings_map, self.shard_count)
+        self._call_all('write_run', [(part, number) if part else None for part in parts])
+    
+    def commit_runs(self, through: int):
+        """Tell the shards flushes up to through committed ('runs' build
+        mode) - they may compact those runs in the background"""
+        for writer in self.writers:
+            writer.send('commit_runs', through)
+    
+    def apply_runs(self, through: int = None, wait: bool = True):
+        """Apply committed runs to the shards' posts (merge build mode)"""
+        for writer in self.writers:
+            writer.send('apply_runs', through)
+        if wait:
+            for writer in self.writers:
+                writer.wait()
+    
+    def pending_runs(self) -> List[Tuple[int, int, str]]:
+        """Runs not merged yet in any shard, oldest first"""
+        runs = [run for shard_runs in self._call_all('pending_runs') for run in shard_runs]
+        return sorted(runs)
+    
+    def merge_runs(self) -> int:
+        """Merge every shard's pending runs - all shards at once"""
+        words = sum(self._call_all('merge_runs'))
+        self.update_manifest()
+        return words
+    
+    def discard_runs(self, committed_through: int):
+        self._call_all('discard_runs', [(committed_through,)] * self.shard_count)
+    
+    def reset_postings(self):
+        self._call_all('reset_postings')
+        self.update_manifest()
+    
+    def remove_postings(self, doc_ids: Set[int], words: List[str], scan_doc_ids: Set[int]) -> int:
+        """IndexBuilder.remove_postings() on every shard that has the words"""
+        touched = self._call_all('remove_postings', [
+            (doc_ids, part, scan_doc_ids) if part or scan_doc_ids else None
+            for part in partition(words, self.shard_count)
+        ])
+        return sum(count or 0 for count in touched)
+    
+    def vacuum(self):
+        self._call_all('vacuum')
+        self.update_manifest()
+    
+    def count_words(self) -> List[int]:
+        """Words in each shard's posts"""
+        return self._call_all('count_words')
+    
+    def connect_posts(self) -> List[sqlite3.Connection]:
+        """Read-only connections to the shards' posmap.db (see IndexBuilder.update_word_tables)"""
+        return [
+            sqlite3.connect(f"file:{os.path.join(self.output_dir, shard['path'], DB_NAME)}?mode=ro", uri=True)
+            for shard in self.manifest['shards']
+        ]
+    
+    def update_manifest(self):
+        """Record the words and bytes of every shard in the manifest"""
+        for shard, words in zip(self.manifest['shards'], self.count_words()):
+            db_path = os.path.join(self.output_dir, shard['path'], DB_NAME)
+            shard['words'] = words
+            shard['bytes'] = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+        write_manifest(self.output_dir, self.manifest)
+    
+    def close(self):
+        """Stop the shard processes"""
+        for writer in self.writers:
+            writer.close()
+        self._executor.shutdown()
+    
+    def destroy(self):
+        """Stop the shard processes and delete the shards and the manifest"""
+        self.close()
+        remove_shards(self.output_dir)
+
+
+class ShardedPostingsReader:
+    """Read postings of a sharded index - same API as PostingsReader"""
+    
+    def __init__(self, output_dir: str):
+        manifest = read_manifest(output_dir)
+        if manifest is None:
+            raise ValueError(f"Not a sharded index: {output_dir}")
+        
+        self.shard_count = manifest['shard_count']
+        self.shards = [
+            PostingsReader(os.path.join(output_dir, shard['path'], DB_NAME))
+            for shard in manifest['shards']
+        ]
+        self.main = PostingsReader(os.path.join(output_dir, DB_NAME))
+        self._executor = ThreadPoolExecutor(
+            max_workers=min(self.shard_count, os.cpu_count() or 1),
+            thread_name_prefix='shard-reader'
+        )
+    
+    def shard(self, word: str) -> PostingsReader:
+        """Reader of the shard holding a word"""
+        return self.shards[shard_for(word, self.shard_count)]
+    
+    def get(self, word: str) -> Dict[int, List[int]]:
+        """{doc_id: absolute offsets} for a word ({} if not indexed)"""
+        return self.shard(word).get(word, self.main.get_committed_through())
+    
+    def get_many(self, words: List[str]) -> Dict[str, Dict[int, List[int]]]:
+        """{word: {doc_id: absolute offsets}} - shards are read in parallel"""
+        # All shards read the runs of the same committed flushes
+        committed_through = self.main.get_committed_through()
+        groups = [
+            (self.shards[shard], part)
+            for shard, part in enumerate(partition(words, self.shard_count)) if part
+        ]
+        if len(groups) == 1:
+            reader, part = groups[0]
+            return reader.get_many(part, committed_through)
+        
+        result = {}
+        for postings in self._executor.map(
+            lambda group: group[0].get_many(group[1], committed_through), groups
+        ):
+            result.update(postings)
+        return result
+    
+    def get_docs(self, word: str) -> Set[int]:
+        """Doc ids containing a word - offsets are not decoded"""
+        return self.shard(word).get_docs(word, self.main.get_committed_through())
+    
+    def get_files(self) -> Dict[int, Dict]:
+        """{doc_id: {'path', 'title', 'page_count', 'size'}}"""
+        return self.main.get_files()
+    
+    def get_page_table(self, doc_id: int) -> Optional[PageTable]:
+        """PageTable of a document (None if it was indexed without one)"""
+        return self.main.get_page_table(doc_id)
+    
+    def get_gematria_words(self, low: int, high: Optional[int] = None, method: str = 'regular') -> Dict[str, int]:
+        """{word: value} of the words whose gematria is in [low, high]"""
+        return self.main.get_gematria_words(low, high, method)
+    
+    def iter_word_sequences(self) -> Iterator[Tuple[int, List[str]]]:
+        """(doc_id, words in text order) of the documents indexed with GEMATRIA_PHRASES"""
+        return self.main.iter_word_sequences()
+    
+    def get_variants(self, word: str) -> List[str]:
+        """Indexed words that are word with Hebrew prefixes"""
+        return self.main.get_variants(word)
+    
+    def get_with_variants(self, word: str) -> Dict[str, Dict[int, List[int]]]:
+        """{word or prefixed form: {doc_id: absolute offsets}} - shards are read in parallel"""
+        return self.get_many([word] + self.get_variants(word))
+    
+    def close(self):
+        self._executor.shutdown()
+        for reader in self.shards:
+            reader.close()
+        self.main.close()
+
+
+def open_postings_reader(output_dir: str):
+    """PostingsReader or ShardedPostingsReader, whichever fits the index"""
+    if read_manifest(output_dir) is not None:
+        return ShardedPostingsReader(output_dir)
+    return PostingsReader(os.path.join(output_dir, DB_NAME))
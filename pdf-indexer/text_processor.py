@@ -1,45 +1,158 @@
 """
 Hebrew Text Processing
 """
+import unicodedata
 import regex as re  # Use regex module for Unicode support
-from typing import List, Tuple
-from config import REMOVE_NIKUD, MIN_WORD_LENGTH, NIKUD_PATTERN
+from array import array
+from bisect import bisect_right
+from typing import Dict, List, Optional, Sequence, Tuple
+from config import REMOVE_NIKUD, MIN_WORD_LENGTH, NIKUD_PATTERN, PREFIX_MIN_STEM
+
+_NIKUD = re.compile(NIKUD_PATTERN)
+
+# Recorded in every index (meta table) - postings of different tokenizers
+# don't mix. Bump the version when tokenize_with_offsets() splits or
+# normalizes words differently (2: nikud and cantillation kept inside a word).
+TOKENIZER_VERSION = 2
+TOKENIZER = f"{TOKENIZER_VERSION}/remove_nikud={int(REMOVE_NIKUD)}/min_word_length={MIN_WORD_LENGTH}"
+
+# Nikud and cantillation marks sit on a letter, inside a word. The rest of
+# NIKUD_PATTERN (maqaf, paseq, sof pasuq...) is punctuation and keeps
+# separating words.
+_MARKS = ''.join(
+    char for char in _NIKUD.findall(''.join(map(chr, range(0x10000))))
+    if unicodedata.category(char) == 'Mn'
+)
+_WORD_MARKS = re.compile(f"[{re.escape(_MARKS)}]+") if REMOVE_NIKUD and _MARKS else None
+
+# Match Hebrew, English, and numbers (with the marks inside a word)
+_TOKEN = re.compile(r'[\p{L}\p{N}]+')
+_LONG_TOKEN = re.compile(r'[\p{L}\p{N}]{%d,}' % max(MIN_WORD_LENGTH, 1))
+_MARKED_TOKEN = re.compile(r'[\p{L}\p{N}][\p{L}\p{N}%s]*' % re.escape(_MARKS)) if _WORD_MARKS else None
+_WORD_CHAR = re.compile(r'[\p{L}\p{N}%s]' % re.escape(_MARKS))
+
+# str.lower() of a whole text equals lowering word by word, except for
+# U+0130 (lowercases to two characters) and Greek sigma (final form
+# depends on what follows the word)
+_CONTEXT_LOWER = ('\u0130', '\u03a3')
+
+# Hebrew prefix letters: an optional ו, then ש, כש or מ, then ה, ב, כ or ל
+_PREFIX_LETTERS = 'והבכלמש'
+_PREFIX = re.compile(r'ו?(?:כש|ש|מ)?[הבכל]?')
+_MAX_PREFIX = 4
+
+# clean_text() steps: (pattern, replacement, the matches that drop
+# characters, characters such a match keeps at its start, at its end)
+_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]+')
+_CLEAN_STEPS = (
+    (_CONTROL_CHARS, '', _CONTROL_CHARS, 0, 0),
+    (re.compile(r'[ \t]+'), ' ', re.compile(r'[ \t]{2,}'), 1, 0),
+    (re.compile(r'\n\s*\n'), '\n\n', re.compile(r'\n\s+\n'), 1, 1)
+)
 
 
 def remove_nikud(text: str) -> str:
     """Remove Hebrew nikud (vowel points)"""
     if not REMOVE_NIKUD:
         return text
-    return re.sub(NIKUD_PATTERN, '', text)
+    return _NIKUD.sub('', text)
 
 
 def tokenize_with_offsets(text: str) -> List[Tuple[str, int, int]]:
     """
     Tokenize text and return (token, start_offset, length)
     
+    The whole text is lowercased at once and matched with a precompiled
+    pattern. Nikud inside a word is part of the token's span, and is
+    stripped from all tokens of the text in a single pass.
+    
     Args:
         text: Input text
         
     Returns:
         List of (cleaned_token, offset, original_length)
     """
-    tokens = []
+    lowered = None if any(char in text for char in _CONTEXT_LOWER) else text.lower()
     
-    # Match Hebrew, English, and numbers
-    pattern = re.compile(r'[\p{L}\p{N}]+', re.UNICODE)
+    if _WORD_MARKS is None or not _WORD_MARKS.search(text):
+        if lowered is not None:
+            return [
+                (match.group(), match.start(), match.end() - match.start())
+                for match in _LONG_TOKEN.finditer(lowered)
+            ]
+        words, spans = _match_words(_TOKEN, text)
+    else:
+        words, spans = _match_words(_MARKED_TOKEN, text if lowered is None else lowered)
+        words = _WORD_MARKS.sub('', '\0'.join(words)).split('\0')
     
+    if lowered is None:
+        words = [word.lower() for word in words]
+    
+    return [
+        (word, start, end - start)
+        for word, (start, end) in zip(words, spans)
+        if len(word) >= MIN_WORD_LENGTH
+    ]
+
+
+def _match_words(pattern, text: str) -> Tuple[List[str], List[Tuple[int, int]]]:
+    words = []
+    spans = []
     for match in pattern.finditer(text):
-        raw_token = match.group(0)
-        cleaned = remove_nikud(raw_token).lower()
+        words.append(match.group())
+        spans.append(match.span())
+    return words, spans
+
+
+def prefix_stems(token: str) -> List[str]:
+    """
+    Stems of a token without its Hebrew prefix letters
+    
+    Every way the token can start with a prefix (ו|השבת, וה|שבת) gives a
+    stem, if PREFIX_MIN_STEM letters are left - at most 4 per token.
+    
+    Args:
+        token: Token from tokenize_with_offsets()
+        
+    Returns:
+        Stems, longest first
+    """
+    stems = []
+    for length in range(1, min(_MAX_PREFIX, len(token) - PREFIX_MIN_STEM) + 1):
+        if token[length - 1] not in _PREFIX_LETTERS:
+            break
+        if _PREFIX.fullmatch(token, 0, length):
+            stems.append(token[length:])
+    return stems
+
+
+def snap_to_word_boundary(text: str, pos: int, start: int = 0) -> int:
+    """
+    Move a cut position off the middle of a word
+    
+    Args:
+        text: Text being cut
+        pos: Cut position (0 < pos < len(text))
+        start: The cut doesn't move back to start or before - a word that
+               begins there is cut after its end instead
         
-        if len(cleaned) >= MIN_WORD_LENGTH:
-            tokens.append((
-                cleaned,
-                match.start(),
-                len(raw_token)
-            ))
+    Returns:
+        pos, or the start of the word it splits
+    """
+    is_word = _WORD_CHAR.match
+    if pos <= 0 or pos >= len(text) or not (is_word(text, pos - 1) and is_word(text, pos)):
+        return pos
+    
+    word_start = pos - 1
+    while word_start > start and is_word(text, word_start - 1):
+        word_start -= 1
+    if word_start > start:
+        return word_start
     
-    return tokens
+    end = pos + 1
+    while end < len(text) and is_word(text, end):
+        end += 1
+    return end
 
 
 def normalize_hebrew(text: str) -> str:
@@ -66,24 +179,59 @@ def normalize_hebrew(text: str) -> str:
     return text.lower()
 
 
-def extract_gematria_value(text: str) -> int:
+# Gematria methods, named as in the app's src/utils/gematriaSearchEngine.js
+# so its method option can be passed through:
+#   regular      - mispar hechrechi (final letters count as the regular ones)
+#   small        - mispar katan (the regular value without its zeros)
+#   finalLetters - mispar gadol (final letters 500-900)
+# The tables store methods by their position in GEMATRIA_METHODS.
+_GEMATRIA_REGULAR = {
+    'א': 1, 'ב': 2, 'ג': 3, 'ד': 4, 'ה': 5, 'ו': 6, 'ז': 7, 'ח': 8, 'ט': 9,
+    'י': 10, 'כ': 20, 'ך': 20, 'ל': 30, 'מ': 40, 'ם': 40, 'נ': 50, 'ן': 50,
+    'ס': 60, 'ע': 70, 'פ': 80, 'ף': 80, 'צ': 90, 'ץ': 90, 'ק': 100,
+    'ר': 200, 'ש': 300, 'ת': 400
+}
+GEMATRIA_TABLES = {
+    'regular': _GEMATRIA_REGULAR,
+    'small': {
+        char: value // 100 if value >= 100 else value // 10 if value >= 10 else value
+        for char, value in _GEMATRIA_REGULAR.items()
+    },
+    'finalLetters': {**_GEMATRIA_REGULAR, 'ך': 500, 'ם': 600, 'ן': 700, 'ף': 800, 'ץ': 900}
+}
+GEMATRIA_METHODS = tuple(GEMATRIA_TABLES)
+_HEBREW_LETTERS = ''.join(_GEMATRIA_REGULAR)
+
+
+def extract_gematria_value(text: str, method: str = 'regular') -> int:
     """
-    Calculate gematria value for Hebrew text
+    Calculate gematria value for Hebrew text (other characters count 0)
+    
+    Args:
+        text: Input text
+        method: One of GEMATRIA_METHODS
     """
-    gematria_values = {
-        'א': 1, 'ב': 2, 'ג': 3, 'ד': 4, 'ה': 5, 'ו': 6, 'ז': 7, 'ח': 8, 'ט': 9,
-        'י': 10, 'כ': 20, 'ך': 20, 'ל': 30, 'מ': 40, 'ם': 40, 'נ': 50, 'ן': 50,
-        'ס': 60, 'ע': 70, 'פ': 80, 'ף': 80, 'צ': 90, 'ץ': 90, 'ק': 100,
-        'ר': 200, 'ש': 300, 'ת': 400
-    }
+    values = GEMATRIA_TABLES[method]
     
     total = 0
     for char in text:
-        total += gematria_values.get(char, 0)
+        total += values.get(char, 0)
     
     return total
 
 
+def gematria_values(word: str) -> Optional[Tuple[int, ...]]:
+    """
+    Value of an indexed word by each of GEMATRIA_METHODS
+    
+    Returns:
+        The values, or None if the word isn't all Hebrew letters
+    """
+    if not word or word.strip(_HEBREW_LETTERS):
+        return None
+    return tuple(sum(map(values.__getitem__, word)) for values in GEMATRIA_TABLES.values())
+
+
 def is_hebrew(text: str) -> bool:
     """Check if text contains Hebrew characters"""
     hebrew_pattern = re.compile(r'[\u0590-\u05FF]')
@@ -97,16 +245,150 @@ def clean_text(text: str) -> str:
     - Remove control characters
     - Normalize line breaks
     """
-    # Remove control characters except newlines and tabs
-    text = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]', '', text)
-    
-    # Normalize whitespace
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n\s*\n', '\n\n', text)
+    for pattern, replacement, _, _, _ in _CLEAN_STEPS:
+        text = pattern.sub(replacement, text)
     
     return text.strip()
 
 
+class OffsetMap:
+    """
+    Offsets in a cleaned text -> offsets in the text it was cleaned from
+    
+    Cleaning only drops characters, so the cleaned text is the original
+    with some ranges cut out, and the shift between the two is constant
+    from one cut to the next. Segment i starts at clean[i] in the cleaned
+    text, which is raw[i] in the original - two array('I')s with an entry
+    per cut, and a lookup is a bisect.
+    """
+    
+    __slots__ = ('clean', 'raw')
+    
+    def __init__(self, clean: Optional[array] = None, raw: Optional[array] = None):
+        self.clean = array('I', [0]) if clean is None else clean
+        self.raw = array('I', [0]) if raw is None else raw
+    
+    @classmethod
+    def from_cuts(cls, cuts: List[Tuple[int, int]]) -> 'OffsetMap':
+        """Map of a text with the given (start, end) ranges cut out (sorted, disjoint)"""
+        offsets = cls()
+        removed = 0
+        for start, end in cuts:
+            if start == removed:  # cut at the start of the text
+                offsets.raw[0] = end
+            else:
+                offsets.clean.append(start - removed)
+                offsets.raw.append(end)
+            removed += end - start
+        return offsets
+    
+    def __len__(self) -> int:
+        return len(self.clean)
+    
+    def to_raw(self, offset: int) -> int:
+        """Offset in the original text of a cleaned-text offset"""
+        i = bisect_right(self.clean, offset) - 1
+        if i < 0:
+            return offset
+        return self.raw[i] + offset - self.clean[i]
+    
+    def to_clean(self, raw_offset: int) -> int:
+        """Cleaned-text offset of an original offset (a cut-out one -> the next kept character)"""
+        i = bisect_right(self.raw, raw_offset) - 1
+        if i < 0:
+            return 0
+        offset = self.clean[i] + raw_offset - self.raw[i]
+        if i + 1 < len(self.clean):
+            offset = min(offset, self.clean[i + 1])
+        return offset
+    
+    def extend(self, other: 'OffsetMap', clean_start: int, raw_start: int):
+        """
+        Append the map of a text that starts at clean_start / raw_start
+        
+        Used to map a document whose pages are cleaned one at a time.
+        """
+        for clean, raw in zip(other.clean, other.raw):
+            clean += clean_start
+            raw += raw_start
+            if raw - clean == self.raw[-1] - self.clean[-1]:
+                continue  # same shift - the last segment goes on
+            if clean == self.clean[-1]:
+                self.raw[-1] = raw
+            else:
+                self.clean.append(clean)
+                self.raw.append(raw)
+
+
+def clean_text_with_offsets(text: str) -> Tuple[str, OffsetMap]:
+    """
+    clean_text() plus the map of its offsets back to text's
+    
+    Args:
+        text: Raw text (e.g. a page from PDFExtractor)
+        
+    Returns:
+        (cleaned text, OffsetMap from cleaned to raw offsets)
+    """
+    cuts = []  # ranges of text dropped so far, sorted
+    offsets = OffsetMap()
+    
+    def cut(ranges: List[Tuple[int, int]]) -> OffsetMap:
+        # Ranges of the current text -> ranges of the original text
+        nonlocal cuts
+        merged = []
+        for start, end in sorted(cuts + [(offsets.to_raw(start), offsets.to_raw(end)) for start, end in ranges]):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        cuts = merged
+        return OffsetMap.from_cuts(cuts)
+    
+    for pattern, replacement, drops, keep_start, keep_end in _CLEAN_STEPS:
+        ranges = [(match.start() + keep_start, match.end() - keep_end) for match in drops.finditer(text)]
+        if ranges:
+            offsets = cut(ranges)
+        text = pattern.sub(replacement, text)
+    
+    stripped = text.lstrip()
+    if len(stripped) < len(text):
+        offsets = cut([(0, len(text) - len(stripped))])
+    
+    return stripped.rstrip(), offsets
+
+
+class _StartOffsets:
+    """start_offset of each page dict, as a sequence for bisect"""
+    
+    def __init__(self, pages: Sequence[Dict]):
+        self.pages = pages
+    
+    def __len__(self) -> int:
+        return len(self.pages)
+    
+    def __getitem__(self, index: int) -> int:
+        return self.pages[index]['start_offset']
+
+
+def page_for_offset(pages: Sequence[Dict], offset: int) -> int:
+    """
+    Page number of an offset into the text that page dicts slice
+    
+    Args:
+        pages: [{'page_num', 'start_offset', 'end_offset'}] in text order
+               (PDFExtractor) - offsets into the raw extracted text
+        offset: Offset into that text (see OffsetMap for cleaned offsets)
+        
+    Returns:
+        Page number (1 without pages)
+    """
+    if not pages:
+        return 1
+    index = bisect_right(_StartOffsets(pages), offset) - 1
+    return pages[max(index, 0)]['page_num']
+
+
 if __name__ == "__main__":
     # Test
     test_text = "שָׁלוֹם עוֹלָם! Hello World 123"
@@ -10,15 +10,21 @@ import sys
 import json
 import threading
 import time
-from pathlib import Path
 import logging
 from tkinter import Tk, filedialog
 
-from pdf_extractor import PDFExtractor
 from index_builder import IndexBuilder
-from checkpoint_manager import CheckpointManager
+from pipeline import IndexingPipeline, parse_size
+from checkpoint_manager import CheckpointManager, read_progress
+from file_scanner import iter_files, iter_pending, find_files
 from meili_uploader import MeiliUploader
-from config import CHUNK_SIZE, FLUSH_EVERY, CHECKPOINT_FILE
+from extract_cache import ExtractCache
+from pdf_extractor import EXTRACTOR_VERSION
+from text_processor import TOKENIZER
+from config import (
+    CHUNK_SIZE, FLUSH_EVERY, MAX_WORKERS, CHECKPOINT_FILE, DB_NAME, BUILD_MODE, MEM_BUDGET,
+    EXTRACT_CACHE_DIR, EXTRACT_CACHE_SIZE
+)
 
 app = Flask(__name__)
 CORS(app)
@@ -34,59 +40,23 @@ indexing_state = {
     'words': 0,
     'errors': [],
     'start_time': None,
-    'elapsed': 0
+    'elapsed': 0,
+    'pipeline': {}
 }
 
 indexing_thread = None
 
 
-def find_files(books_dir: str) -> list:
-    """Find all PDF and TXT files"""
-    extensions = ['.pdf', '.txt']
-    files = []
-    for ext in extensions:
-        files.extend(Path(books_dir).rglob(f'*{ext}'))
-    return [str(f) for f in sorted(files)]
-
-
-def process_file(file_path: str, builder: IndexBuilder, extractor: PDFExtractor, postings_map: dict):
-    """Process a single file"""
-    filename = os.path.basename(file_path)
-    file_id = filename.rsplit('.', 1)[0]
-    
-    try:
-        # Extract text
-        if file_path.lower().endswith('.pdf'):
-            result = extractor.extract_text(file_path)
-            text = result['text']
-            pages = result['pages']
-        else:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
-            pages = [{'page_num': 1, 'start_offset': 0, 'end_offset': len(text)}]
-        
-        if not text or len(text) < 10:
-            return 0, 0, False, "File too short or empty"
-        
-        # Build chunks and postings
-        chunks, postings = builder.build_chunks_and_postings(file_id, text, pages)
-        
-        # Append chunks
-        builder.append_chunks(chunks)
-        
-        # Merge postings
-        for word, offsets in postings.items():
-            if word not in postings_map:
-                postings_map[word] = {}
-            postings_map[word][file_id] = offsets
-        
-        return len(chunks), len(postings), True, None
-        
-    except Exception as e:
-        return 0, 0, False, str(e)
-
-
-def indexing_worker(books_dir: str, output_dir: str, flush_every: int, reset: bool, upload_meili: bool):
+def indexing_worker(
+    books_dir: str,
+    output_dir: str,
+    flush_every: int,
+    reset: bool,
+    upload_meili: bool,
+    workers: int = MAX_WORKERS,
+    build_mode: str = BUILD_MODE,
+    mem_budget: int = MEM_BUDGET
+):
     """Background worker for indexing"""
     global indexing_state
     
@@ -100,106 +70,108 @@ def indexing_worker(books_dir: str, output_dir: str, flush_every: int, reset: bo
         # Create output directory
         os.makedirs(output_dir, exist_ok=True)
         
-        # Find files
-        files = find_files(books_dir)
-        indexing_state['total'] = len(files)
-        
-        if not files:
-            indexing_state['errors'].append("No files found!")
+        if not os.path.isdir(books_dir):
+            indexing_state['errors'].append(f"Books directory not found: {books_dir}")
             indexing_state['running'] = False
             return
         
         # Initialize components
+        builder = IndexBuilder(output_dir, build_mode=build_mode)
         checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
-        checkpoint = CheckpointManager(checkpoint_path)
+        checkpoint = CheckpointManager(checkpoint_path, builder.db)
         
         if reset:
+            builder.reset()
             checkpoint.reset()
+        else:
+            builder.discard_uncommitted()
         
-        builder = IndexBuilder(output_dir)
-        extractor = PDFExtractor()
+        if builder.tokenizer != TOKENIZER:
+            indexing_state['errors'].append(
+                f"Index was built with tokenizer {builder.tokenizer}, this version uses {TOKENIZER} - rebuild it with reset"
+            )
+            indexing_state['running'] = False
+            return
         
         # Get already processed count
         already_processed = len(checkpoint.get_processed_files())
         
         # Process files
-        postings_map = {}
         processed_count = 0
         total_chunks = 0
         total_words = 0
+        done_count = 0
+        
+        # Files are streamed from the directory walk; the total grows as
+        # the walk goes on
+        scan = {'found': 0, 'skipped': 0}
+        indexing_state['processed'] = already_processed
         
-        for i, file_path in enumerate(files):
+        extract_cache = None
+        if EXTRACT_CACHE_DIR:
+            extract_cache = ExtractCache(
+                EXTRACT_CACHE_DIR, parse_size(EXTRACT_CACHE_SIZE), EXTRACTOR_VERSION
+            )
+        
+        # Extraction + tokenization run in the worker pool, chunks and
+        # SQLite flushes run in their own pipeline stages
+        pipeline = IndexingPipeline(
+            builder, checkpoint,
+            workers=workers, chunk_size=CHUNK_SIZE, flush_every=flush_every,
+            mem_budget=mem_budget, extract_cache=extract_cache
+        )
+        for result in pipeline.run(iter_pending(iter_files(books_dir), checkpoint, scan)):
             if not indexing_state['running']:
-                # Save before stopping
-                if postings_map:
-                    builder.flush_postings(postings_map)
-                    postings_map = {}
-                break
-            
-            filename = os.path.basename(file_path)
-            
-            # Skip if already processed
-            if checkpoint.is_processed(filename):
-                indexing_state['processed'] = already_processed + processed_count
-                indexing_state['progress'] = (indexing_state['processed'] / indexing_state['total']) * 100
-                continue
+                # Written files still get flushed
+                pipeline.stop()
             
+            filename = result['filename']
             indexing_state['current_file'] = filename
             
-            # Process file
-            chunks_count, words_count, success, error = process_file(
-                file_path, builder, extractor, postings_map
-            )
-            
-            if success:
-                total_chunks += chunks_count
-                total_words += words_count
+            if not result['error']:
+                total_chunks += result['chunks_count']
+                total_words += result['words_count']
                 processed_count += 1
                 
                 indexing_state['chunks'] = total_chunks
                 indexing_state['words'] = total_words
-                
-                # Mark as processed
-                checkpoint.mark_processed(filename, i)
-                
-                # Flush periodically
-                if processed_count % flush_every == 0:
-                    builder.flush_postings(postings_map)
-                    postings_map = {}
             else:
-                indexing_state['errors'].append(f"{filename}: {error}")
+                indexing_state['errors'].append(f"{filename}: {result['error']}")
             
+            done_count += 1
+            indexing_state['total'] = scan['found']
             indexing_state['processed'] = already_processed + processed_count
-            indexing_state['progress'] = ((i + 1) / indexing_state['total']) * 100
+            indexing_state['progress'] = ((scan['skipped'] + done_count) / scan['found']) * 100
             indexing_state['elapsed'] = time.time() - indexing_state['start_time']
+            indexing_state['pipeline'] = pipeline.get_stats()
         
-        # Final flush
-        if postings_map:
-            builder.flush_postings(postings_map)
+        indexing_state['total'] = scan['found']
+        if not scan['found']:
+            indexing_state['errors'].append("No files found!")
+        else:
+            indexing_state['progress'] = ((scan['skipped'] + done_count) / scan['found']) * 100
         
         # Mark as completed only if finished all files
-        if indexing_state['running']:
+        if indexing_state['running'] and scan['found']:
+            # Sorted runs are merged into a fresh, ordered posts table
+            builder.merge_runs()
+            builder.update_word_tables()
             checkpoint.mark_completed()
             
-            # Optimize database
-            builder.vacuum()
+            if build_mode == 'merge':
+                # Optimize database
+                builder.vacuum()
             
             # Upload to Meilisearch
             if upload_meili:
                 uploader = MeiliUploader()
                 uploader.configure_index()
-                uploader.upload_from_file(builder.chunks_path)
+                uploader.upload_from_file(builder.chunks_path, builder.get_titles())
         
         indexing_state['elapsed'] = time.time() - indexing_state['start_time']
         
     except Exception as e:
         indexing_state['errors'].append(f"Fatal error: {str(e)}")
-        # Try to save postings before crashing
-        if builder and 'postings_map' in locals() and postings_map:
-            try:
-                builder.flush_postings(postings_map)
-            except:
-                pass
     finally:
         if builder:
             builder.close()
@@ -232,6 +204,14 @@ def start_indexing():
     flush_every = int(data.get('flush_every', FLUSH_EVERY))
     reset = data.get('reset', False)
     upload_meili = data.get('upload_meili', False)
+    workers = int(data.get('workers', MAX_WORKERS))
+    build_mode = data.get('build_mode', BUILD_MODE)
+    if build_mode not in ('merge', 'runs'):
+        return jsonify({'error': f'Unknown build mode: {build_mode}'}), 400
+    try:
+        mem_budget = parse_size(data.get('mem_budget', MEM_BUDGET))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     # Validate books directory
     if not os.path.exists(books_dir):
@@ -240,7 +220,7 @@ def start_indexing():
     # Start indexing in background
     indexing_thread = threading.Thread(
         target=indexing_worker,
-        args=(books_dir, output_dir, flush_every, reset, upload_meili)
+        args=(books_dir, output_dir, flush_every, reset, upload_meili, workers, build_mode, mem_budget)
     )
     indexing_thread.daemon = True
     indexing_thread.start()
@@ -264,16 +244,17 @@ def get_checkpoint():
     output_dir = request.args.get('output_dir', './index')
     checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
     
-    if not os.path.exists(checkpoint_path):
+    if not os.path.exists(checkpoint_path) and not os.path.exists(os.path.join(output_dir, DB_NAME)):
         return jsonify({'exists': False})
     
-    checkpoint = CheckpointManager(checkpoint_path)
-    
     # Count files in books directory
     books_dir = request.args.get('books_dir', '../books')
     total_files = len(find_files(books_dir)) if os.path.exists(books_dir) else 0
     
-    progress = checkpoint.get_progress(total_files)
+    # Read-only - the checkpoint is only created and migrated by builds
+    progress = read_progress(checkpoint_path, total_files)
+    if progress is None:
+        return jsonify({'exists': False})
     
     return jsonify({
         'exists': True,